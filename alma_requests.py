@@ -2,103 +2,269 @@ import asyncio
 import aiohttp
 from aiohttp import ClientResponseError 
 from utils import check_config, partition
-from asyncio_throttle import Throttler
+from metrics import aiohttp_trace
+from rate_limiter import AdaptiveThrottler, QuotaBudget, QuotaExceeded
 from typing import List, Dict
+from hashlib import sha256
 import logging
 
 
+def extract_user(user: Dict, iz: str = None):
+    '''Given a user object in the format of the Alma Users API, extracts the user\'s barcode and user group, and the IZ (if provided). Returns a tuple of the primary ID and a dictionary of the extracted data (which lacks barcode if the user has none).'''
+    info = {'user_group': extract_user_group(user),
+            'iz': iz}
+    for ident in user.get('user_identifier') or []:    # Each user has more than one identifier
+        if ident['id_type']['value'] == 'BARCODE':
+            info['barcode'] = ident['value']
+            break # Once we've found the barcode, move to the next user
+    return user['primary_id'], info
+
+def extract_user_group(user: Dict):
+    '''Given a user object, extract the user group.'''
+    user_group = user.get('user_group')
+    if user_group:
+        return user_group.get('desc')
+    return user_group
+
+
 class AlmaRequests():
 
-    def __init__(self, config: Dict):
-        '''config should be a Python dictionary containing the API key for the Alma Users API as well as the endpoint for looking up a user by Primary ID. '''
+    def __init__(self, config: Dict, cache=None):
+        '''config should be a Python dictionary containing the API key for the Alma Users API as well as the endpoint for looking up a user by Primary ID. 
+        cache, if provided, should be an instance of SQLiteCache, used to remember which IZ each user was found in.'''
         self.logger = logging.getLogger('lcpp.alma_requests')
         check_config(config=config,
                     top_level_key='Alma', 
                     config_keys=['apikeys', 'users_endpt'],
                     obj=self)
-        # Initialize throttler for Alma's rate limit
-        self.throttler = Throttler(rate_limit=25)
-
+        # Optional rate limit settings: the starting, minimum and maximum requests per second for each API key, and the maximum across all keys combined
+        self.rate_limit = config['Alma'].get('rate_limit', 25)
+        self.min_rate = config['Alma'].get('min_rate', 1)
+        self.max_rate = config['Alma'].get('max_rate', 25)
+        # Daily API calls per IZ to leave unused, and the number of times to retry a request after a 429
+        self.budget = QuotaBudget(reserve=config['Alma'].get('quota_reserve', 1000),
+                                  max_rate=config['Alma'].get('max_total_rate'))
+        self.max_retries = config['Alma'].get('max_retries', 3)
+        # Initialize a throttler for each API key, since Alma's rate limit applies per institution
+        self.throttlers = {apikey: AdaptiveThrottler(self.rate_limit, 
+                                                     min_rate=self.min_rate, 
+                                                     max_rate=self.max_rate, 
+                                                     budget=self.budget) for apikey in self.apikeys}
+        # If true, query all IZ's at once for users whose IZ is not known, rather than one IZ after another
+        self.fanout = config['Alma'].get('fanout', False)
+        self.cache = cache
+        # Optional settings for the HTTP session: maximum open connections and per-request timeout (in seconds)
+        self.connection_limit = config['Alma'].get('connection_limit', 25)
+        self.request_timeout = config['Alma'].get('request_timeout', 30)
+        # The event loop and HTTP session persist across calls to main, so that connections (and DNS and TLS sessions) are reused. Call close() on shutdown.
+        self.loop = asyncio.new_event_loop()
+        self.session = None
 
-    def _extract_info(self, users: List):
-        '''Given a list of user objects, extract a mapping from primary ID to barcode.'''
-        mapping = {}
-        for user in users:
-            primary_id = user['primary_id']
-            mapping[primary_id] = {'user_group': self._extract_user_group(user)}
-            idents = user['user_identifier']
-            for ident in idents:    # Each user has more than one identifier
-                if ident['id_type']['value'] == 'BARCODE':
-                    barcode = ident['value']
-                    mapping[primary_id]['barcode'] = barcode
-                    break # Once we've found the barcode, move to the next user
-        return mapping
 
+    def _extract_info(self, users: List, apikey: str):
+        '''Given a list of user objects from the IZ corresponding to apikey, extract a mapping from primary ID to barcode, user group, and IZ.'''
+        iz = self.iz_id(apikey)
+        return dict(extract_user(user, iz) for user in users)
 
-    def _extract_user_group(self, user: Dict):
-        '''Given a user object, extract the user group.'''
-        user_group = user.get('user_group')
-        if user_group:
-            return user_group.get('desc')
-        return user_group
 
+    @staticmethod
+    def iz_id(apikey: str):
+        '''Returns a short identifier for the IZ corresponding to an API key. (Used so that the keys themselves are not stored in the cache.)'''
+        return sha256(apikey.encode()).hexdigest()[:16]
 
     def main(self, user_ids: List[str]):
         '''Function to run async loop. Argument should be a list of user IDs to retrieve in Alma.
         Returns 1) barcode and other data for users with matching records in an IZ, and 2) users with no match in any IZ.'''
+        user_ids = [user_id for user_id in user_ids if user_id]
+        user_data = {}
+        # API key of the IZ in which each user has already been reported not found
+        tried = {}
+        # Users whose IZ is on record are queried in that IZ first
+        if self.cache:
+            found, tried = self._query_known_izs(user_ids)
+            user_data.update(found)
+            user_ids = [user_id for user_id in user_ids if user_id not in user_data]
+        if user_ids and self.fanout:
+            found, user_ids = self.loop.run_until_complete(self._fan_out(user_ids, tried))
+            user_data.update(found)
+        elif user_ids:
+            found, user_ids = self._query_izs_in_order(user_ids, tried)
+            user_data.update(found)
+        # Log user ID's that could not be found
+        #if user_ids:
+        #    self.logger.error(f"Users could not be found in any IZ: {user_ids}")
+        if self.cache:
+            self.cache.add_iz_affinity([{'primary_id': primary_id, 'iz': data['iz']} for primary_id, data in user_data.items()])
+        self.logger.debug(f'Alma API quota usage: {self.quota_usage()}')
+        return user_data, user_ids
+
+    def _query_izs_in_order(self, user_ids: List[str], exclude: Dict[str, str] = None):
+        '''Queries the IZ's one after another, querying each IZ only for those users not found in the previous one.
+        exclude, if provided, maps user IDs to the API key of an IZ in which they were already not found, which is skipped for them.
+        Returns found users and users not found in any IZ.'''
+        exclude = exclude or {}
         user_data = {}
         # Loop through available Alma API keys in order. Allows querying of multiple IZ's.
         for apikey in self.apikeys:
-            # Create request header
-            self.headers = {'Authorization': f"apikey {apikey}",
-                        'Accept': 'application/json'}
-            results = asyncio.run(self._retrieve_user_records(user_ids))
+            skipped = [user_id for user_id in user_ids if exclude.get(user_id) == apikey]
+            query_ids = [user_id for user_id in user_ids if exclude.get(user_id) != apikey]
+            results = self.loop.run_until_complete(self._retrieve_user_records(query_ids, apikey)) if query_ids else []
             # Valid results have the record_type key
             errors, results = partition(lambda x: x and 'record_type' in x, results)
             # Extract barcodes and user groups as mapping to user IDs
-            user_data.update(self._extract_info(results))
+            user_data.update(self._extract_info(results, apikey))
             # Get the remaining user ID's to query
-            user_ids = [e['User ID'] for e in errors if e['Error'] == 'User Not Found']
+            user_ids = skipped + [e['User ID'] for e in errors if e['Error'] == 'User Not Found']
             if not user_ids:
                 break
-        # Log user ID's that could not be found
-        #if user_ids:
-        #    self.logger.error(f"Users could not be found in any IZ: {user_ids}")
         return user_data, user_ids
 
+    def _query_known_izs(self, user_ids: List[str]):
+        '''Queries each user in the IZ recorded for them in the cache. Returns the users found there, and a mapping of the users reported not found to the API key of the IZ queried (so that it need not be queried again).'''
+        iz_to_key = {self.iz_id(apikey): apikey for apikey in self.apikeys}
+        users_by_key = {}
+        for primary_id, iz in self.cache.iz_lookup_many(user_ids).items():
+            # Ignore IZ's that are no longer configured
+            if iz in iz_to_key:
+                users_by_key.setdefault(iz_to_key[iz], []).append(primary_id)
+        if not users_by_key:
+            return {}, {}
+        self.logger.debug(f'Querying {sum(map(len, users_by_key.values()))} users in their known IZ.')
+        return self.loop.run_until_complete(self._query_keys(users_by_key))
+
+    async def _query_keys(self, users_by_key: Dict[str, List[str]]):
+        '''Queries a different set of users against each API key, concurrently. Returns the users found, and a mapping of the users reported not found to the API key queried.'''
+        apikeys = list(users_by_key.keys())
+        all_results = await asyncio.gather(*[self._retrieve_user_records(users_by_key[apikey], apikey) for apikey in apikeys])
+        user_data = {}
+        not_found = {}
+        for apikey, results in zip(apikeys, all_results):
+            errors, results = partition(lambda x: x and 'record_type' in x, results)
+            user_data.update(self._extract_info(results, apikey))
+            # Users with other errors (e.g., a server error) may be queried again in the same IZ
+            not_found.update({e['User ID']: apikey for e in errors if e and e.get('Error') == 'User Not Found'})
+        return user_data, not_found
 
-    async def _retrieve_user_records(self, user_ids: List[str]):
-        '''Given a list of user IDs, retrieve the barcodes from Alma. Async method that gathers calls to fetch_user concurrently.'''
-        async with aiohttp.ClientSession() as client:
-            queries = [self._fetch_user(user_id, client) for user_id in user_ids if user_id]
-            results =  await asyncio.gather(*queries, return_exceptions=True)
+    async def _fan_out(self, user_ids: List[str], exclude: Dict[str, str] = None):
+        '''Queries all IZ's concurrently for each user, taking the first match. exclude is as for _query_izs_in_order.
+        Returns found users and users not found in any IZ.'''
+        exclude = exclude or {}
+        client = await self._get_session()
+        results = await asyncio.gather(*[self._fan_out_user(user_id, client, exclude.get(user_id)) for user_id in user_ids])
+        user_data = {}
+        not_found = []
+        for user_id, (apikey, result) in zip(user_ids, results):
+            if apikey:
+                user_data.update(self._extract_info([result], apikey))
+            elif result.get('Error') == 'User Not Found':
+                not_found.append(user_id)
+        return user_data, not_found
+
+    async def _fan_out_user(self, user_id: str, client, exclude: str = None):
+        '''Queries a single user in all IZ's at once (except that of the API key exclude, if provided). Returns a tuple of the API key and the record from the first IZ to return a match; the remaining queries are cancelled.
+        If the user is not found, returns None and an error, which is User Not Found only if every IZ reported it as such.'''
+        tasks = {asyncio.ensure_future(self._fetch_user(user_id, client, apikey)): apikey for apikey in self.apikeys if apikey != exclude}
+        pending = set(tasks)
+        errors = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result and 'record_type' in result:
+                        return tasks[task], result
+                    errors.append(result)
+        finally:
+            for task in pending:
+                task.cancel()
+        if all(e.get('Error') == 'User Not Found' for e in errors):
+            return None, {'Error': 'User Not Found', 'User ID': user_id}
+        return None, next(e for e in errors if e.get('Error') != 'User Not Found')
+
+    def close(self):
+        '''Closes the HTTP session and the event loop.'''
+        if self.session:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
+
+    async def _get_session(self):
+        '''Returns the shared aiohttp.ClientSession, creating it on first use. (The session must be created from within the event loop.)'''
+        if not self.session:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, 
+                                             ttl_dns_cache=300) # Cache DNS lookups for 5 minutes
+            self.session = aiohttp.ClientSession(connector=connector, 
+                                                 timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                                                 trace_configs=[aiohttp_trace('alma')]) # Records each request in the metrics
+        return self.session
+
+    async def _retrieve_user_records(self, user_ids: List[str], apikey: str):
+        '''Given a list of user IDs, retrieve the barcodes from the Alma IZ corresponding to apikey. Async method that gathers calls to fetch_user concurrently.'''
+        client = await self._get_session()
+        queries = [self._fetch_user(user_id, client, apikey) for user_id in user_ids if user_id]
+        results =  await asyncio.gather(*queries, return_exceptions=True)
         return results
 
+    def _retry_after(self, headers: Dict):
+        '''Returns the number of seconds to wait from a Retry-After header, if present.'''
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def quota_usage(self):
+        '''Returns the current API quota usage: requests made, responses throttled, the remaining daily quota per IZ (as last reported by Alma), and the IZ's whose quota is exhausted.'''
+        return self.budget.usage()
+
     def _check_error_status(self, error_msg: Dict):
         '''Checks an Alma API error message for a "User not found" error.'''
         for error in error_msg['errorList']['error']:
             if error['errorCode'] == '401861':
                 return True # Found an instance of user not found
 
-    async def _fetch_user(self, user_id: str, client):
+    async def _fetch_user(self, user_id: str, client, apikey: str):
         '''Given a user ID, fetch the user\'s record from the Alma API.
-        client should be an open aiohttp.CLientSessions'''
+        client should be an open aiohttp.CLientSessions
+        apikey should be the API key for the IZ to query.'''
         url = f'{self.users_endpt}/{user_id}' # Construct the URL for this user
+        # Create request header
+        headers = {'Authorization': f"apikey {apikey}",
+                    'Accept': 'application/json'}
+        iz = self.iz_id(apikey)
+        throttler = self.throttlers[apikey]
         try:
-            async with self.throttler: # Throttler is set to enforce Alma's rate limits
-                async with client.get(url, 
-                                        headers=self.headers,
-                                        raise_for_status=False) as session: # client should be a reference to a shared aiohttp.ClientSession
-                    if session.status != 200:
-                        if session.content_type == 'application/json':
-                            body = await session.json()
-                            if self._check_error_status(body): # Test for User not found error
-                                # Flag this error to query the user in another IZ, if possible
-                                return {'Error': 'User Not Found', 'User ID': user_id}
-                        else:
-                            session.raise_for_status()
-                    result = await session.json()
-                    return result
+            for _ in range(self.max_retries + 1):
+                async with throttler: # Throttler adapts to Alma's rate limits
+                    # Checked after waiting on the throttler, so that the quota reflects the latest responses
+                    self.budget.check(iz)
+                    async with client.get(url, 
+                                            headers=headers,
+                                            raise_for_status=False) as session: # client should be a reference to a shared aiohttp.ClientSession
+                        self.budget.update(iz, session.headers)
+                        if session.status == 429:
+                            body = await session.text()
+                            if 'DAILY_THRESHOLD' in body:
+                                self.budget.mark_exhausted(iz)
+                                raise QuotaExceeded(f'Daily API quota exhausted for IZ {iz}')
+                            # Per-second threshold: back off and try again
+                            throttler.on_throttled(self._retry_after(session.headers))
+                            continue
+                        if session.status != 200:
+                            if session.content_type == 'application/json':
+                                body = await session.json()
+                                if self._check_error_status(body): # Test for User not found error
+                                    # Flag this error to query the user in another IZ, if possible
+                                    return {'Error': 'User Not Found', 'User ID': user_id}
+                            else:
+                                session.raise_for_status()
+                        throttler.on_success(self.budget.has_headroom(iz))
+                        result = await session.json()
+                        return result
+            self.logger.error(f'Query to Alma API for user {user_id} still rate limited after {self.max_retries} retries')
+            return {'Error': 429, 'User ID': user_id, 'Error Msg': 'Too Many Requests'}
+        except QuotaExceeded as e:
+            self.logger.warning(f'Skipping query to Alma API for user {user_id} -- {e}')
+            return {'Error': 'Quota Exceeded', 'User ID': user_id}
         # Return exceptions to the asyncio.gather call
         except ClientResponseError as e:
             self.logger.exception(f'Query to Alma API failed on user {user_id}')
@@ -107,9 +273,3 @@ class AlmaRequests():
         except Exception as e:
             self.logger.exception(f'Query to Alma API failed on user {user_id}')
             return {'Error': e, 'User ID': user_id}
-
-
-
-
-
-
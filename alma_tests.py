@@ -11,6 +11,7 @@ if __name__ == '__main__':
 	user_ids = parser.parse_args().users
 	ar = AlmaRequests(load_config('config.yml'))
 	results = ar.main(user_ids)
+	ar.close()
 	print(f'Results: {results}')
 
 
@@ -1,14 +1,23 @@
 import argparse
 import logging
 import sched, time
-from datetime import datetime
+from hashlib import sha256
 from logging.handlers import SMTPHandler
 from typing import Dict, List
 from libcal_requests import LibCalRequests
 from alma_requests import AlmaRequests
 from sqlite_cache import SQLiteCache
+from hot_index import HotIndex
 from pp_requests import PassagePointRequests
-from utils import load_config, check_config
+from negative_cache import NegativeCache, NOT_FOUND, MISSING_BARCODE
+from pipeline import PipelineSync
+from outbox import Outbox
+from leases import LeaseManager
+from reconcile import Reconciler
+from polling import AdaptivePoller
+from tracing import CycleProfiler, traced
+from metrics import CYCLE_DURATION, STAGE_DURATION, BACKLOG, record_lookups, start_server
+from utils import load_config, check_config, to_timestamp
 
 # Configure logging 
 
@@ -34,104 +43,280 @@ def create_loggers(config: Dict):
 
 class LibCal2PP():
 
-    def __init__(self, config_path: str = './config.yml', interval=None):
+    def __init__(self, config_path: str = './config.yml', interval=None, profile_dir: str = None):
         '''
         config_path, if provided, should point to a YAML file with config information for the LibCal, PassagePoint, and Alma API's. 
         interval should be the time (in seconds) to pause between runs of the app. If not provided, the app runs once and quits.
+        profile_dir, if provided, enables tracing: a Chrome trace and cProfile statistics are written there for each cycle.
         '''
         # Load the config file
         self.config = load_config(config_path)
+        # Enabled before the components are created, so that they set up tracing
+        self.profiler = CycleProfiler(profile_dir) if profile_dir else None
         # Initialize components
         self.logger = create_loggers(self.config)
         self.logger.debug('Initializing components')
         # Do not catch errors here - if any of these fail, we want the program to exit
-        self.libcal = LibCalRequests(self.config)
-        self.alma = AlmaRequests(self.config)
         self.cache = SQLiteCache()
+        # Optional in-memory index of appointments and users, in front of the cache
+        if self.config['LCPP'].get('hot_index', False):
+            self.cache = HotIndex(self.cache, max_users=self.config['LCPP'].get('hot_index_max_users', 50000))
+        self.libcal = LibCalRequests(self.config, cache=self.cache)
+        self.alma = AlmaRequests(self.config, cache=self.cache)
         self.pp = PassagePointRequests(self.config)
         # Should contain the value for the interval for scheduled execution
         self.interval = self.config['LCPP']['interval']
-        # Cache for storing invalid user ID's (wiped at midnight daily)
-        self.error_cache = []
+        # Scheduler: "fixed" (poll every interval seconds) or "adaptive" (interval varies with activity and opening hours)
+        self.poller = AdaptivePoller(self) if self.config['LCPP'].get('scheduler', 'fixed') == 'adaptive' else None
+        # Number of new bookings found in the current cycle
+        self.new_booking_count = 0
+        # Sync engine: "batch" (each step completes for all bookings before the next) or "pipeline" (bookings flow through the steps independently)
+        self.engine = self.config['LCPP'].get('engine', 'batch')
+        # Maximum age (in seconds) of a cached Alma profile (barcode and user group) for it to be used instead of querying Alma
+        self.profile_max_age = self.config['LCPP'].get('profile_max_age', 86400)
+        # Cache for storing invalid user ID's (entries expire after a period depending on the reason for the failure)
+        self.error_cache = NegativeCache(self.cache, self.config['LCPP'].get('negative_cache_ttl'))
+        # Time (in seconds) after the end of an appointment at which it is removed from the cache. Bookings that ended longer ago than this are ignored.
+        self.appt_retention = self.config['LCPP'].get('appt_retention', 3600)
+        # Queue of pending PassagePoint operations, retried until they succeed
+        self.outbox = Outbox(self)
+        # Worker mode: if sharding is enabled, the locations are partitioned among the processes sharing the cache
+        self.leases = LeaseManager(self) if self.config['LCPP'].get('sharding', False) else None
+        # Reconciliation: pre-registrations for bookings changed or cancelled in LibCal are updated or deleted in PassagePoint
+        self.reconciler = Reconciler(self) if self.config['LCPP'].get('reconcile', False) else None
 
-    def log_new_bookings(self):
-        '''Retrieve bookings from LibCal and create new pre-registrations in PassagePoint.'''
+    def run_cycle(self):
+        '''Runs a single cycle of the sync, using the engine selected in the config.'''
+        self.new_booking_count = 0
+        if self.profiler:
+            with self.profiler.cycle():
+                self._run_cycle()
+        else:
+            self._run_cycle()
+        self.update_backlog()
+
+    def _run_cycle(self):
+        '''Runs the sync, then retries pending operations and prunes the caches.'''
+        with CYCLE_DURATION.time():
+            if self.engine == 'pipeline':
+                PipelineSync(self).run()
+            else:
+                self.log_new_bookings()
+            # Retry any failed PassagePoint operations that are due
+            self.drain_outbox()
+            self.prune_caches()
+        if self.poller:
+            self.poller.observe(self.new_booking_count)
+
+    def update_backlog(self):
+        '''Records the sizes of the queues of pending work in the metrics.'''
+        BACKLOG.set(self.new_booking_count, queue='new_bookings')
+        BACKLOG.set(len(self.error_cache), queue='invalid_users')
+        try:
+            BACKLOG.set(self.outbox.size(), queue='outbox')
+        except Exception as e:
+            self.logger.exception(f'Error counting the operations in the outbox -- {e}')
+
+    def next_interval(self):
+        '''Returns the time (in seconds) to wait before the next cycle.'''
+        if not self.poller:
+            return self.interval
+        try:
+            return self.poller.next_interval()
+        except Exception as e:
+            self.logger.exception(f'Error computing the polling interval -- {e}')
+            return self.interval
+
+    @traced('drain_outbox')
+    def drain_outbox(self):
+        '''Processes the operations in the outbox that are due.'''
+        try:
+            self.outbox.drain()
+        except Exception as e:
+            self.logger.exception(f'Error processing the outbox -- {e}')
+
+    @traced('get_new_bookings')
+    def get_new_bookings(self):
+        '''Retrieve bookings from LibCal, returning those not already in the cache. Returns None if the bookings could not be retrieved or checked.'''
         self.logger.debug('Querying LibCal API')
         try:
-            bookings = self.libcal.retrieve_bookings_by_location()
+            locations = self.owned_locations()
+            if locations == []:
+                self.logger.debug('No locations assigned to this worker.')
+                return []
+            with STAGE_DURATION.time(stage='libcal_fetch'):
+                bookings = self.libcal.retrieve_bookings_by_location(locations)
         except Exception as e:
             self.logger.error(f'Error retrieving new bookings -- {e}')
-            return
+            return None
         self.logger.debug(f'Bookings retrieved: {len(bookings)}')
-        # Filter out appointments already in the database 
-        new_bookings = [booking for booking in bookings if not self.cache.appt_lookup(booking['bookId'])]
+        # Compare the appointments in the cache with the current bookings, for the locations fetched in full
+        if self.reconciler:
+            try:
+                with STAGE_DURATION.time(stage='reconcile'):
+                    self.reconciler.reconcile(bookings, self.libcal.complete_locations)
+            except Exception as e:
+                self.logger.exception(f'Error reconciling bookings -- {e}')
+        # Ignore bookings that have expired, since they are no longer kept in the cache, and bookings whose times can't be read
+        cutoff = time.time() - self.appt_retention
+        current = []
+        for booking in bookings:
+            times = self.booking_times(booking)
+            if times is None:
+                self.logger.error(f'Skipping booking {booking.get("bookId")} with missing or invalid times: {booking.get("fromDate")} - {booking.get("toDate")}')
+            elif times[1] >= cutoff:
+                current.append(booking)
+        bookings = current
+        # Filter out appointments already in the database, or with a pre-registration pending in the outbox
+        try:
+            keys = [self.appt_key(booking) for booking in bookings]
+            with STAGE_DURATION.time(stage='cache_lookup'):
+                existing = self.cache.appt_lookup_many(keys)
+                existing |= self.outbox.pending_appts(keys)
+        except Exception as e:
+            self.logger.exception(f'Error checking bookings against the cache -- {e}')
+            return None
+        new_bookings = [booking for booking in bookings if self.appt_key(booking) not in existing]
+        record_lookups('appts', hits=len(bookings) - len(new_bookings), misses=len(new_bookings))
+        # Bookings for invalid users turn up again on every poll, so they don't count towards the arrival rate
+        self.new_booking_count = sum(1 for booking in new_bookings if booking['primary_id'] not in self.error_cache)
         if not new_bookings:
             self.logger.debug('No new bookings.')
+        else:
+            self.logger.debug(f'New bookings: {new_bookings}')
+        return new_bookings
+
+    def owned_locations(self):
+        '''In worker mode, claims this worker's share of the locations and returns them. Otherwise, returns None (all locations).'''
+        if not self.leases:
+            return None
+        owned = self.leases.acquire()
+        return [location for location in self.libcal.locations if str(location['id']) in owned]
+
+    def owned_shards(self):
+        '''Returns the location IDs (as strings) held by this worker, or None if not in worker mode.'''
+        return self.leases.owned if self.leases else None
+
+    @staticmethod
+    def appt_key(booking: Dict):
+        '''Identifies a booking in the cache by its bookId and date (YYYY-MM-DD), so that recurring bookings are distinguished.'''
+        return booking['bookId'], booking['fromDate'][:10]
+
+    @staticmethod
+    def booking_times(booking: Dict):
+        '''Returns the start and end times of a booking as UNIX timestamps, or None if either is missing or can\'t be parsed.'''
+        try:
+            return to_timestamp(booking['fromDate']), to_timestamp(booking['toDate'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def booking_fingerprint(booking: Dict):
+        '''Returns a hash of the parts of a booking reflected in its pre-registration (times and location), and of its status, for detecting changes made in LibCal.'''
+        fields = (booking['fromDate'], booking['toDate'], booking['lid'], booking['status'])
+        return sha256('|'.join(map(str, fields)).encode()).hexdigest()[:16]
+
+    def make_prereg(self, booking: Dict):
+        '''Create the prereg data, using the LibCal timestamps and location ID'''
+        appt_id, booking_date = self.appt_key(booking)
+        return {'startTime': booking['fromDate'],
+                'endTime': booking['toDate'],
+                'destination': booking['lid'],
+                'appt_id': appt_id,
+                'booking_date': booking_date,
+                'fingerprint': self.booking_fingerprint(booking)}
+
+    def make_appt_record(self, pre_reg: Dict, prereg_id: str):
+        '''Returns the row for the appts table for a new pre-registration. pre_reg should be as returned by make_prereg.'''
+        return {'appt_id': pre_reg['appt_id'],
+                'booking_date': pre_reg['booking_date'],
+                'prereg_id': prereg_id,
+                'start_time': to_timestamp(pre_reg['startTime']),
+                'end_time': to_timestamp(pre_reg['endTime']),
+                'location_id': pre_reg['destination'],
+                # Absent from pre-registrations queued before fingerprints were stored
+                'fingerprint': pre_reg.get('fingerprint')}
+
+    @traced('log_new_bookings')
+    def log_new_bookings(self):
+        '''Retrieve bookings from LibCal and create new pre-registrations in PassagePoint.'''
+        new_bookings = self.get_new_bookings()
+        if not new_bookings:
             return
-        self.logger.debug(f'New bookings: {new_bookings}')
         # Get the user info we need for PassagePoint, registering any new users in the process
         users = self.process_users(new_bookings)
-        # If no valid users, exit
-        if not users:
+        # Users whose visitor record is waiting to be created in the outbox (including any that failed just now)
+        try:
+            pending_visitors = self.outbox.pending_visitors({b['primary_id'] for b in new_bookings if b['primary_id'] not in users})
+        except Exception as e:
+            self.logger.exception(f'Error checking the outbox -- {e}')
             return
         # Add the VistorId for the Passage Point user to each appointment
-        registrations = []
+        preregs = []
         for booking in new_bookings:
             primary_id = booking['primary_id']
             visitor_id = users.get(primary_id)
             # User not registered -- skip
-            if not visitor_id:
+            if not visitor_id and primary_id not in pending_visitors:
                 continue
-            # Create the prereg data, using the LibCal timestamps and location ID
-            pre_reg = {'startTime': booking['fromDate'],
-                        'endTime': booking['toDate'],
-                        'destination': booking['lid']}
-            try:
-                self.logger.debug(f'Creating new pre-registration in Passage Point for visitor {visitor_id}.')
-                # Make call to Passage Point and get appointment Id
-                prereg_id = self.pp.create_prereg(pre_reg, visitor_id)
-                # Save the prereg Id for insertion into the cache
-                registrations.append({'prereg_id': prereg_id,
-                                    'appt_id': booking['bookId']})
-            except Exception as e:
-                continue
-        if registrations:
-            self.logger.debug('Saving new pre-registrations to cache.')
-            try:
-                self.cache.add_appt(registrations)
-            except Exception as e:
-                self.logger.exception(f'Error saving pre-registrations -- {e}')
-
+            preregs.append({'pre_reg': self.make_prereg(booking),
+                            'primary_id': primary_id,
+                            'visitor_id': visitor_id})
+        self.logger.debug(f'Creating {len(preregs)} new pre-registrations in Passage Point.')
+        # Record the pre-registrations in the outbox before attempting them, so that failures are retried without re-processing the booking
+        try:
+            self.outbox.add_preregs(preregs)
+        except Exception as e:
+            self.logger.exception(f'Error saving pre-registrations to the outbox -- {e}')
+            return
+        # Make calls to Passage Point; successful pre-registrations are saved to the cache
+        self.drain_outbox()
 
-    def process_users(self, bookings: List[Dict[str, str]]):
-        '''Given new appointments from LibCal, check for their presence in the cache and if necessary, retrieve their barcodes from Alma and register them in PassagePoint.'''
+    @traced('sort_users', lambda self, bookings: {'bookings': len(bookings)})
+    def sort_users(self, bookings: List[Dict[str, str]]):
+        '''Given new appointments from LibCal, check for their users\' presence in the cache.
+        Returns 1) a mapping from primary ID to visitor ID for users already registered in PassagePoint, and 2) a mapping from primary ID to user info for users needing to be registered. Users in the error cache, and users whose registration is pending in the outbox, are omitted from the latter.'''
         self.logger.debug(f'Checking for users in the cache.')
         # Users will be a lookup by primary ID to visitor ID
         users = {}
         # New users will be a lookup by primary ID to other user info
         new_users = {}
+        with STAGE_DURATION.time(stage='cache_lookup'):
+            cached_users = self.cache.user_lookup_many(b['primary_id'] for b in bookings)
         for b in bookings:
             primary_id = b['primary_id']
-            # Avoid querying for the same user more than once per batch of appointments
-            if (primary_id not in users) and (primary_id not in new_users):
-                try:
-                    user = self.cache.user_lookup(primary_id)
-                except Exception as e:
-                    self.logger.exception(f'Error processing user {primary_id} -- {e}')
-                    continue
+            # Avoid processing the same user more than once per batch of appointments
+            if (primary_id in users) or (primary_id in new_users):
+                continue
+            user = cached_users.get(primary_id)
             # If the user isn't in the cache, or if the records lacks a visitor_id, need to get their info from Alma
-                if not user or not user.get('visitor_id'):
-                    new_users[primary_id] = {'firstName': b['firstName'],
-                                             'lastName': b['lastName'],
-                                             'email': b['email'],
-                                             'primary_id': primary_id}
+            if not user or not user.get('visitor_id'):
+                new_users[primary_id] = {'firstName': b['firstName'],
+                                         'lastName': b['lastName'],
+                                         'email': b['email'],
+                                         'primary_id': primary_id}
+                # Reuse the user's Alma profile from the cache, if it is recent enough
+                if self.is_fresh_profile(user):
+                    new_users[primary_id].update({k: user[k] for k in ('barcode', 'user_group', 'iz', 'fetched_at')})
             # Otherwise, record their PassagePoint Id
-                else:
-                    users[primary_id] = user['visitor_id']  
+            else:
+                users[primary_id] = user['visitor_id']  
 
-        # Skip any already in the error cache
+        record_lookups('users', hits=len(users), misses=len(new_users))
+        # Skip any already in the error cache or waiting in the outbox
+        pending_visitors = self.outbox.pending_visitors(new_users.keys())
         new_users = {primary_id: booking for primary_id, booking in new_users.items() 
-                                        if primary_id not in self.error_cache}
+                                        if (primary_id not in self.error_cache) and (primary_id not in pending_visitors)}
+        return users, new_users
+
+    @traced('process_users', lambda self, bookings: {'bookings': len(bookings)})
+    def process_users(self, bookings: List[Dict[str, str]]):
+        '''Given new appointments from LibCal, check for their presence in the cache and if necessary, retrieve their barcodes from Alma and register them in PassagePoint.'''
+        try:
+            users, new_users = self.sort_users(bookings)
+        except Exception as e:
+            self.logger.exception(f'Error looking up users in the cache -- {e}')
+            return {}
         if new_users:
             # Register the new users and get back their PassagePoint ID's
             registered_users = {user['primary_id']: user for user in self.register_new_users(new_users) if user}
@@ -146,87 +331,142 @@ class LibCal2PP():
         return users
 
 
-    def register_new_users(self, new_users: Dict[str, Dict[str, str]]):
-        '''new_users should be a dictionary whose keys are Alma Primary IDs and whose values are dictionaries containing additional information from LibCal required to register new users in PassagePoint.'''
-        self.logger.debug(f'Getting new user info from Alma for {list(new_users.keys())}.')
-        # AlmaRequest.main returns a dict mapping primary ID's to barcodes
-        try:
-            pid_to_users, invalid_users = self.alma.main(new_users.keys())
-        except Exception as e:
-            self.logger.exception(f'Error fetching user data for new users -- {e}')
-            return None
-        if invalid_users:
-            self.logger.error(f'Primary ID\'s not found in any IZ: {invalid_users}')
-            self.error_cache.extend(invalid_users)
-        # Register new PassagePoint users -- function should return for each user, their Visitor Id
+    def is_fresh_profile(self, user: Dict):
+        '''True if a user record from the cache contains an Alma profile fetched within the last profile_max_age seconds.'''
+        if not user or not user.get('barcode') or not user.get('fetched_at'):
+            return False
+        return time.time() - user['fetched_at'] < self.profile_max_age
+
+    @traced('fetch_profiles', lambda self, new_users: {'primary_ids': list(new_users)})
+    def fetch_profiles(self, new_users: Dict[str, Dict[str, str]]):
+        '''new_users should be a dictionary whose keys are Alma Primary IDs and whose values are dictionaries containing additional information from LibCal required to register new users in PassagePoint.
+        Adds the barcode and user group from Alma to each user, returning a list of those users that can be registered in PassagePoint. Users whose values already include a (fresh) Alma profile from the cache are not looked up again in Alma.'''
+        # Users with a cached profile
+        pid_to_users = {pid: {k: user[k] for k in ('barcode', 'user_group', 'iz', 'fetched_at')} 
+                            for pid, user in new_users.items() if user.get('fetched_at')}
+        alma_ids = [pid for pid in new_users if pid not in pid_to_users]
+        record_lookups('profiles', hits=len(pid_to_users), misses=len(alma_ids))
+        if alma_ids:
+            self.logger.debug(f'Getting new user info from Alma for {alma_ids}.')
+            # AlmaRequest.main returns a dict mapping primary ID's to barcodes
+            try:
+                with STAGE_DURATION.time(stage='alma'):
+                    alma_users, invalid_users = self.alma.main(alma_ids)
+            except Exception as e:
+                self.logger.exception(f'Error fetching user data for new users -- {e}')
+                alma_users, invalid_users = {}, []
+            if invalid_users:
+                self.logger.error(f'Primary ID\'s not found in any IZ: {invalid_users}')
+                self.error_cache.add(invalid_users, NOT_FOUND)
+            # Save the Alma profiles, so that they need not be fetched again if registration in PassagePoint fails
+            fetched_at = time.time()
+            for user in alma_users.values():
+                user['fetched_at'] = fetched_at
+            try:
+                # Merged, rather than replaced, so that a visitor ID saved in the meantime (e.g., by another worker) is kept
+                self.cache.merge_profiles([{'primary_id': pid, 'barcode': None, 'user_group': None, 'iz': None, **user} 
+                                            for pid, user in alma_users.items()])
+            except Exception as e:
+                self.logger.exception(f'Error saving Alma profiles -- {e}')
+            pid_to_users.update(alma_users)
+        visitors = []
+        missing_barcodes = []
         for pid, user in pid_to_users.items():
             # Update the user info with the barcode and user_group from Alma
             new_user = new_users[pid]
             new_user.update(user) 
             if not user.get('barcode'):
                 self.logger.error(f'User {pid} missing barcode in Alma. Skipping preregistration.')
-                self.error_cache.append(pid)
+                missing_barcodes.append(pid)
                 continue
-            try:
-                self.logger.debug(f'Creating PassagePoint visitor record: {pid}.')
-                # Call to Passage Point API here
-                visitor_id = self.pp.create_visitor(new_user)
-                # Return the user info from Alma and PP
-                yield {'visitor_id': visitor_id,
-                        'primary_id': pid,
-                        'barcode': user['barcode']}
-            except Exception as e:
-                self.logger.exception(f'Error creating PassagePoint visitor record for user {pid} -- {e}')
+            visitors.append(new_user)
+        self.error_cache.add(missing_barcodes, MISSING_BARCODE)
+        return visitors
+
+    @traced('register_new_users', lambda self, new_users: {'primary_ids': list(new_users)})
+    def register_new_users(self, new_users: Dict[str, Dict[str, str]]):
+        '''new_users should be a dictionary whose keys are Alma Primary IDs and whose values are dictionaries containing additional information from LibCal required to register new users in PassagePoint.'''
+        # Register new PassagePoint users -- function should return for each user, their Visitor Id
+        visitors = self.fetch_profiles(new_users)
+        self.logger.debug(f'Creating PassagePoint visitor records: {[v["primary_id"] for v in visitors]}.')
+        # Calls to Passage Point API here, made concurrently
+        failed = []
+        for visitor, visitor_id, error in self.pp.create_visitors(visitors):
+            if error:
+                self.logger.error(f'Error creating PassagePoint visitor record for user {visitor["primary_id"]} -- {error}')
+                failed.append(visitor)
                 continue
+            # Return the user info from Alma and PP
+            yield self.make_user_record(visitor, visitor_id)
+        # Retry failed visitors from the outbox
+        self.queue_failed_visitors(failed)
 
-    def clear_cache(self):
-        '''Clears the appointments cache and the in-memory cache of invalid user ID's.'''
-        self.error_cache = []
+    def queue_failed_visitors(self, visitors: List[Dict]):
+        '''Adds visitors whose creation failed to the outbox, to be retried later.'''
+        if not visitors:
+            return
         try:
-            self.cache.delete_appts()
+            self.outbox.add_visitors(visitors)
         except Exception as e:
-            self.logger.exception(f'Error clearing appointments table: {e}')
+            self.logger.exception(f'Error saving visitors to the outbox -- {e}')
+
+    def make_user_record(self, visitor: Dict, visitor_id: str):
+        '''Returns the row for the users table for a newly registered visitor.'''
+        return {'visitor_id': visitor_id,
+                'primary_id': visitor['primary_id'],
+                'barcode': visitor['barcode'],
+                'user_group': visitor['user_group'],
+                'iz': visitor['iz'],
+                'fetched_at': visitor['fetched_at']}
+
+    def close(self):
+        '''Releases the network resources held by the API clients, this worker's leases, and the cache's connections.'''
+        if self.leases:
+            self.leases.close()
+        self.alma.close()
+        self.libcal.close()
+        self.pp.close()
+        self.cache.close()
+
+    @traced('prune_caches')
+    def prune_caches(self):
+        '''Removes appointments that ended more than appt_retention seconds ago, and expired entries in the cache of invalid user ID's.'''
+        try:
+            self.error_cache.prune()
+            self.cache.delete_expired_appts(time.time() - self.appt_retention)
+        except Exception as e:
+            self.logger.exception(f'Error pruning the cache: {e}')
 
 def run_app(app, scheduler):
     '''Function to schedule the app. 
-    app should be an instance of LibCal2PP. This function calls the log_new_bookings method.
+    app should be an instance of LibCal2PP. This function calls the run_cycle method.
     scheduler should be an instance of sched.scheduler.'''
-    app.log_new_bookings()
+    app.run_cycle()
     # Schedule the next run of this function
-    scheduler.enter(app.interval, 1, run_app, argument=(app, scheduler))
-
-def get_next_midnight():
-    '''Get the timestamp for the next midnight from now.'''
-    today = datetime.now()
-    try:
-        midnight = datetime(today.year, today.month, today.day+1, 0, 0, 0).timestamp()
-    except ValueError:
-        # If the day is out of range, need to get the next month
-        # Check for December 31
-        if today.month == 12 and today.day == 31:
-            midnight = datetime(today.year+1, 1, 1, 0, 0, 0).timestamp()
-        else:
-            midnight = datetime(today.year, today.month+1, 1, 0, 0, 0).timestamp()
-    return midnight
-
-def cleanup(app, scheduler):
-    '''Schedules daily cleanup of the appointments table. This allows recurring appointments in LibCal to be picked up correctly by the app.'''
-    # Calculate the next midnight's timestamp
-    app.clear_cache()
-
-    scheduler.enterabs(get_next_midnight(), 2, cleanup, argument=(app, scheduler))
+    scheduler.enter(app.next_interval(), 1, run_app, argument=(app, scheduler))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    # Accepts an optional path to the config file (e.g., one written by replay.py)
+    parser.add_argument('--config', default='./config.yml')
     # Accepts an option --debug flag to set the log level to DEBUG (most verbose)
     parser.add_argument('--debug', action="store_const", const=logging.DEBUG, default=logging.WARNING)
+    # Accepts an optional port on which to serve metrics (overrides metrics_port in the config)
+    parser.add_argument('--metrics-port', type=int, default=None)
+    # Accepts an optional directory in which to write a trace and profile of each cycle
+    parser.add_argument('--profile', metavar='DIR', default=None)
     args = parser.parse_args()
-    app = LibCal2PP()
+    app = LibCal2PP(config_path=args.config, profile_dir=args.profile)
     app.logger.setLevel(args.debug)
+    metrics_port = args.metrics_port or app.config['LCPP'].get('metrics_port')
+    if metrics_port:
+        start_server(metrics_port)
     # Initialize sched object
     scheduler = sched.scheduler(time.time, time.sleep)
-    scheduler.enterabs(get_next_midnight(), 2, cleanup, argument=(app, scheduler))
-    run_app(app, scheduler)
-    # Run the scheduling thread
-    scheduler.run()
+    try:
+        run_app(app, scheduler)
+        # Run the scheduling thread
+        scheduler.run()
+    finally:
+        app.close()
 
@@ -0,0 +1,333 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging.handlers import SMTPHandler
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+import yaml
+
+# Run from the command line to benchmark the app against local stand-ins for the LibCal, Alma, and PassagePoint API's, e.g.:
+#   python benchmark.py --sizes 10 1000 10000 --latency 0.02 --error-rate 0.01
+# For each number of bookings, log_new_bookings is run once against an empty cache (cold) and once with the users already cached (warm).
+# The report gives the time taken, throughput, the percentiles of the time from the start of the run to the creation of each pre-registration, the operations left in the outbox, and the number of calls to each API endpoint.
+
+LOCATIONS = [8827, 10332]
+APIKEYS = ['benchmark-iz-1', 'benchmark-iz-2']
+
+class FakeAPIs():
+
+    def __init__(self, bookings: int, users_per_booking: float = 0.5, not_found_rate: float = 0.02,
+                latency: Dict[str, float] = None, error_rate: Dict[str, float] = None, seed: int = 0):
+        '''State shared by the fake LibCal, Alma, and PassagePoint API's.
+        bookings is the total number of bookings returned by LibCal (split across LOCATIONS), made by bookings * users_per_booking distinct users, of whom a fraction not_found_rate are not in Alma.
+        latency and error_rate are mappings from API name (libcal, alma, passagepoint) to the delay (in seconds) added to each response, and the fraction of requests (other than authentication) answered with a 500 error.'''
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.prereg_times = []
+        self.ids = itertools.count(1)
+        self.tokens = {'libcal': 'libcal-token', 'passagepoint': 'pp-token'}
+        num_users = max(1, int(bookings * users_per_booking))
+        self.users = {f'G{i:08d}': APIKEYS[i % len(APIKEYS)] for i in range(num_users)
+                        if self.random.random() >= not_found_rate}
+        self.bookings = {lid: [] for lid in LOCATIONS}
+        now = datetime.now().astimezone().replace(microsecond=0)
+        for i in range(bookings):
+            lid = LOCATIONS[i % len(LOCATIONS)]
+            start = now + timedelta(hours=1 + i % 8)
+            self.bookings[lid].append({'bookId': f'bench{i}',
+                                       'lid': lid,
+                                       'fromDate': start.isoformat(),
+                                       'toDate': (start + timedelta(hours=1)).isoformat(),
+                                       'created': (now - timedelta(seconds=bookings - i)).isoformat(),
+                                       'status': 'Mediated Approved',
+                                       'firstName': 'Test',
+                                       'lastName': f'User{i % num_users}',
+                                       'email': f'user{i % num_users}@example.edu',
+                                       'q12505': f'G{i % num_users:08d}'})
+
+    def record(self, endpoint: str):
+        with self.lock:
+            self.calls[endpoint] += 1
+            if endpoint == 'passagepoint:createPreReg':
+                self.prereg_times.append(time.time())
+
+    def fail(self, api: str):
+        '''True if this request should be answered with an error.'''
+        with self.lock:
+            return self.random.random() < self.error_rate.get(api, 0)
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'prereg_times': list(self.prereg_times)}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.prereg_times = []
+
+def make_handler(state: FakeAPIs):
+    '''Returns a request handler that serves all three API's: LibCal under /libcal, Alma under /alma, PassagePoint under /pp. /_stats returns the call counts and /_reset clears them.'''
+
+    class FakeHandler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, status: int = 200, headers: Dict = None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length)
+
+        def _call(self, api: str, endpoint: str):
+            '''Records the call and waits for the configured latency.'''
+            state.record(f'{api}:{endpoint}')
+            time.sleep(state.latency.get(api, 0))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/_stats':
+                return self._send(state.stats())
+            if url.path == '/_reset':
+                state.reset()
+                return self._send({})
+            if url.path.startswith('/libcal/'):
+                return self.libcal_bookings(query)
+            if url.path.startswith('/alma/'):
+                return self.alma_user(url.path.rsplit('/', 1)[-1])
+            if url.path.startswith('/pp/'):
+                return self.pp_get(url.path)
+            self._send({'error': 'Not found'}, 404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path == '/libcal/token':
+                self._call('libcal', 'token')
+                return self._send({'access_token': state.tokens['libcal'], 'expires_in': 3600})
+            if url.path.startswith('/pp/'):
+                return self.pp_post(url.path, body)
+            self._send({'error': 'Not found'}, 404)
+
+        def libcal_bookings(self, query: Dict):
+            self._call('libcal', 'bookings')
+            if self.headers.get('Authorization') != f'Bearer {state.tokens["libcal"]}':
+                return self._send({'error': 'Unauthorized'}, 401)
+            if state.fail('libcal'):
+                return self._send({'error': 'Server error'}, 500)
+            limit = int(query['limit'][0])
+            page = int(query.get('page', ['1'])[0])
+            bookings = state.bookings.get(int(query['lid'][0]), [])
+            self._send(bookings[(page - 1) * limit:page * limit])
+
+        def alma_user(self, primary_id: str):
+            self._call('alma', 'users')
+            apikey = self.headers.get('Authorization', '').replace('apikey ', '')
+            headers = {'X-Exl-Api-Remaining': '100000'}
+            if state.fail('alma'):
+                return self._send({'errorsExist': True}, 500, headers)
+            if state.users.get(primary_id) != apikey:
+                return self._send({'errorsExist': True,
+                                   'errorList': {'error': [{'errorCode': '401861', 'errorMessage': 'User with identifier was not found.'}]}},
+                                  400, headers)
+            self._send({'primary_id': primary_id,
+                        'record_type': {'value': 'PUBLIC'},
+                        'user_group': {'value': '10', 'desc': 'GW Undergraduate'},
+                        'user_identifier': [{'id_type': {'value': 'BARCODE'}, 'value': f'2{primary_id[1:]}'}]}, 200, headers)
+
+        def pp_authorized(self):
+            return self.headers.get('token') == state.tokens['passagepoint']
+
+        def pp_get(self, path: str):
+            self._call('passagepoint', path.rsplit('/', 1)[-1])
+            if not self.pp_authorized():
+                return self._send({'error': 'Unauthorized'}, 401)
+            self._send({'data': [{'id': str(next(state.ids))}]})
+
+        def pp_post(self, path: str, body: bytes):
+            endpoint = path.rsplit('/', 1)[-1]
+            self._call('passagepoint', endpoint)
+            if endpoint == 'login':
+                return self._send({'token': state.tokens['passagepoint']})
+            if not self.pp_authorized():
+                return self._send({'error': 'Unauthorized'}, 401)
+            if state.fail('passagepoint'):
+                return self._send({'error': 'Server error'}, 500)
+            self._send({'data': [{'id': str(next(state.ids))}]})
+
+    return FakeHandler
+
+def serve(options: Dict, port_queue):
+    '''Runs the fake API's (in a child process, so that they don't compete with the app for the GIL). options are passed to FakeAPIs. The port is sent back on port_queue.'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(FakeAPIs(**options)))
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def make_config(root: str, args):
+    '''Returns the app config for the fake API's at root.'''
+    return {'LCPP': {'interval': 300,
+                     'engine': args.engine},
+            'LibCal': {'client_id': 'benchmark',
+                       'client_secret': 'benchmark',
+                       'locations': [{'name': f'Location {lid}', 'id': lid} for lid in LOCATIONS],
+                       'credentials_endpt': f'{root}/libcal/token',
+                       'bookings_endpt': f'{root}/libcal/space/bookings',
+                       'primary_id_field': 'q12505',
+                       'page_size': args.page_size},
+            'Alma': {'apikeys': APIKEYS,
+                     'users_endpt': f'{root}/alma/users',
+                     'rate_limit': args.alma_rate,
+                     'max_rate': args.alma_rate,
+                     'quota_reserve': 0},
+            'PassagePoint': {'username': 'benchmark',
+                             'password': 'benchmark',
+                             'pp_api_root': f'{root}/pp',
+                             'login_endpt': '/login',
+                             'uniqueId_endpt': '/byUniqueId',
+                             'create_visitor_endpt': '/createVisitor',
+                             'create_prereg_endpt': '/createPreReg',
+                             'get_destinations_endpt': '/getDestinations',
+                             'user_mapping': {},
+                             'location_mapping': {lid: f'Location {lid}' for lid in LOCATIONS}},
+            'Emails': {'from_email': 'benchmark@example.edu',
+                       'from_username': 'benchmark',
+                       'from_password': 'benchmark',
+                       'smtp_host': 'localhost',
+                       'to_email': ['benchmark@example.edu']}}
+
+def percentile(values: List[float], p: float):
+    '''Returns the pth percentile (0-100) of values, by the nearest-rank method.'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))]
+
+def get_json(url: str):
+    with urlopen(url) as resp:
+        return json.loads(resp.read())
+
+def run_once(app, root: str, bookings: int, label: str):
+    '''Runs log_new_bookings (or PipelineSync, depending on the engine) once and returns a summary of the run.
+    Latency is the time from the start of the run to the creation of each pre-registration.'''
+    from pipeline import PipelineSync
+    get_json(f'{root}/_reset')
+    start = time.time()
+    if app.engine == 'pipeline':
+        PipelineSync(app).run()
+    else:
+        app.log_new_bookings()
+    elapsed = time.time() - start
+    stats = get_json(f'{root}/_stats')
+    latencies = [t - start for t in stats['prereg_times']]
+    return {'bookings': bookings,
+            'cache': label,
+            'seconds': round(elapsed, 3),
+            'bookings_per_second': round(bookings / elapsed, 1) if elapsed else None,
+            'preregs': len(latencies),
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'outbox': app.outbox.size(),
+            'calls': stats['calls']}
+
+def run_benchmark(bookings: int, args):
+    '''Benchmarks log_new_bookings for the given number of bookings, cold and warm. Returns a list of summaries.'''
+    options = {'bookings': bookings,
+               'users_per_booking': args.users_per_booking,
+               'not_found_rate': args.not_found_rate,
+               'latency': {api: args.latency for api in ('libcal', 'alma', 'passagepoint')},
+               'error_rate': {api: args.error_rate for api in ('libcal', 'alma', 'passagepoint')},
+               'seed': args.seed}
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, port_queue), daemon=True)
+    server.start()
+    root = f'http://127.0.0.1:{port_queue.get(timeout=30)}'
+    cwd = os.getcwd()
+    from app import LibCal2PP
+    with tempfile.TemporaryDirectory() as workdir:
+        # The app keeps its cache in the working directory
+        os.chdir(workdir)
+        app = None
+        try:
+            with open('config.yml', 'w') as f:
+                yaml.safe_dump(make_config(root, args), f)
+            app = LibCal2PP('config.yml')
+            # Don't send emails for errors during the benchmark
+            for logger in (app.logger, logging.getLogger('lcpp')):
+                for handler in list(logger.handlers):
+                    if isinstance(handler, SMTPHandler):
+                        logger.removeHandler(handler)
+            app.logger.setLevel(args.log_level)
+            results = [run_once(app, root, bookings, 'cold')]
+            # Warm: the users are now cached, so only the pre-registrations are created again
+            app.cache.delete_appts()
+            app.cache.delete_outbox([op['key'] for op in app.cache.outbox_due(float('inf'))])
+            results.append(run_once(app, root, bookings, 'warm'))
+            return results
+        finally:
+            if app:
+                app.close()
+            os.chdir(cwd)
+            server.terminate()
+            server.join()
+
+def format_results(results: List[Dict]):
+    '''Formats the summaries as a table.'''
+    def fmt(value):
+        return '-' if value is None else (f'{value:.3f}' if isinstance(value, float) else str(value))
+    columns = ['bookings', 'cache', 'seconds', 'bookings_per_second', 'preregs', 'latency_p50', 'latency_p95', 'latency_p99', 'outbox']
+    rows = [[fmt(r[c]) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.extend('  '.join(v.ljust(w) for v, w in zip(row, widths)) for row in rows)
+    lines.append('')
+    lines.append('API calls:')
+    for r in results:
+        calls = ', '.join(f'{k}={v}' for k, v in sorted(r['calls'].items()))
+        lines.append(f'  {r["bookings"]} {r["cache"]}: {calls}')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the LibCal to PassagePoint sync against local fake API\'s.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 10000], help='Numbers of bookings to benchmark')
+    parser.add_argument('--engine', choices=['batch', 'pipeline'], default='batch', help='Sync engine to benchmark (log_new_bookings or PipelineSync)')
+    parser.add_argument('--latency', type=float, default=0.02, help='Delay (in seconds) added to each API response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API requests answered with a 500 error')
+    parser.add_argument('--users-per-booking', type=float, default=0.5, help='Distinct users per booking')
+    parser.add_argument('--not-found-rate', type=float, default=0.02, help='Fraction of users not found in Alma')
+    parser.add_argument('--page-size', type=int, default=500, help='LibCal page size')
+    parser.add_argument('--alma-rate', type=float, default=500, help='Alma requests per second per API key')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--debug', action='store_const', dest='log_level', const=logging.DEBUG, default=logging.CRITICAL)
+    args = parser.parse_args()
+    results = []
+    for size in args.sizes:
+        results.extend(run_benchmark(size, args))
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
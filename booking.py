@@ -0,0 +1,49 @@
+from typing import Dict, Pattern
+
+class Booking():
+
+    # The fields of a LibCal booking used by the app, under their LibCal names; primary_id is taken from the configured form field
+    __slots__ = ('bookId', 'lid', 'fromDate', 'toDate', 'created', 'status', 'firstName', 'lastName', 'email', 'primary_id')
+
+    def __init__(self, bookId=None, lid=None, fromDate=None, toDate=None, created=None, status=None, 
+                 firstName=None, lastName=None, email=None, primary_id=None):
+        '''A booking from the LibCal space/bookings API, holding only the fields used by the app (rather than the whole API response, with its form answers).
+        Fields are read as attributes or, like the dictionaries returned by the API, by key (e.g., booking['bookId']).'''
+        self.bookId = bookId
+        self.lid = lid
+        self.fromDate = fromDate
+        self.toDate = toDate
+        self.created = created
+        self.status = status
+        self.firstName = firstName
+        self.lastName = lastName
+        self.email = email
+        self.primary_id = primary_id
+
+    @classmethod
+    def from_api(cls, data: Dict, primary_id_field: str, id_match: Pattern):
+        '''Projects a booking from the API response. The primary ID is taken from the form field primary_id_field; if it matches id_match (i.e., is a GWID), it is normalized to uppercase, without surrounding spaces.'''
+        primary_id = data.get(primary_id_field)
+        if isinstance(primary_id, str) and id_match.match(primary_id):
+            primary_id = primary_id.upper().strip()
+        get = data.get
+        return cls(get('bookId'), get('lid'), get('fromDate'), get('toDate'), get('created'), get('status'),
+                   get('firstName'), get('lastName'), get('email'), primary_id)
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __contains__(self, key: str):
+        return key in self.__slots__
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'Booking({self.bookId!r}, lid={self.lid!r}, fromDate={self.fromDate!r}, primary_id={self.primary_id!r})'
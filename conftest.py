@@ -0,0 +1,72 @@
+import logging
+import pytest
+from app import LibCal2PP
+from outbox import Outbox
+from sqlite_cache import SQLiteCache
+
+class FakePassagePoint():
+    '''Stands in for PassagePointRequests. Pre-registrations fail while error is set; calls counts the pre-registrations attempted, and existing maps the appt_id of each pre-registration created to its ID.'''
+    update_prereg_endpt = '/update'
+    delete_prereg_endpt = '/delete'
+    find_prereg_endpt = '/find'
+    max_workers = 2
+
+    def __init__(self):
+        self.error = None
+        self.calls = 0
+        self.existing = {}
+
+    def create_visitor(self, visitor):
+        return f'visitor-{visitor["primary_id"]}'
+
+    def create_prereg(self, pre_reg, visitor_id):
+        self.calls += 1
+        if self.error:
+            raise Exception(self.error)
+        self.existing[pre_reg['appt_id']] = f'prereg-{pre_reg["appt_id"]}'
+        return self.existing[pre_reg['appt_id']]
+
+    def create_preregs(self, preregs, on_result=None):
+        results = []
+        for args in preregs:
+            try:
+                results.append((args, self.create_prereg(*args), None))
+            except Exception as e:
+                results.append((args, None, e))
+            if on_result:
+                on_result(*results[-1])
+        return results
+
+    def find_preregs(self, preregs):
+        return [(args, self.existing.get(args[0]['appt_id']), None) for args in preregs]
+
+class FakeApp():
+    '''Stands in for LibCal2PP, with its methods for turning bookings into pre-registrations and the settings used by the outbox.'''
+    appt_key = staticmethod(LibCal2PP.appt_key)
+    booking_times = staticmethod(LibCal2PP.booking_times)
+    booking_fingerprint = staticmethod(LibCal2PP.booking_fingerprint)
+    make_prereg = LibCal2PP.make_prereg
+    make_appt_record = LibCal2PP.make_appt_record
+    make_user_record = LibCal2PP.make_user_record
+    queue_failed_visitors = LibCal2PP.queue_failed_visitors
+
+    def __init__(self, cache: SQLiteCache):
+        self.config = {'LCPP': {'outbox_base_delay': 30, 'outbox_max_delay': 100, 'outbox_max_attempts': 3}}
+        self.logger = logging.getLogger('lcpp.app')
+        self.cache = cache
+        self.pp = FakePassagePoint()
+        self.outbox = Outbox(self)
+
+    def owned_shards(self):
+        return None
+
+@pytest.fixture
+def cache(tmp_path):
+    '''An empty SQLiteCache.'''
+    cache = SQLiteCache(str(tmp_path / 'cache.db'))
+    yield cache
+    cache.close()
+
+@pytest.fixture
+def app(cache):
+    return FakeApp(cache)
@@ -0,0 +1,171 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterable, List, Tuple
+import logging
+
+# Columns of the users table, as held in the index
+USER_COLUMNS = ('primary_id', 'barcode', 'visitor_id', 'user_group', 'iz', 'fetched_at')
+
+class HotIndex():
+
+    def __init__(self, cache, max_users: int = 50000):
+        '''In-memory index of the appts and users tables, in front of a SQLiteCache (which remains the source of truth). Other methods are passed through to the cache, so an instance can be used in place of the cache.
+        Appointments are all held in memory (the table only holds appointments that have not yet expired). Users are held up to max_users, evicting the least recently used.
+        Writes go to SQLite first, then to the index once committed. Lookups that miss the index fall back to SQLite, so rows written by other processes sharing the cache are still found.'''
+        self.logger = logging.getLogger('lcpp.hot_index')
+        self.cache = cache
+        self.max_users = max_users
+        # Maps (appt_id, booking_date) to the appointment's end time
+        self.appts = {}
+        # Maps primary ID to the user's row, in order of use
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        # Index updates waiting for the current transaction (per thread) to commit
+        self._local = threading.local()
+        self.warm()
+
+    def __getattr__(self, name):
+        # Called only for attributes not defined here
+        return getattr(self.cache, name)
+
+    def warm(self):
+        '''Loads the appointments and the most recently fetched users from SQLite.'''
+        appts = self.cache.load_appt_keys()
+        users = self.cache.load_recent_users(self.max_users)
+        with self.lock:
+            self.appts = appts
+            # Oldest first, so that the most recent are evicted last
+            self.users = OrderedDict((user['primary_id'], user) for user in reversed(users))
+        self.logger.debug(f'Loaded {len(self.appts)} appointments and {len(self.users)} users into the index.')
+
+    def _pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = []
+        return self._local.pending
+
+    def _write_through(self, update):
+        '''Applies an update to the index once the data has been committed to SQLite.'''
+        if self.cache.in_transaction():
+            self._pending().append(update)
+        else:
+            update()
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        '''As SQLiteCache.transaction. The index is updated when the outermost transaction commits; if it rolls back, the updates are discarded.'''
+        outer = not self.cache.in_transaction()
+        try:
+            with self.cache.transaction(immediate=immediate):
+                yield
+        except BaseException:
+            if outer:
+                self._local.pending = []
+            raise
+        if outer:
+            pending, self._local.pending = self._pending(), []
+            for update in pending:
+                update()
+
+    def _index_users(self, users: Iterable[Dict]):
+        with self.lock:
+            for user in users:
+                self.users[user['primary_id']] = user
+                self.users.move_to_end(user['primary_id'])
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def _index_appts(self, appts: Iterable[Dict]):
+        with self.lock:
+            self.appts.update({(appt['appt_id'], appt['booking_date']): appt.get('end_time') for appt in appts})
+
+    def appt_lookup_many(self, appt_keys: Iterable[Tuple[str, str]]):
+        '''Returns the set of the given (appt_id, booking_date) keys that are in the appts table, querying SQLite only for those not in the index.'''
+        appt_keys = set(appt_keys)
+        found = {key for key in appt_keys if key in self.appts}
+        missing = appt_keys - found
+        if missing:
+            found |= self.cache.appt_lookup_many(missing)
+        return found
+
+    def user_lookup_many(self, primary_ids: Iterable[str]):
+        '''Returns a dictionary mapping primary IDs to user data, querying SQLite only for users not in the index.
+        Users without a visitor ID are always looked up in SQLite, since another process may have registered them since.'''
+        users = {}
+        missing = []
+        with self.lock:
+            for primary_id in set(primary_ids):
+                user = self.users.get(primary_id)
+                if user and user.get('visitor_id'):
+                    self.users.move_to_end(primary_id)
+                    users[primary_id] = dict(user)
+                else:
+                    missing.append(primary_id)
+        if missing:
+            found = self.cache.user_lookup_many(missing)
+            self._index_users(found.values())
+            users.update(found)
+        return users
+
+    def user_lookup(self, primary_id: str):
+        return self.user_lookup_many([primary_id]).get(primary_id)
+
+    def add_users(self, user_data: List[Dict[str, str]]):
+        user_data = [{column: user.get(column) for column in USER_COLUMNS} for user in user_data]
+        self.cache.add_users(user_data)
+        self._write_through(lambda: self._index_users(user_data))
+
+    def merge_profiles(self, profiles: List[Dict]):
+        self.cache.merge_profiles(profiles)
+        primary_ids = [profile['primary_id'] for profile in profiles]
+        def update():
+            with self.lock:
+                for primary_id in primary_ids:
+                    self.users.pop(primary_id, None)
+        self._write_through(update)
+
+    def set_visitor_ids(self, visitors: List[Dict[str, str]]):
+        updated = self.cache.set_visitor_ids(visitors)
+        barcodes = {visitor['barcode'] for visitor in visitors}
+        def update():
+            # Users are indexed by primary ID, so those affected are found by scanning
+            with self.lock:
+                for primary_id in [primary_id for primary_id, user in self.users.items() if user.get('barcode') in barcodes]:
+                    del self.users[primary_id]
+        self._write_through(update)
+        return updated
+
+    def add_appt(self, appt_data: List[Dict[str, str]]):
+        appt_data = list(appt_data)
+        self.cache.add_appt(appt_data)
+        self._write_through(lambda: self._index_appts(appt_data))
+
+    def complete_outbox(self, key: str, users: List[Dict] = None, appts: List[Dict] = None, deleted_appts: List[Tuple[str, str]] = None):
+        users = [{column: user.get(column) for column in USER_COLUMNS} for user in users or []]
+        appts = list(appts or [])
+        deleted_appts = [tuple(appt_key) for appt_key in deleted_appts or []]
+        self.cache.complete_outbox(key, users=users, appts=appts, deleted_appts=deleted_appts)
+        def update():
+            self._index_users(users)
+            self._index_appts(appts)
+            with self.lock:
+                for appt_key in deleted_appts:
+                    self.appts.pop(appt_key, None)
+        self._write_through(update)
+
+    def delete_expired_appts(self, cutoff: float):
+        self.cache.delete_expired_appts(cutoff)
+        today = date.today().isoformat()
+        def update():
+            with self.lock:
+                self.appts = {key: end_time for key, end_time in self.appts.items()
+                                if (end_time is not None and end_time >= cutoff) or (end_time is None and key[1] >= today)}
+        self._write_through(update)
+
+    def delete_appts(self):
+        self.cache.delete_appts()
+        def update():
+            with self.lock:
+                self.appts = {}
+        self._write_through(update)
@@ -0,0 +1,64 @@
+import os
+import socket
+import threading
+import time
+from uuid import uuid4
+import logging
+
+class LeaseManager():
+
+    def __init__(self, app):
+        '''Partitions the LibCal locations among worker processes that share the SQL cache, so that each booking is handled by only one worker.
+        Each worker holds leases on its locations, which it renews from a background thread every lease_heartbeat seconds. A lease not renewed within lease_ttl seconds (e.g., because the worker has stopped) is taken over by another worker at the start of its next cycle.
+        app should be an instance of LibCal2PP, whose config and cache are used.'''
+        self.logger = logging.getLogger('lcpp.leases')
+        config = app.config['LCPP']
+        # Identifies this worker in the leases table; should be unique among the workers sharing the cache
+        self.worker_id = config.get('worker_id') or f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.ttl = config.get('lease_ttl', 120)
+        self.heartbeat_interval = config.get('lease_heartbeat', 30)
+        self.cache = app.cache
+        self.shards = [str(location['id']) for location in app.config['LibCal']['locations']]
+        self.owned = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def acquire(self):
+        '''Claims this worker's share of the locations, and starts the heartbeat if it isn't running. Returns the set of location IDs (as strings) held by this worker.'''
+        owned = self.cache.claim_leases(self.worker_id, self.shards, time.time(), self.ttl)
+        if owned != self.owned:
+            self.logger.info(f'Worker {self.worker_id} now holds locations {sorted(owned)}.')
+        self.owned = owned
+        if not self.thread:
+            self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+            self.thread.start()
+        return owned
+
+    def owns(self, location_id):
+        '''True if this worker holds the lease on the location.'''
+        return str(location_id) in self.owned
+
+    def _heartbeat(self):
+        '''Renews this worker's leases until close is called. (The cache gives this thread its own connection.)'''
+        try:
+            while not self.stopped.wait(self.heartbeat_interval):
+                try:
+                    held = self.cache.renew_leases(self.worker_id, time.time(), self.ttl)
+                    lost = self.owned - held
+                    if lost:
+                        self.logger.warning(f'Worker {self.worker_id} lost the leases on locations {sorted(lost)}.')
+                        self.owned = self.owned & held
+                except Exception as e:
+                    self.logger.exception(f'Error renewing leases -- {e}')
+        finally:
+            self.cache.close_connection()
+
+    def close(self):
+        '''Stops the heartbeat and releases this worker's leases.'''
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        try:
+            self.cache.release_leases(self.worker_id)
+        except Exception as e:
+            self.logger.exception(f'Error releasing leases -- {e}')
@@ -1,43 +1,176 @@
+import io
+import json
 import requests
-from utils import check_config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import check_config, iter_json, to_timestamp
+from booking import Booking
+from token_manager import TokenManager
+from metrics import InstrumentedAdapter
 from typing import Dict, List
 from requests.exceptions import HTTPError
+from datetime import date
+from hashlib import sha256
 import logging
 import re
+import time
 
 class LibCalRequests():
 
-    def __init__(self, config: Dict):
-        '''config should contain the client id and client secret for the LibCal API, as well as the authentication and bookings endpoints, all nested under a "LibCal" key. '''
+    def __init__(self, config: Dict, cache=None):
+        '''config should contain the client id and client secret for the LibCal API, as well as the authentication and bookings endpoints, all nested under a "LibCal" key. 
+        cache, if provided, should be an instance of SQLiteCache, used to persist the high-water marks for incremental polling.'''
 
         self.logger = logging.getLogger('lcpp.libcal_requests')
         check_config(config=config,
                     top_level_key='LibCal', 
                     config_keys=['client_id', 'client_secret', 'credentials_endpt', 'bookings_endpt', 'locations', 'primary_id_field'],
                     obj=self)
+        # Optional settings: results per page (the API maximum is 500) and the number of concurrent requests
+        self.page_size = config['LibCal'].get('page_size', 100)
+        self.max_workers = config['LibCal'].get('max_workers', 4)
+        # Incremental polling: return only bookings created since the last poll, with a full sweep every full_sweep_interval seconds
+        self.cache = cache
+        self.incremental = config['LibCal'].get('incremental', False) and (cache is not None)
+        self.full_sweep_interval = config['LibCal'].get('full_sweep_interval', 3600)
+        # Change detection: locations whose bookings are unchanged since the last poll are skipped, except on a full sweep
+        self.change_detection = config['LibCal'].get('change_detection', False) and (cache is not None)
+        # IDs of the locations for which the last call to retrieve_bookings_by_location returned the full set of current bookings (for reconciliation)
+        self.complete_locations = set()
         # Pattern to test for the presence of a valid primary identifier
         self.id_match = re.compile(r'[Gg]\d{8}')
+        # Shared session, so that concurrent requests reuse pooled connections.
+        self.session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            self.session.mount(prefix, InstrumentedAdapter('libcal', pool_maxsize=self.max_workers))
+        # Refreshes the token ahead of its expiry. LibCal reports the token's lifetime; token_lifetime (in seconds) is a fallback.
+        self.tokens = TokenManager(self._request_token, 
+                                   lifetime=config['LibCal'].get('token_lifetime'), 
+                                   name='LibCal')
         self.fetch_token()
 
 
-    def retrieve_bookings_by_location(self):
-        '''Loops through locations provided in the config file to retrieve the bookings associated with each.'''
+    def retrieve_bookings_by_location(self, locations: List[Dict] = None):
+        '''Retrieves the bookings for all locations provided in the config file (or for the given subset of them), querying the locations concurrently.
+        Returns a single list of bookings, deduplicated across locations. The locations whose bookings were returned in full (i.e., fetched successfully and not filtered by the watermarks) are recorded in complete_locations.'''
         bookings = []
-        for location in self.locations:
-            try:
-                booking = self.get_bookings(location)
-                bookings.extend(booking)
-            except Exception as e:
-                self.logger.exception(f'Failed to get bookings for {location["name"]} -- {e}')
-        return bookings
+        self.complete_locations = set()
+        if locations is None:
+            locations = self.locations
+        # The watermarks are looked up here, rather than in the workers, so that the workers don't use the cache
+        watermarks = {location['id']: self.cache.watermark_lookup(location['id']) if (self.incremental or self.change_detection) else None 
+                        for location in locations}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_location, location, watermarks[location['id']]): location for location in locations}
+            for future in as_completed(futures):
+                location = futures[future]
+                try:
+                    location_bookings = future.result()
+                    complete = True
+                    # The watermarks are applied here, one location at a time, rather than in the workers
+                    if self.incremental or self.change_detection:
+                        location_bookings, complete = self.filter_by_watermark(location, *location_bookings)
+                    bookings.extend(self.approved(location_bookings))
+                    if complete:
+                        self.complete_locations.add(location['id'])
+                except Exception as e:
+                    self.logger.exception(f'Failed to get bookings for {location["name"]} -- {e}')
+        return self.dedup_bookings(bookings)
+
+    def fetch_location(self, location: Dict, watermark: Dict = None):
+        '''Fetches the bookings for a location (in a worker thread). watermark should be the location\'s watermark from the cache, if any.
+        If neither incremental polling nor change detection is enabled, returns the list of bookings (of any status). Otherwise, returns a tuple of the bookings (None if LibCal reported every page unchanged), the validators for each page, the watermark, whether this is a full sweep, and the time of the request, for filter_by_watermark.'''
+        if not (self.incremental or self.change_detection):
+            return self.get_bookings(location)
+        now = time.time()
+        full_sweep = self.is_full_sweep(watermark, now)
+        # Pages are requested conditionally, except on a full sweep
+        validators = None
+        if self.change_detection and not full_sweep:
+            validators = json.loads(watermark.get('validators') or '[]')
+        bookings, validators = self.get_bookings_conditional(location, validators)
+        return bookings, validators, watermark, full_sweep, now
+
+    def is_full_sweep(self, watermark: Dict, now: float):
+        '''True if all of a location\'s bookings should be processed: on the first poll of the day and every full_sweep_interval seconds thereafter.'''
+        return (not watermark) or (watermark['booking_date'] != date.today().isoformat()) or \
+                (watermark['last_full_sweep'] is None) or (now - watermark['last_full_sweep'] >= self.full_sweep_interval)
+
+    def filter_by_watermark(self, location: Dict, bookings: List, validators: List, watermark: Dict, full_sweep: bool, now: float):
+        '''Applies change detection and incremental polling to the bookings fetched for a location (as returned by fetch_location), and updates the location\'s watermark.
+        With change detection, returns no bookings if the set of bookings is the same as at the previous poll (or LibCal reported it unchanged).
+        With incremental polling, returns only those bookings created at or after the location\'s high-water mark, and advances the mark. Bookings that were not yet approved at the previous poll (e.g., mediated bookings awaiting approval) are returned too, however old, since they may have been approved since.
+        On a full sweep, all bookings are returned. bookings may be of any status; so may those returned.
+        Returns a tuple of the bookings and whether they are all of the location\'s current bookings.'''
+        today = date.today().isoformat()
+        if full_sweep:
+            self.logger.debug(f'Full sweep of bookings for {location["name"]}.')
+        update = {'location_id': location['id'],
+                  'booking_date': today,
+                  'last_created': watermark['last_created'] if watermark and not full_sweep else None,
+                  'last_full_sweep': now if full_sweep else watermark['last_full_sweep'],
+                  'validators': json.dumps(validators) if any(validators) else None,
+                  'fingerprint': watermark['fingerprint'] if watermark else None,
+                  'held': watermark['held'] if watermark else None}
+        if self.change_detection:
+            if bookings is not None:
+                update['fingerprint'] = self.fingerprint(bookings)
+            if not full_sweep and update['fingerprint'] == watermark['fingerprint']:
+                self.logger.debug(f'Bookings for {location["name"]} unchanged.')
+                if update['validators'] != watermark['validators']:
+                    self.cache.update_watermark(update)
+                return [], False
+        if self.incremental:
+            last_created = update['last_created']
+            if full_sweep:
+                new_bookings = bookings
+            else:
+                held = set(json.loads(watermark['held'] or '[]'))
+                # Bookings created in the same second as the mark are returned again; these are filtered out against the appointments cache
+                new_bookings = [b for b in bookings if (str(b['bookId']) in held) or not self._before_watermark(b, last_created)]
+            # Bookings not (yet) approved, which are returned by the next poll in case they are approved in the meantime
+            update['held'] = json.dumps(sorted({str(b['bookId']) for b in bookings if not self.check_status(b['status'])}))
+            # The mark covers bookings of every status, since those not approved are tracked separately
+            created = [c for c in map(self._created, bookings) if c is not None]
+            if last_created is not None:
+                created.append(last_created)
+            update['last_created'] = max(created, default=None)
+        else:
+            new_bookings = bookings
+        self.cache.update_watermark(update)
+        return new_bookings, (full_sweep or not self.incremental)
 
+    @staticmethod
+    def fingerprint(bookings: List):
+        '''Returns a hash of a set of bookings (in any order), for detecting changes between polls.'''
+        digest = sha256()
+        for booking in sorted(json.dumps(booking.to_dict(), sort_keys=True) for booking in bookings):
+            digest.update(booking.encode())
+        return digest.hexdigest()
+
+    def _before_watermark(self, booking: Dict, last_created: float):
+        '''True if the booking is known to have been created before the high-water mark.'''
+        created = self._created(booking)
+        if (created is None) or (last_created is None):
+            return False
+        return created < last_created
+
+    def _created(self, booking: Dict):
+        '''Returns the creation time of a booking as a UNIX timestamp, or None if not available.'''
+        try:
+            return to_timestamp(booking['created'])
+        except (KeyError, TypeError, ValueError):
+            return None
 
     def check_status(self, booking: Dict):
         '''To filter out bookings with particular kinds of statuses.'''
-        if 'Mediated Approved' in booking:
+        if booking and 'Mediated Approved' in booking:
             return True
         return False
 
+    def approved(self, bookings: List):
+        '''Returns the bookings whose status passes check_status (e.g., not cancelled), deduplicated.'''
+        return self.dedup_bookings([b for b in bookings if self.check_status(b['status'])])
+
     def dedup_bookings(self, bookings: List):
         '''Identified duplicate bookIds, which can occur when appointments are made using the LibCal admin module for the same user for the same time for different seats.
         For the purposes of this integration, we count those as a single booking.'''
@@ -52,40 +185,89 @@ class LibCalRequests():
             return deduped
         return bookings
 
-    def get_bookings(self, location: Dict, retry: bool = False):
-        '''Fetches the space appointments for today\'s date (default).
+    def get_bookings(self, location: Dict):
+        '''Fetches the space appointments for today\'s date (default), paging through the results until exhausted.
         location argument should be a dictionary with keys "name" and "id" from the config file.
+        Returns a list of Booking records, excluding cancelled bookings.'''
+        return self.approved(self.get_bookings_conditional(location)[0])
+
+    def get_bookings_conditional(self, location: Dict, validators: List[Dict] = None):
+        '''As get_bookings, but if validators (the ETag and Last-Modified headers returned for each page at the previous poll) are provided, the pages are requested conditionally.
+        Returns the bookings (of any status, and not deduplicated), or None if LibCal reported every page unchanged, and the validators for each page.'''
+        validators = validators or []
+        bookings = []
+        new_validators = []
+        # Pages that LibCal reported unchanged
+        unchanged = []
+        page = 1
+        while True:
+            validator = validators[page - 1] if page <= len(validators) else None
+            page_bookings, count, validator = self.get_bookings_page(location, page, validator)
+            new_validators.append(validator)
+            if page_bookings is None:
+                unchanged.append(page)
+                # The page has as many results as before
+                more = page < len(validators)
+            else:
+                bookings.extend(page_bookings)
+                # A short page means there are no more results
+                more = count >= self.page_size
+            if not more:
+                break
+            page += 1
+        if unchanged:
+            if len(unchanged) == len(validators) == page:
+                return None, new_validators
+            # Some pages have changed, so the unchanged pages are needed after all
+            for page in unchanged:
+                page_bookings, _, new_validators[page - 1] = self.get_bookings_page(location, page)
+                bookings.extend(page_bookings)
+        return bookings, new_validators
+
+    def get_bookings_page(self, location: Dict, page: int, validator: Dict = None, retry: bool = False):
+        '''Fetches a single page of results from the space/bookings API.
+        The response is parsed one booking at a time, and each booking kept only as a Booking record, with the primary ID (which has a non-descriptive field name in the LibCal API) normalized. 
+        validator, if provided, should contain the etag and/or last_modified returned for the page previously, which are sent as conditional headers.
+        Returns the records, the number of results on the page, and the page\'s validator (None if LibCal does not provide one). If LibCal reports the page unchanged, the records and count are None.
         retry is a flag to manage the need to retry the request after refreshing the token. If retry is true, the call will not be retried again.'''
         try:
-            headers, params = self.prepare_bookings_req(location)
-            resp = requests.get(self.bookings_endpt, 
+            token = self.tokens.get()
+            headers, params = self.prepare_bookings_req(location, page, token)
+            if validator:
+                if validator.get('etag'):
+                    headers['If-None-Match'] = validator['etag']
+                if validator.get('last_modified'):
+                    headers['If-Modified-Since'] = validator['last_modified']
+            resp = self.session.get(self.bookings_endpt, 
                                 headers=headers,
-                                params=params)
+                                params=params,
+                                stream=True)
             resp.raise_for_status()
-            data = resp.json()
-            # Check for error in the JSON
-            if 'error' in data:
-                raise Exception(f'Error returned by LibCal bookings API: {bookings}')
+            if resp.status_code == 304:
+                resp.close()
+                return None, None, validator
+            validator = None
+            if resp.headers.get('ETag') or resp.headers.get('Last-Modified'):
+                validator = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
             bookings = []
-            # Filter out cancelled bookings
-            # Rename the primary ID field, which has a non-descriptive identifier in the LibCap API
-            for booking in data:
-                if not self.check_status(booking['status']):
-                    continue
-                booking['primary_id'] = booking.get(self.primary_id_field)
-                # For GWID, convert to uppercase (in case initial letter is lowercase)
-                # Remove any leading or trailing spaces
-                if self.id_match.match(booking['primary_id']):
-                    booking['primary_id'] = booking['primary_id'].upper().strip()
-                bookings.append(booking)
-            bookings = self.dedup_bookings(bookings)
-            return bookings
+            count = 0
+            with resp:
+                # Decompress, if necessary, as the body is read
+                resp.raw.decode_content = True
+                for data in iter_json(io.TextIOWrapper(resp.raw, encoding=resp.encoding or 'utf-8')):
+                    # Check for error in the JSON
+                    if 'error' in data:
+                        raise Exception(f'Error returned by LibCal bookings API: {data}')
+                    count += 1
+                    # Bookings of every status are kept, so that incremental polling can track those not yet approved; the others are filtered out by the caller
+                    bookings.append(Booking.from_api(data, self.primary_id_field, self.id_match))
+            return bookings, count, validator
         except HTTPError:
             # Test for expired token
             if (resp.reason == 'Unauthorized') and not retry:
                 self.logger.debug('LibCal token expired. Fetching new token.')
-                self.fetch_token()
-                return self.get_bookings(location, retry=True)
+                self.tokens.refresh(stale=token)
+                return self.get_bookings_page(location, page, validator, retry=True)
             self.logger.error(f'Error calling space/bookings API - {resp.reason}')
             self.logger.error(f'Error response: {resp.text}')
             raise
@@ -93,11 +275,14 @@ class LibCalRequests():
             raise
 
 
-    def prepare_bookings_req(self, location: Dict):
+    def prepare_bookings_req(self, location: Dict, page: int, token: str):
         '''Creates the authentication header and the default parameters for the LibCal bookings calls.
-        location argument should be a dictionary with keys "name" and "id." The id field is used to pass the location to the bookings query.'''
-        header = {'Authorization': f'Bearer {self.token}'}
-        params = {'limit': 100,             # Max value
+        location argument should be a dictionary with keys "name" and "id." The id field is used to pass the location to the bookings query.
+        page is the (1-based) page of results to request.
+        token is the authentication token to use.'''
+        header = {'Authorization': f'Bearer {token}'}
+        params = {'limit': self.page_size,
+                'page': page,
                 'lid': location['id'],
                 'formAnswers': 1} # Includes additional form fields 
         return header, params
@@ -105,20 +290,23 @@ class LibCalRequests():
 
     def fetch_token(self):
         '''Retrieves a new authentication token, using supplied credentials.'''
+        self.tokens.refresh(stale=self.tokens.token)
+        return self
+
+    def _request_token(self):
+        '''Requests a new authentication token from the API. Returns the token and its lifetime in seconds.'''
         try:
             cred_body = {'client_id': self.client_id,
                     'client_secret': self.client_secret,
                     'grant_type': 'client_credentials'}
-            resp = requests.post(self.credentials_endpt, json=cred_body)
+            resp = self.session.post(self.credentials_endpt, json=cred_body)
             resp.raise_for_status()
             token = resp.json()
-            # TO DO: Check for expired token and create new if necessary
             # Check for errors in the JSON
             if 'error' in token:
                 raise Exception(f'Error returned by LibCal authentication API: {token}')
-            # Store the access token string
-            self.token = token['access_token']
-            return self
+            # Return the access token string
+            return token['access_token'], token.get('expires_in')
         except HTTPError:
             self.logger.error(f'Error on LibCal authentication API: {resp.reason}')
             self.logger.error(f'Error body: {resp.text}')
@@ -127,6 +315,11 @@ class LibCalRequests():
             self.logger.exception('Error fetching LibCal authentication token.')
             raise
 
+    def close(self):
+        '''Stops the background token refresh and closes the pooled connections.'''
+        self.tokens.close()
+        self.session.close()
+
 
 if __name__ == '__main__':
     from utils import load_config
@@ -0,0 +1,230 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+from tracing import TRACER
+from typing import Dict, Iterable, Tuple
+import logging
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metric():
+
+    kind = None
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        '''Base class for a metric with zero or more labels. Values are kept per combination of label values.'''
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]):
+        '''Returns the tuple of label values, in the order of the metric's labels.'''
+        if set(labels) != set(self.labels):
+            raise ValueError(f'Metric {self.name} expects labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Dict[str, str] = None):
+        '''Formats label values for the Prometheus text format.'''
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        '''Returns the metric in the Prometheus text format.'''
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return '\n'.join(lines)
+
+    def _render_value(self, key: Tuple[str, ...], value):
+        yield f'{self.name}{self._format_labels(key)} {value}'
+
+    def snapshot(self):
+        '''Returns the current values, keyed on tuples of label values.'''
+        with self.lock:
+            return dict(self.values)
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        '''Increases the counter for the given label values.'''
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        '''Sets the gauge for the given label values.'''
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        '''Records observations (e.g., durations in seconds) in cumulative buckets, as well as their count and sum.'''
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        '''Records an observation for the given label values.'''
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        '''Context manager that records the time spent in the block.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key: Tuple[str, ...], value):
+        counts, total, count = value
+        for bound, c in zip(self.buckets, counts):
+            yield f'{self.name}_bucket{self._format_labels(key, {"le": str(bound)})} {c}'
+        yield f'{self.name}_bucket{self._format_labels(key, {"le": "+Inf"})} {count}'
+        yield f'{self.name}_sum{self._format_labels(key)} {total}'
+        yield f'{self.name}_count{self._format_labels(key)} {count}'
+
+class Registry():
+
+    def __init__(self):
+        '''Collection of metrics, rendered together.'''
+        self.metrics = {}
+
+    def _register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        return self._register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        return self._register(Gauge(name, description, labels))
+
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        return self._register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text format.'''
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+    def snapshot(self):
+        '''Returns the current values of all metrics, keyed on metric name.'''
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+# Registry used by the app's components
+REGISTRY = Registry()
+
+CYCLE_DURATION = REGISTRY.histogram('lcpp_cycle_duration_seconds', 'Duration of a sync cycle.')
+STAGE_DURATION = REGISTRY.histogram('lcpp_stage_duration_seconds',
+                                    'Duration of each stage of the sync: libcal_fetch and alma per cycle or batch, cache_lookup per lookup, reconcile per cycle, pp_visitor, pp_prereg, pp_update, and pp_cancel per record.',
+                                    labels=('stage',))
+UPSTREAM_REQUESTS = REGISTRY.counter('lcpp_upstream_requests_total',
+                                     'Requests to each upstream API, by HTTP status (or "error" if no response was received).',
+                                     labels=('upstream', 'status'))
+UPSTREAM_LATENCY = REGISTRY.histogram('lcpp_upstream_request_duration_seconds', 'Duration of requests to each upstream API.', labels=('upstream',))
+CACHE_LOOKUPS = REGISTRY.counter('lcpp_cache_lookups_total', 'Lookups in the SQLite cache, by table and result (hit or miss).', labels=('table', 'result'))
+BACKLOG = REGISTRY.gauge('lcpp_backlog', 'Items waiting: outbox (PassagePoint operations), invalid_users (negative cache entries), new_bookings (in the last cycle).', labels=('queue',))
+
+def record_request(upstream: str, status, duration: float):
+    '''Records a request to an upstream API. status should be the HTTP status code, or None if the request failed without a response.'''
+    UPSTREAM_REQUESTS.inc(upstream=upstream, status=status if status is not None else 'error')
+    UPSTREAM_LATENCY.observe(duration, upstream=upstream)
+
+def record_lookups(table: str, hits: int, misses: int):
+    '''Records the results of a bulk cache lookup.'''
+    CACHE_LOOKUPS.inc(hits, table=table, result='hit')
+    CACHE_LOOKUPS.inc(misses, table=table, result='miss')
+
+class InstrumentedAdapter(HTTPAdapter):
+
+    def __init__(self, upstream: str, **kwargs):
+        '''Transport adapter for requests.Session that records each request to the upstream API (and a span, if tracing is enabled). Keyword arguments are passed to HTTPAdapter.'''
+        self.upstream = upstream
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        with TRACER.span('http', upstream=self.upstream, method=request.method, url=request.url) as span:
+            start = time.perf_counter()
+            try:
+                resp = super().send(request, **kwargs)
+            except Exception:
+                record_request(self.upstream, None, time.perf_counter() - start)
+                raise
+            record_request(self.upstream, resp.status_code, time.perf_counter() - start)
+            span.tag(status=resp.status_code)
+            return resp
+
+def aiohttp_trace(upstream: str):
+    '''Returns an aiohttp.TraceConfig that records each request to the upstream API (and a span, if tracing is enabled).'''
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        end = time.perf_counter()
+        record_request(upstream, params.response.status, end - context.start)
+        TRACER.record('http', context.start, end, {'upstream': upstream, 'method': params.method, 'url': str(params.url), 'status': params.response.status})
+
+    async def on_request_exception(session, context, params):
+        end = time.perf_counter()
+        record_request(upstream, None, end - context.start)
+        TRACER.record('http', context.start, end, {'upstream': upstream, 'method': params.method, 'url': str(params.url), 'error': type(params.exception).__name__})
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('lcpp.metrics').debug(format % args)
+
+def start_server(port: int, host: str = '127.0.0.1'):
+    '''Serves the metrics at http://host:port/metrics from a background thread. Returns the server; call shutdown() to stop it.'''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.getLogger('lcpp.metrics').debug(f'Serving metrics on {host}:{server.server_address[1]}.')
+    return server
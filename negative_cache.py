@@ -0,0 +1,52 @@
+import time
+from typing import Dict, Iterable
+import logging
+
+# Reasons for which a user may be recorded as invalid
+NOT_FOUND = 'not_found'             # Primary ID not found in any Alma IZ
+MISSING_BARCODE = 'missing_barcode' # Alma record has no barcode
+
+# Default time (in seconds) for which a user is considered invalid, by reason
+DEFAULT_TTLS = {NOT_FOUND: 86400,
+                MISSING_BARCODE: 3600}
+
+class NegativeCache():
+
+    def __init__(self, cache, ttls: Dict[str, int] = None):
+        '''Keeps track of user ID's that could not be registered, so that they are not looked up again in Alma until their entry expires.
+        cache should be an instance of SQLiteCache, in which the entries are persisted (so that they survive restarts).
+        ttls, if provided, should map reasons (NOT_FOUND, MISSING_BARCODE) to expiry times in seconds, overriding the defaults.'''
+        self.logger = logging.getLogger('lcpp.negative_cache')
+        self.cache = cache
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        # In-memory copy of the unexpired entries, mapping primary ID to expiry timestamp
+        self.entries = self.cache.load_invalid_users(time.time())
+        self.logger.debug(f'Loaded {len(self.entries)} invalid users from the cache.')
+
+    def __contains__(self, primary_id: str):
+        '''True if the user is recorded as invalid and the entry has not yet expired.'''
+        expires_at = self.entries.get(primary_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self.entries[primary_id]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, primary_ids: Iterable[str], reason: str):
+        '''Records the given user ID's as invalid for the given reason.'''
+        expires_at = time.time() + self.ttls[reason]
+        rows = [{'primary_id': primary_id, 'reason': reason, 'expires_at': expires_at} for primary_id in set(primary_ids)]
+        if not rows:
+            return
+        self.cache.add_invalid_users(rows)
+        self.entries.update({row['primary_id']: expires_at for row in rows})
+
+    def prune(self):
+        '''Removes expired entries from memory and from the database.'''
+        now = time.time()
+        self.entries = {primary_id: expires_at for primary_id, expires_at in self.entries.items() if expires_at > now}
+        self.cache.delete_expired_invalid_users(now)
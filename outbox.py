@@ -0,0 +1,257 @@
+import json
+import random
+import time
+from typing import Dict, Iterable, List, Tuple
+import logging
+
+# Kinds of operation
+VISITOR = 'visitor'
+PREREG = 'prereg'
+UPDATE = 'update'
+CANCEL = 'cancel'
+
+class Outbox():
+
+    def __init__(self, app):
+        '''Durable queue of PassagePoint operations (visitor creation, pre-registration, and the update and deletion of pre-registrations), stored in the outbox table of the SQL cache.
+        Failed operations are retried with exponential backoff, without needing to look up the booking in LibCal or the user in Alma again.
+        app should be an instance of LibCal2PP, whose cache and PassagePoint client are used.'''
+        self.logger = logging.getLogger('lcpp.outbox')
+        self.app = app
+        # Delay (in seconds) before the first retry, doubled on each subsequent attempt up to max_delay
+        self.base_delay = app.config['LCPP'].get('outbox_base_delay', 30)
+        self.max_delay = app.config['LCPP'].get('outbox_max_delay', 3600)
+        # Operations are dropped after this many failed attempts
+        self.max_attempts = app.config['LCPP'].get('outbox_max_attempts', 10)
+        # Time (in seconds) for which operations being attempted are hidden from other workers sharing the cache
+        self.claim_timeout = app.config['LCPP'].get('outbox_claim_timeout', 300)
+        if not app.pp.find_prereg_endpt:
+            self.logger.warning('Without find_prereg_endpt in the PassagePoint config, pre-registrations whose outcome is unknown (e.g., after a timeout or a crash) are retried without checking for a duplicate.')
+
+    @staticmethod
+    def prereg_key(appt_key: Tuple[str, str]):
+        '''Idempotency key for the pre-registration of a LibCal booking, identified by a tuple of bookId and booking date.'''
+        appt_id, booking_date = appt_key
+        return f'{PREREG}:{appt_id}:{booking_date}'
+
+    @staticmethod
+    def update_key(appt_key: Tuple[str, str]):
+        '''Idempotency key for the update of a pre-registration after its booking changed in LibCal.'''
+        appt_id, booking_date = appt_key
+        return f'{UPDATE}:{appt_id}:{booking_date}'
+
+    @staticmethod
+    def cancel_key(appt_key: Tuple[str, str]):
+        '''Idempotency key for the deletion of a pre-registration after its booking was cancelled (or changed) in LibCal.'''
+        appt_id, booking_date = appt_key
+        return f'{CANCEL}:{appt_id}:{booking_date}'
+
+    @staticmethod
+    def visitor_key(primary_id: str):
+        '''Idempotency key for the creation of a PassagePoint visitor.'''
+        return f'{VISITOR}:{primary_id}'
+
+    def add_preregs(self, preregs: List[Dict], claimed: bool = False):
+        '''Queues pre-registrations. Each entry should be a dictionary with the prereg data (see LibCal2PP.make_prereg) under pre_reg, the user's primary_id, and the visitor_id (which may be None if the visitor is itself pending in the outbox).
+        If claimed is true, the caller is about to attempt the pre-registrations itself, and should record the outcome of each with complete_preregs or fail_preregs. They are claimed as they are added (see SQLiteCache.claim_outbox), so that drain leaves them alone in the meantime; if the caller stops before recording an outcome, they become due once the claim expires.'''
+        now = time.time()
+        self.app.cache.add_outbox([{'key': self.prereg_key((p['pre_reg']['appt_id'], p['pre_reg']['booking_date'])),
+                                    'op': PREREG,
+                                    'payload': json.dumps(p),
+                                    'next_attempt_at': now + self.claim_timeout if claimed else now,
+                                    'claimed_at': now if claimed else None,
+                                    # Pre-registrations belong to the worker holding the booking's location
+                                    'shard': str(p['pre_reg']['destination'])} for p in preregs])
+
+    def complete_preregs(self, appts: List[Dict]):
+        '''Saves the appointments for pre-registrations created by the caller (rows as returned by LibCal2PP.make_appt_record), removing them from the outbox in the same transaction.'''
+        with self.app.cache.transaction():
+            self.app.cache.add_appt(appts)
+            self.app.cache.delete_outbox([self.prereg_key((a['appt_id'], a['booking_date'])) for a in appts])
+
+    def fail_preregs(self, preregs: List[Tuple[Dict, str]]):
+        '''Records the failure of pre-registrations attempted by the caller, scheduling their first retry. preregs should be a list of tuples of a pre-registration (as accepted by add_preregs) and the error.
+        Pre-registrations that are not in the outbox (e.g., because adding them failed) are added.'''
+        with self.app.cache.transaction():
+            self.add_preregs([p for p, _ in preregs])
+            self._reschedule([({'key': self.prereg_key((p['pre_reg']['appt_id'], p['pre_reg']['booking_date'])), 'attempts': 0}, error)
+                              for p, error in preregs])
+
+    def add_visitors(self, visitors: List[Dict], delay: bool = True):
+        '''Queues visitor creation. Each visitor should be a dictionary as accepted by PassagePointRequests.create_visitor, with the fields required by LibCal2PP.make_user_record.
+        If delay is true, the first attempt is delayed (e.g., because the operation has just failed).'''
+        next_attempt_at = time.time() + (self.base_delay if delay else 0)
+        self.app.cache.add_outbox([{'key': self.visitor_key(v['primary_id']),
+                                    'op': VISITOR,
+                                    'payload': json.dumps(v),
+                                    'next_attempt_at': next_attempt_at} for v in visitors])
+
+    def add_updates(self, updates: List[Dict]):
+        '''Queues updates of pre-registrations. Each entry should be a dictionary with the prereg_id, the location_id of the appointment in the cache, and the new prereg data (see LibCal2PP.make_prereg) under pre_reg.'''
+        self.app.cache.add_outbox([{'key': self.update_key((u['pre_reg']['appt_id'], u['pre_reg']['booking_date'])),
+                                    'op': UPDATE,
+                                    'payload': json.dumps(u),
+                                    'next_attempt_at': time.time(),
+                                    'shard': str(u['location_id'])} for u in updates])
+
+    def add_cancels(self, cancels: List[Dict]):
+        '''Queues deletions of pre-registrations. Each entry should be a dictionary with the appt_id, booking_date, prereg_id, and location_id of the appointment in the cache, and under recreate, either None or a pre-registration (as accepted by add_preregs) to queue once the deletion succeeds.'''
+        self.app.cache.add_outbox([{'key': self.cancel_key((c['appt_id'], c['booking_date'])),
+                                    'op': CANCEL,
+                                    'payload': json.dumps(c),
+                                    'next_attempt_at': time.time(),
+                                    'shard': str(c['location_id'])} for c in cancels])
+
+    def pending_appts(self, appt_keys: Iterable[Tuple[str, str]]):
+        '''Returns the set of the given bookings (tuples of LibCal bookId and booking date) that have a pre-registration pending in the outbox.'''
+        appt_keys = list(appt_keys)
+        pending = self.app.cache.outbox_lookup_many(self.prereg_key(key) for key in appt_keys)
+        return {key for key in appt_keys if self.prereg_key(key) in pending}
+
+    def pending_changes(self, appt_keys: Iterable[Tuple[str, str]]):
+        '''Returns the set of the given bookings (tuples of LibCal bookId and booking date) that have an update or deletion pending in the outbox.'''
+        appt_keys = list(appt_keys)
+        pending = self.app.cache.outbox_lookup_many([self.update_key(key) for key in appt_keys] + [self.cancel_key(key) for key in appt_keys])
+        return {key for key in appt_keys if (self.update_key(key) in pending) or (self.cancel_key(key) in pending)}
+
+    def pending_visitors(self, primary_ids: Iterable[str]):
+        '''Returns the set of the given primary IDs whose visitor creation is pending in the outbox.'''
+        primary_ids = list(primary_ids)
+        pending = self.app.cache.outbox_lookup_many(self.visitor_key(pid) for pid in primary_ids)
+        return {pid for pid in primary_ids if self.visitor_key(pid) in pending}
+
+    def size(self):
+        '''Number of operations pending in the outbox.'''
+        return self.app.cache.count_outbox()
+
+    @staticmethod
+    def in_doubt(op: Dict):
+        '''True if an operation may already have been carried out in PassagePoint: it failed before (perhaps after PassagePoint received the request, e.g., with a timeout), or its last claim expired without a result being recorded.'''
+        return (op['attempts'] > 0) or (op.get('claimed_at') is not None)
+
+    def _complete(self, key: str, **results):
+        '''Removes a completed operation from the outbox and saves its results (see SQLiteCache.complete_outbox). If that fails, the operation is left claimed, to be checked when the claim expires.'''
+        try:
+            self.app.cache.complete_outbox(key, **results)
+        except Exception as e:
+            self.logger.exception(f'Error saving the result of {key} -- {e}')
+
+    def drain(self):
+        '''Attempts all operations that are due: visitors first, so that pre-registrations waiting on them can go ahead, then pre-registrations, updates, and deletions.
+        The operations are claimed first, so that workers sharing the cache don't attempt the same operation; in worker mode, only pre-registrations for this worker's locations are attempted.
+        The result of each operation is saved as soon as PassagePoint returns it, so that a crash loses at most the results of the calls in flight. Pre-registrations in doubt (see in_doubt) are looked up in PassagePoint first, if find_prereg_endpt is configured, so that they are not created twice.'''
+        due = self.app.cache.claim_outbox(time.time(), self.claim_timeout, self.app.owned_shards())
+        if not due:
+            return
+        self.logger.debug(f'Processing {len(due)} operations from the outbox.')
+        self._drain_visitors([op for op in due if op['op'] == VISITOR])
+        self._drain_preregs([op for op in due if op['op'] == PREREG])
+        self._drain_updates([op for op in due if op['op'] == UPDATE])
+        self._drain_cancels([op for op in due if op['op'] == CANCEL])
+
+    def _drain_visitors(self, ops: List[Dict]):
+        '''Creates the queued visitors in PassagePoint.'''
+        if not ops:
+            return
+        def save(visitor, visitor_id, error):
+            if not error:
+                self._complete(self.visitor_key(visitor['primary_id']), users=[self.app.make_user_record(visitor, visitor_id)])
+        results = self.app.pp.create_visitors([json.loads(op['payload']) for op in ops], on_result=save)
+        self._reschedule([(op, error) for op, (_, _, error) in zip(ops, results) if error])
+
+    def _drain_preregs(self, ops: List[Dict]):
+        '''Creates the queued pre-registrations in PassagePoint.'''
+        if not ops:
+            return
+        payloads = [json.loads(op['payload']) for op in ops]
+        # Pre-registrations queued before their visitor was created get the visitor ID from the cache
+        users = self.app.cache.user_lookup_many(p['primary_id'] for p in payloads if not p['visitor_id'])
+        ready = []
+        failed = []
+        for op, payload in zip(ops, payloads):
+            visitor_id = payload['visitor_id'] or (users.get(payload['primary_id']) or {}).get('visitor_id')
+            if not visitor_id:
+                failed.append((op, 'Visitor not yet registered'))
+                continue
+            ready.append((op, (payload['pre_reg'], visitor_id)))
+        ready = self._check_preregs(ready, failed)
+        def save(args, prereg_id, error):
+            pre_reg, _ = args
+            if not error:
+                self._complete(self.prereg_key((pre_reg['appt_id'], pre_reg['booking_date'])), appts=[self.app.make_appt_record(pre_reg, prereg_id)])
+        results = self.app.pp.create_preregs([args for _, args in ready], on_result=save)
+        failed.extend((op, error) for (op, _), (_, _, error) in zip(ready, results) if error)
+        self._reschedule(failed)
+
+    def _check_preregs(self, ready: List[Tuple[Dict, Tuple]], failed: List):
+        '''Looks up the pre-registrations in doubt in PassagePoint, completing those that exist. ready should be a list of tuples of the operation and the arguments for create_prereg; returns those still to be created.
+        Pre-registrations that could not be looked up are added to failed, rather than risk creating them twice.'''
+        in_doubt = [(op, args) for op, args in ready if self.in_doubt(op)]
+        if not (in_doubt and self.app.pp.find_prereg_endpt):
+            return ready
+        resolved = set()
+        for (op, _), ((pre_reg, _), prereg_id, error) in zip(in_doubt, self.app.pp.find_preregs([args for _, args in in_doubt])):
+            if error:
+                failed.append((op, f'Error checking for an existing pre-registration: {error}'))
+            elif prereg_id:
+                self.logger.info(f'Found existing pre-registration {prereg_id} for {op["key"]}.')
+                self._complete(op['key'], appts=[self.app.make_appt_record(pre_reg, prereg_id)])
+            else:
+                continue
+            resolved.add(op['key'])
+        return [(op, args) for op, args in ready if op['key'] not in resolved]
+
+    def _drain_updates(self, ops: List[Dict]):
+        '''Updates the queued pre-registrations in PassagePoint, saving the new times and location of each to the cache.'''
+        if not ops:
+            return
+        payloads = [json.loads(op['payload']) for op in ops]
+        def save(args, _, error):
+            prereg_id, pre_reg = args
+            if not error:
+                self._complete(self.update_key((pre_reg['appt_id'], pre_reg['booking_date'])), appts=[self.app.make_appt_record(pre_reg, prereg_id)])
+        results = self.app.pp.update_preregs([(p['prereg_id'], p['pre_reg']) for p in payloads], on_result=save)
+        self._reschedule([(op, error) for op, (_, _, error) in zip(ops, results) if error])
+
+    def _drain_cancels(self, ops: List[Dict]):
+        '''Deletes the queued pre-registrations in PassagePoint, removing them from the cache. Replacement pre-registrations, if any, are queued in the same transaction.'''
+        if not ops:
+            return
+        payloads = {p['prereg_id']: p for p in (json.loads(op['payload']) for op in ops)}
+        def save(prereg_id, _, error):
+            if error:
+                return
+            payload = payloads[prereg_id]
+            try:
+                with self.app.cache.transaction():
+                    self.app.cache.complete_outbox(self.cancel_key((payload['appt_id'], payload['booking_date'])),
+                                                   deleted_appts=[(payload['appt_id'], payload['booking_date'])])
+                    if payload['recreate']:
+                        self.add_preregs([payload['recreate']])
+            except Exception as e:
+                self.logger.exception(f'Error saving the deletion of pre-registration {prereg_id} -- {e}')
+        results = self.app.pp.delete_preregs(list(payloads), on_result=save)
+        self._reschedule([(op, error) for op, (_, _, error) in zip(ops, results) if error])
+
+    def _reschedule(self, failed: List):
+        '''Schedules the next attempt for failed operations, with exponential backoff (plus jitter), or drops them after max_attempts.'''
+        now = time.time()
+        retries = []
+        dropped = []
+        for op, error in failed:
+            attempts = op['attempts'] + 1
+            if attempts >= self.max_attempts:
+                dropped.append(op['key'])
+                continue
+            delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            retries.append({'key': op['key'],
+                            'attempts': attempts,
+                            'next_attempt_at': now + delay * random.uniform(1, 1.25),
+                            'last_error': str(error)})
+        if retries:
+            self.logger.debug(f'Rescheduling {len(retries)} failed operations.')
+            self.app.cache.reschedule_outbox(retries)
+        if dropped:
+            # Pre-registrations dropped here will be picked up as new bookings on the next cycle
+            self.logger.error(f'Dropping operations after {self.max_attempts} failed attempts: {dropped}')
+            self.app.cache.delete_outbox(dropped)
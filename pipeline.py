@@ -0,0 +1,223 @@
+import logging
+import threading
+from queue import Queue, Empty, Full
+from typing import Dict, List, Tuple
+from utils import chunked
+from tracing import traced
+
+# Marks the end of the work for a stage's worker threads
+STOP = None
+
+class PipelineSync():
+
+    def __init__(self, app):
+        '''Alternative to LibCal2PP.log_new_bookings, in which each booking moves on to the next step as soon as it is ready, rather than waiting for all bookings to complete each step.
+        app should be an instance of LibCal2PP, whose API clients and cache are used.
+
+        Stages:
+        1. The calling thread fetches the new bookings and sorts their users. Bookings for users already registered in PassagePoint go straight to the prereg stage.
+        2. The calling thread looks up the remaining users in Alma, in small batches; as each batch returns, its users are passed to the visitor stage.
+        3. Visitor workers create the users in PassagePoint, then pass their bookings to the prereg stage.
+        4. Prereg workers create the pre-registrations.
+        Pre-registrations are written to the outbox (claimed) before they are attempted, so that one whose result is lost in a crash is retried later, and failed operations are retried from the outbox.
+        The stages are connected by bounded queues. Results are sent back to the calling thread, which does the rest of the writes to the cache, in batches.'''
+        self.logger = logging.getLogger('lcpp.pipeline')
+        self.app = app
+        # Number of users per Alma request batch
+        self.alma_batch_size = app.config['LCPP'].get('pipeline_alma_batch', 25)
+        # Maximum number of items waiting between stages
+        self.queue_size = app.config['LCPP'].get('pipeline_queue_size', 100)
+        # Number of threads for each PassagePoint stage
+        self.workers = app.pp.max_workers
+
+    @traced('pipeline')
+    def run(self):
+        '''Runs a single cycle of the sync.'''
+        new_bookings = self.app.get_new_bookings()
+        if not new_bookings:
+            return
+        try:
+            users, new_users = self.app.sort_users(new_bookings)
+        except Exception as e:
+            self.logger.exception(f'Error looking up users in the cache -- {e}')
+            return
+        self.visitor_queue = Queue(maxsize=self.queue_size)
+        self.prereg_queue = Queue(maxsize=self.queue_size)
+        # Unbounded, so that workers never block on the calling thread
+        self.results = Queue()
+        self.completed = 0
+        self.new_records = {'users': [], 'appts': []}
+        visitor_threads = self._start_workers(self._visitor_worker)
+        prereg_threads = self._start_workers(self._prereg_worker)
+        try:
+            self._feed(new_bookings, users, new_users)
+            # Wait for every booking to be registered or dropped
+            while self.completed < len(new_bookings):
+                self._drain(block=True)
+                # The workers post a result for every item, but if one dies, its items will never complete
+                if not all(thread.is_alive() for thread in visitor_threads + prereg_threads):
+                    self.logger.error(f'A pipeline worker stopped unexpectedly; {len(new_bookings) - self.completed} bookings were not processed.')
+                    break
+        finally:
+            # Stop the visitor stage first, since it feeds the prereg stage
+            self._stop_workers(self.visitor_queue, visitor_threads)
+            self._stop_workers(self.prereg_queue, prereg_threads)
+            self._drain(block=False)
+            self._save()
+
+    def _start_workers(self, target):
+        '''Starts the worker threads for a stage.'''
+        threads = [threading.Thread(target=target, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _stop_workers(self, queue: Queue, threads: List[threading.Thread]):
+        '''Signals the worker threads for a stage to stop once the queue is empty, and waits for them to finish.'''
+        # A thread that has died can't take its signal (and would leave the queue full)
+        for _ in [thread for thread in threads if thread.is_alive()]:
+            queue.put(STOP)
+        for thread in threads:
+            thread.join()
+
+    def _feed(self, new_bookings: List[Dict], users: Dict[str, str], new_users: Dict[str, Dict]):
+        '''Sends each booking to the appropriate stage. Bookings for users who are neither registered nor in need of registration (e.g., invalid users) are dropped.'''
+        bookings_by_user = {}
+        # Users whose visitor record is waiting to be created in the outbox
+        pending_visitors = self.app.outbox.pending_visitors({b['primary_id'] for b in new_bookings 
+                                                                if b['primary_id'] not in users and b['primary_id'] not in new_users})
+        self._write_ahead([(booking, users[booking['primary_id']]) for booking in new_bookings if booking['primary_id'] in users])
+        for booking in new_bookings:
+            primary_id = booking['primary_id']
+            if primary_id in users:
+                self._put(self.prereg_queue, (booking, users[primary_id]))
+            elif primary_id in new_users:
+                bookings_by_user.setdefault(primary_id, []).append(booking)
+            elif primary_id in pending_visitors:
+                self._queue_preregs([booking], None)
+            else:
+                self.completed += 1
+        for batch in chunked(new_users.keys(), self.alma_batch_size):
+            visitors = self.app.fetch_profiles({pid: new_users[pid] for pid in batch})
+            for visitor in visitors:
+                self._put(self.visitor_queue, (visitor, bookings_by_user.pop(visitor['primary_id'])))
+            # Users that could not be resolved
+            for primary_id in batch:
+                self.completed += len(bookings_by_user.pop(primary_id, []))
+            self._drain(block=False)
+
+    def _put(self, queue: Queue, item):
+        '''Puts an item on a bounded queue, processing results while waiting for space.'''
+        while True:
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                self._drain(block=False)
+
+    def _drain(self, block: bool):
+        '''Processes the results returned by the worker threads. If block is true, waits for at least one result.'''
+        try:
+            result = self.results.get(timeout=0.1) if block else self.results.get_nowait()
+        except Empty:
+            return
+        while True:
+            kind, data = result
+            if kind == 'user':
+                self.new_records['users'].append(data)
+            elif kind == 'appt':
+                self.new_records['appts'].append(data)
+                self.completed += 1
+            elif kind == 'visitor_failed':
+                visitor, bookings = data
+                self.app.queue_failed_visitors([visitor])
+                self._queue_preregs(bookings, None)
+            elif kind == 'prereg_failed':
+                booking, visitor_id, error = data
+                try:
+                    self.app.outbox.fail_preregs([(self._outbox_entry(booking, visitor_id), error)])
+                except Exception as e:
+                    self.logger.exception(f'Error saving pre-registrations to the outbox -- {e}')
+                self.completed += 1
+            try:
+                result = self.results.get_nowait()
+            except Empty:
+                break
+        self._save()
+
+    def _outbox_entry(self, booking: Dict, visitor_id: str):
+        '''Returns the pre-registration for a booking, as accepted by Outbox.add_preregs.'''
+        return {'pre_reg': self.app.make_prereg(booking),
+                'primary_id': booking['primary_id'],
+                'visitor_id': visitor_id}
+
+    def _queue_preregs(self, bookings: List[Dict], visitor_id: str):
+        '''Adds pre-registrations to the outbox, to be retried later. The bookings are then complete, as far as this cycle is concerned.'''
+        try:
+            self.app.outbox.add_preregs([self._outbox_entry(booking, visitor_id) for booking in bookings])
+        except Exception as e:
+            self.logger.exception(f'Error saving pre-registrations to the outbox -- {e}')
+        self.completed += len(bookings)
+
+    def _write_ahead(self, preregs: List[Tuple[Dict, str]]):
+        '''Adds pre-registrations, given as (booking, visitor_id) tuples, to the outbox as claimed, before they are attempted. (If this fails, they are attempted anyway.)'''
+        if not preregs:
+            return
+        try:
+            self.app.outbox.add_preregs([self._outbox_entry(booking, visitor_id) for booking, visitor_id in preregs], claimed=True)
+        except Exception as e:
+            self.logger.exception(f'Error saving pre-registrations to the outbox -- {e}')
+
+    def _save(self):
+        '''Writes new users and pre-registrations to the cache, removing the pre-registrations from the outbox.'''
+        try:
+            with self.app.cache.transaction():
+                if self.new_records['users']:
+                    self.app.cache.add_users(self.new_records['users'])
+                if self.new_records['appts']:
+                    self.app.outbox.complete_preregs(self.new_records['appts'])
+        except Exception as e:
+            self.logger.exception(f'Error saving new users and pre-registrations -- {e}')
+        self.new_records = {'users': [], 'appts': []}
+
+    def _visitor_worker(self):
+        '''Creates visitors in PassagePoint, then queues their bookings for pre-registration.'''
+        while True:
+            item = self.visitor_queue.get()
+            if item is STOP:
+                # Writing ahead opens a connection to the cache in this thread
+                self.app.cache.close_connection()
+                return
+            visitor, bookings = item
+            visitor_id = None
+            try:
+                visitor_id = self.app.pp.create_visitor(visitor)
+                self.results.put(('user', self.app.make_user_record(visitor, visitor_id)))
+            except Exception as e:
+                if visitor_id is None:
+                    self.logger.error(f'Error creating PassagePoint visitor record for user {visitor["primary_id"]} -- {e}')
+                else:
+                    self.logger.exception(f'Error saving visitor {visitor_id} for user {visitor["primary_id"]} -- {e}')
+            finally:
+                # Every booking goes on to the prereg stage or to the outbox, so that the calling thread isn't left waiting for it
+                if visitor_id is None:
+                    self.results.put(('visitor_failed', (visitor, bookings)))
+                else:
+                    self._write_ahead([(booking, visitor_id) for booking in bookings])
+                    for booking in bookings:
+                        self.prereg_queue.put((booking, visitor_id))
+
+    def _prereg_worker(self):
+        '''Creates pre-registrations in PassagePoint.'''
+        while True:
+            item = self.prereg_queue.get()
+            if item is STOP:
+                return
+            booking, visitor_id = item
+            try:
+                pre_reg = self.app.make_prereg(booking)
+                prereg_id = self.app.pp.create_prereg(pre_reg, visitor_id)
+                self.results.put(('appt', self.app.make_appt_record(pre_reg, prereg_id)))
+            except Exception as e:
+                # Errors are logged by PassagePointRequests
+                self.results.put(('prereg_failed', (booking, visitor_id, e)))
@@ -0,0 +1,91 @@
+import time
+from datetime import datetime, timedelta
+import logging
+
+class AdaptivePoller():
+
+    def __init__(self, app):
+        '''Chooses the interval before the next poll of LibCal, in place of the fixed LCPP.interval.
+        app should be an instance of LibCal2PP, whose config and cache are used.
+
+        The interval is:
+        - max_interval while all locations are closed, shortened so as to poll when the first location opens;
+        - min_interval when a registered appointment starts within lead_time seconds (since bookings made just before they start need to be registered quickly);
+        - otherwise, the time in which target_arrivals new bookings are expected, based on a moving average of the rate of new bookings per second, but no longer than LCPP.interval (the fixed interval), so that bookings are not picked up later than they would be by the fixed schedule.
+        The result is always between min_interval and max_interval.'''
+        self.logger = logging.getLogger('lcpp.polling')
+        self.app = app
+        config = app.config['LCPP']
+        self.min_interval = config.get('min_interval', 60)
+        self.max_interval = config.get('max_interval', 1800)
+        # Longest interval while a location is open
+        self.open_interval = config['interval']
+        self.lead_time = config.get('lead_time', 900)
+        self.target_arrivals = config.get('target_arrivals', 1)
+        # Weight of the latest observation in the moving average of the arrival rate
+        self.smoothing = config.get('arrival_smoothing', 0.3)
+        # Opening hours per location, as (open, close) times of day; locations without hours are treated as always open
+        self.hours = {location['id']: self.parse_hours(location['hours'])
+                      for location in app.config['LibCal']['locations'] if location.get('hours')}
+        self.always_open = any(not location.get('hours') for location in app.config['LibCal']['locations'])
+        self.arrival_rate = 0
+        self.last_poll = None
+
+    @staticmethod
+    def parse_hours(hours: str):
+        '''Converts opening hours of the form "08:00-22:00" to a tuple of (hour, minute) tuples. A closing time before the opening time is taken to be after midnight.'''
+        return tuple(tuple(int(part) for part in t.strip().split(':')) for t in hours.split('-'))
+
+    def observe(self, new_bookings: int, now: float = None):
+        '''Records the number of new bookings found by a poll, updating the moving average of the arrival rate.'''
+        now = now or time.time()
+        if self.last_poll is not None and now > self.last_poll:
+            rate = new_bookings / (now - self.last_poll)
+            self.arrival_rate = self.smoothing * rate + (1 - self.smoothing) * self.arrival_rate
+        self.last_poll = now
+
+    def next_interval(self, now: float = None):
+        '''Returns the number of seconds to wait before the next poll.'''
+        now = now or time.time()
+        if not self.is_open(now):
+            interval = self.max_interval
+            opening = self.next_opening(now)
+            if opening is not None:
+                interval = min(interval, opening - now)
+        else:
+            interval = self.open_interval
+            if self.arrival_rate > 0:
+                interval = min(interval, self.target_arrivals / self.arrival_rate)
+            next_start = self.app.cache.next_appt_start(now)
+            if (next_start is not None) and (next_start - now <= self.lead_time):
+                interval = self.min_interval
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        self.logger.debug(f'Next poll in {interval:.0f} seconds (arrival rate {self.arrival_rate * 3600:.1f}/hour).')
+        return interval
+
+    def _windows(self, now: float):
+        '''Yields the opening and closing times (as datetimes) of each location, from the day before now through the day after.'''
+        today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        for (open_h, open_m), (close_h, close_m) in self.hours.values():
+            for offset in (-1, 0, 1):
+                day = today + timedelta(days=offset)
+                opens = day.replace(hour=open_h, minute=open_m)
+                closes = day.replace(hour=close_h, minute=close_m)
+                if closes <= opens:
+                    closes += timedelta(days=1)
+                yield opens, closes
+
+    def is_open(self, now: float):
+        '''True if any location is open at now (a UNIX timestamp).'''
+        if self.always_open or not self.hours:
+            return True
+        current = datetime.fromtimestamp(now)
+        return any(opens <= current < closes for opens, closes in self._windows(now))
+
+    def next_opening(self, now: float):
+        '''Returns the next time (a UNIX timestamp) at which a location opens, or None if no opening hours are configured.'''
+        current = datetime.fromtimestamp(now)
+        openings = [opens for opens, _ in self._windows(now) if opens > current]
+        if not openings:
+            return None
+        return min(openings).timestamp()
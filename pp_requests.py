@@ -1,7 +1,11 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from utils import check_config, load_config
-from typing import Dict
+from token_manager import TokenManager
+from metrics import InstrumentedAdapter, STAGE_DURATION
+from tracing import traced
+from typing import Callable, Dict, List, Tuple
 import logging
 from requests.exceptions import HTTPError
 
@@ -20,31 +24,59 @@ class PassagePointRequests():
                                  'get_destinations_endpt', 'user_mapping',
                                  'location_mapping'],
                     obj=self)
-        self.make_header()
+        # Maximum number of concurrent requests for batch operations
+        self.max_workers = config['PassagePoint'].get('max_workers', 8)
+        # Optional endpoints for updating and deleting pre-registrations, used to reconcile bookings changed or cancelled in LibCal
+        self.update_prereg_endpt = config['PassagePoint'].get('update_prereg_endpt')
+        self.delete_prereg_endpt = config['PassagePoint'].get('delete_prereg_endpt')
+        # Optional endpoint for finding a visitor's pre-registrations, used to check whether a pre-registration whose outcome is unknown was created before retrying it
+        self.find_prereg_endpt = config['PassagePoint'].get('find_prereg_endpt')
+        # Persistent session: keeps a pool of keep-alive connections, so that each call doesn't pay for a new TLS handshake.
+        self.session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            self.session.mount(prefix, InstrumentedAdapter('passagepoint', pool_connections=1, pool_maxsize=self.max_workers))
+        # Refreshes the token ahead of its expiry, if token_lifetime (in seconds) is configured; otherwise, the token is refreshed after a 401
+        self.tokens = TokenManager(self._request_token, 
+                                   lifetime=config['PassagePoint'].get('token_lifetime'),
+                                   name='PassagePoint')
+        self.fetch_token()
 
     def fetch_token(self):
         '''Retrieves a new authentication token, using supplied credentials.'''
+        self.tokens.refresh(stale=self.tokens.token)
+        return self
+
+    def _request_token(self):
+        '''Requests a new authentication token from the API. Returns the token and its lifetime (None, since PassagePoint does not report it).'''
         try:
             cred_body = {'username': self.username,
                          'password': self.password}
-            resp = requests.post(self.pp_api_root + self.login_endpt, json=cred_body)
+            resp = self.session.post(self.pp_api_root + self.login_endpt, json=cred_body)
             resp.raise_for_status()
             token = resp.json()
-            # TO DO: Check for expired token and create new if necessary
             # Check for errors in the JSON
             if 'error' in token:
                 raise Exception(f'Error returned by PassagePoint authentication API: {token}')
-            # Store the access token string
-            self.token = token['token']
-            return self
+            # Return the access token string
+            return token['token'], None
         except Exception as e:
             self.logger.exception(f'Error fetching PassagePoint authentication token -- {e}')
             raise
 
-    def make_header(self):
+    def make_header(self, token: str):
         '''Create the HTTP headers, using the PP token.'''
-        self.fetch_token()
-        self.req_header = {'token': self.token, 'Content-Type': 'application/json'}
+        return {'token': token, 'Content-Type': 'application/json'}
+
+    def _request(self, method: str, endpt: str, **kwargs):
+        '''Sends a request to the given PassagePoint endpoint with the current token. If the token has expired (401), a new token is fetched and the request is replayed once.
+        Additional keyword arguments are passed to requests.'''
+        token = self.tokens.get()
+        resp = self.session.request(method, self.pp_api_root + endpt, headers=self.make_header(token), **kwargs)
+        if resp.status_code == 401:
+            self.logger.debug('Token expired. Getting new PassagePoint token.')
+            token = self.tokens.refresh(stale=token)
+            resp = self.session.request(method, self.pp_api_root + endpt, headers=self.make_header(token), **kwargs)
+        return resp
 
     def _extract_id(self, api_data: Dict):
         '''Extracts the visitor ID(s) from the data returned from the createVisitor call.
@@ -56,23 +88,15 @@ class PassagePointRequests():
         return id_num
 
 
-    def retry(self, func, *args, **kwargs):
-        '''Helper function to refresh the token before re-trying the given function.'''
-        self.make_header()
-        return func(*args, **kwargs)
-
-
-    def error_handler(self, resp, error, func, *args, **kwargs):
-        '''Error handler for HTTP errors. Func should be the function to retry, in case of a 401 error, followed by its arguments and keyword arguments. '''
-        if resp.status_code == 401: # Retry if 401
-            self.logger.debug('Token expired. Getting new PassagePoint token.')
-            self.retry(func, *args, **kwargs)
-        else: # Otherwise, log the response and propagate the error
-            self.logger.error(f'Error in calling PassagePoint API: {resp.reason}')
-            self.logger.error(f'Error response: {resp.text}')
-            raise error
+    def error_handler(self, resp, error):
+        '''Error handler for HTTP errors: logs the response and propagates the error. (Expired tokens are handled by _request.)'''
+        self.logger.error(f'Error in calling PassagePoint API: {resp.reason}')
+        self.logger.error(f'Error response: {resp.text}')
+        raise error
 
 
+    @STAGE_DURATION.time(stage='pp_visitor')
+    @traced('pp.create_visitor', lambda self, visitor: {'primary_id': visitor['primary_id']})
     def create_visitor(self, visitor: dict):
         '''Sends a POST request to create a new visitor using a uniqueId'''
         # visitor['user_group'] should correspond to an Alma user group. Default is "Visitor"
@@ -83,8 +107,7 @@ class PassagePointRequests():
                   'mobilePhoneNo': visitor['primary_id'],
                   'uniqueId': str(visitor['barcode'])}
         try:
-            resp = requests.post(self.pp_api_root + self.create_visitor_endpt,
-                                 headers=self.req_header,
+            resp = self._request('post', self.create_visitor_endpt,
                                  params=params)
             resp.raise_for_status()
             visitor_data = resp.json()
@@ -97,7 +120,7 @@ class PassagePointRequests():
                 self.logger.debug(f'Visitor {visitor["barcode"]} already exists in PassagePoint; getting Visitor ID.')
                 return self.get_visitor_bybarcode(visitor['barcode'])
             else:
-                self.error_handler(resp, e, self.create_visitor, visitor)
+                self.error_handler(resp, e)
         except Exception as e:
             self.logger.exception(f'Error creating visitor in PassagePoint for barcode {visitor["barcode"]} -- {e}')
             raise
@@ -107,33 +130,28 @@ class PassagePointRequests():
         '''Retrieves the visitor ID from PassagePoint for a provided barcode in the visitor's unique ID field.'''
         try:
             params = {'uniqueId': str(barcode)}
-            resp = requests.get(self.pp_api_root + self.uniqueId_endpt,
-                                headers=self.req_header,
+            resp = self._request('get', self.uniqueId_endpt,
                                 params=params)
             resp.raise_for_status()
             visitor_data = resp.json()
             return self._extract_id(visitor_data)
         except HTTPError as e:
-                self.error_handler(resp, e, self.get_visitor_bybarcode, barcode)
+            self.error_handler(resp, e)
         except Exception as e:
             self.logger.exception(f'Error getting visitor from PassagePoint with barcode {barcode} -- {e}')
             raise
 
 
+    @STAGE_DURATION.time(stage='pp_prereg')
+    @traced('pp.create_prereg', lambda self, booking, visitor: {'appt_id': booking.get('appt_id'), 'visitor_id': visitor})
     def create_prereg(self, booking: dict, visitor: str):
         '''Creates a Pre-Registration with the visitor ID and LibCal data.
         Requires a booking dict with a visitorId, startTime and endTime
         '''
         try:
-            prereg = {}
-            format_str = '%Y-%m-%dT%H:%M:%S%z'
-            prereg["startTime"] = str(int(datetime.strptime(booking['startTime'], format_str).timestamp()))
-            prereg["endTime"] = str(int(datetime.strptime(booking['endTime'], format_str).timestamp()))
+            prereg = self._prereg_times(booking)
             prereg["visitorId"] = str(visitor)
-            # Map the LibCal location ID to its destination name in PassagePoint
-            prereg["destination"] = self.location_mapping.get(booking['destination'])  # needs to exist in PP
-            resp = requests.post(self.pp_api_root + self.create_prereg_endpt,
-                                 headers=self.req_header,
+            resp = self._request('post', self.create_prereg_endpt,
                                  json=prereg)
             resp.raise_for_status()
             prereg_data = resp.json()
@@ -141,17 +159,134 @@ class PassagePointRequests():
                 raise Exception(prereg_data)
             return self._extract_id(prereg_data)
         except HTTPError as e:
-            self.error_handler(resp, e, self.create_prereg, booking, visitor)
+            self.error_handler(resp, e)
         except Exception as e:
             self.logger.exception(f'Error creating pre-registration for booking {booking} -- {e}')
             raise
 
 
+    def _prereg_times(self, booking: dict):
+        '''Returns the start and end times and the destination of a pre-registration, from a booking dict with startTime, endTime (LibCal timestamps) and destination (LibCal location ID).'''
+        format_str = '%Y-%m-%dT%H:%M:%S%z'
+        return {"startTime": str(int(datetime.strptime(booking['startTime'], format_str).timestamp())),
+                "endTime": str(int(datetime.strptime(booking['endTime'], format_str).timestamp())),
+                # Map the LibCal location ID to its destination name in PassagePoint
+                "destination": self.location_mapping.get(booking['destination'])}  # needs to exist in PP
+
+    @traced('pp.find_prereg', lambda self, booking, visitor: {'appt_id': booking.get('appt_id'), 'visitor_id': visitor})
+    def find_prereg(self, booking: dict, visitor: str):
+        '''Returns the ID of the visitor's Pre-Registration with the times and destination of the booking (a dict as accepted by create_prereg), or None if there is none. Requires find_prereg_endpt in the config.'''
+        try:
+            params = self._prereg_times(booking)
+            params["visitorId"] = str(visitor)
+            resp = self._request('get', self.find_prereg_endpt,
+                                 params=params)
+            resp.raise_for_status()
+            prereg_data = resp.json()
+            if 'error' in prereg_data:
+                raise Exception(prereg_data)
+            if not (prereg_data['data'] if isinstance(prereg_data, dict) else prereg_data):
+                return None
+            return self._extract_id(prereg_data)
+        except HTTPError as e:
+            self.error_handler(resp, e)
+        except Exception as e:
+            self.logger.exception(f'Error finding pre-registration for booking {booking} -- {e}')
+            raise
+
+    @STAGE_DURATION.time(stage='pp_update')
+    @traced('pp.update_prereg', lambda self, prereg_id, booking: {'prereg_id': prereg_id, 'appt_id': booking.get('appt_id')})
+    def update_prereg(self, prereg_id: str, booking: dict):
+        '''Changes the times and destination of an existing Pre-Registration to those of the booking (a dict as accepted by create_prereg). Requires update_prereg_endpt in the config.'''
+        try:
+            prereg = self._prereg_times(booking)
+            prereg["id"] = str(prereg_id)
+            resp = self._request('post', self.update_prereg_endpt,
+                                 json=prereg)
+            resp.raise_for_status()
+            prereg_data = resp.json()
+            if 'error' in prereg_data:
+                raise Exception(prereg_data)
+            return prereg_id
+        except HTTPError as e:
+            self.error_handler(resp, e)
+        except Exception as e:
+            self.logger.exception(f'Error updating pre-registration {prereg_id} -- {e}')
+            raise
+
+    @STAGE_DURATION.time(stage='pp_cancel')
+    @traced('pp.delete_prereg', lambda self, prereg_id: {'prereg_id': prereg_id})
+    def delete_prereg(self, prereg_id: str):
+        '''Deletes a Pre-Registration (e.g., for a booking cancelled in LibCal). Requires delete_prereg_endpt in the config.'''
+        try:
+            resp = self._request('post', self.delete_prereg_endpt,
+                                 json={"id": str(prereg_id)})
+            resp.raise_for_status()
+            prereg_data = resp.json()
+            if 'error' in prereg_data:
+                raise Exception(prereg_data)
+            return prereg_id
+        except HTTPError as e:
+            self.error_handler(resp, e)
+        except Exception as e:
+            self.logger.exception(f'Error deleting pre-registration {prereg_id} -- {e}')
+            raise
+
+    def run_batch(self, func: Callable, items: List[Tuple], on_result: Callable = None):
+        '''Calls func once for each tuple of arguments in items, with at most max_workers calls in flight.
+        Returns a list of (args, result, error) tuples, in the same order as items. On failure, result is None and error is the exception raised; on success, error is None.
+        If on_result is provided, it is called (in the calling thread) with the args, result, and error of each call as soon as the call returns, e.g., to save each result without waiting for the rest of the batch.'''
+        def call(args):
+            try:
+                return args, func(*args), None
+            except Exception as e:
+                return args, None, e
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(call, args) for args in items]
+            if on_result:
+                for future in as_completed(futures):
+                    on_result(*future.result())
+            return [future.result() for future in futures]
+
+    @staticmethod
+    def _single_args(on_result: Callable):
+        '''Adapts an on_result callback for a batch of single-argument calls, so that it gets the argument itself rather than a tuple.'''
+        if on_result:
+            return lambda args, result, error: on_result(args[0], result, error)
+
+    def create_visitors(self, visitors: List[dict], on_result: Callable = None):
+        '''Creates a batch of visitors concurrently. Each visitor should be a dict as accepted by create_visitor.
+        Returns a list of (visitor, visitor_id, error) tuples; on_result, if provided, is called with each as it completes (see run_batch).'''
+        return [(args[0], result, error) for args, result, error in self.run_batch(self.create_visitor, [(v,) for v in visitors], self._single_args(on_result))]
+
+    def create_preregs(self, preregs: List[Tuple[dict, str]], on_result: Callable = None):
+        '''Creates a batch of pre-registrations concurrently. preregs should be a list of (booking, visitor_id) tuples, as accepted by create_prereg.
+        Returns a list of ((booking, visitor_id), prereg_id, error) tuples; on_result, if provided, is called with each as it completes (see run_batch).'''
+        return self.run_batch(self.create_prereg, preregs, on_result)
+
+    def find_preregs(self, preregs: List[Tuple[dict, str]]):
+        '''Looks up a batch of pre-registrations concurrently. preregs should be a list of (booking, visitor_id) tuples, as accepted by find_prereg.
+        Returns a list of ((booking, visitor_id), prereg_id, error) tuples, where prereg_id is None if there is no such pre-registration.'''
+        return self.run_batch(self.find_prereg, preregs)
+
+    def update_preregs(self, updates: List[Tuple[str, dict]], on_result: Callable = None):
+        '''Updates a batch of pre-registrations concurrently. updates should be a list of (prereg_id, booking) tuples, as accepted by update_prereg.
+        Returns a list of ((prereg_id, booking), prereg_id, error) tuples; on_result, if provided, is called with each as it completes (see run_batch).'''
+        return self.run_batch(self.update_prereg, updates, on_result)
+
+    def delete_preregs(self, prereg_ids: List[str], on_result: Callable = None):
+        '''Deletes a batch of pre-registrations concurrently. Returns a list of (prereg_id, prereg_id, error) tuples; on_result, if provided, is called with each as it completes (see run_batch).'''
+        return [(args[0], result, error) for args, result, error in self.run_batch(self.delete_prereg, [(i,) for i in prereg_ids], self._single_args(on_result))]
+
+    def close(self):
+        '''Stops the background token refresh and closes the pooled connections.'''
+        self.tokens.close()
+        self.session.close()
+
     def get_destinations(self):
         '''Retrieves the destinations from PassagePoint and returns as dict'''
         try:
-            resp = requests.get(self.pp_api_root + self.get_destinations_endpt,
-                                headers=self.req_header)
+            resp = self._request('get', self.get_destinations_endpt)
             resp.raise_for_status()
             destinations = resp.json()
             return destinations
@@ -163,8 +298,7 @@ class PassagePointRequests():
 if __name__ == '__main__':
     config = load_config('config.yml')
     passagept = PassagePointRequests(config)
-    print(passagept.token)
-    print(passagept.req_header)
+    print(passagept.tokens.get())
  #   visitor_data = passagept.create_visitor({'firstName': 'Test',
  #                                            'lastName': 'Patron',
  #                                            'barcode': '012301230123012301'})
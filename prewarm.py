@@ -0,0 +1,193 @@
+import argparse
+import csv
+import gzip
+import logging
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, IO, Iterable
+from alma_requests import AlmaRequests, extract_user
+from sqlite_cache import SQLiteCache
+from utils import chunked, iter_json, load_config
+
+# Run from the command line to load users into the SQL cache from bulk exports, so that a new deployment (or one whose cache has been lost) doesn't have to look up every returning user in Alma and PassagePoint, e.g.:
+#   python prewarm.py --alma users.xml.gz --iz 0 --pp visitors.csv
+# The Alma export may be CSV, JSON (an array of user objects, one per line, or Users API responses with the users under the "user" key), or XML (as produced by Alma's user export); the PassagePoint visitor export may be CSV or JSON. Files ending in .gz are decompressed as they are read.
+# Exports are streamed and written to the cache in batches, so memory use does not depend on the size of the files.
+
+# Default CSV columns for each field
+ALMA_CSV_COLUMNS = {'primary_id': 'primary_id', 'barcode': 'barcode', 'user_group': 'user_group'}
+PP_CSV_COLUMNS = {'visitor_id': 'id', 'barcode': 'uniqueId'}
+
+def export_format(path: str):
+    '''Returns the format of an export (csv, json, or xml), given its file name.'''
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    for fmt, extensions in {'csv': ('.csv',), 'json': ('.json', '.jsonl', '.ndjson'), 'xml': ('.xml',)}.items():
+        if name.endswith(extensions):
+            return fmt
+    raise ValueError(f'Unrecognized export format for {path}; use --alma-format or --pp-format.')
+
+def open_export(path: str, binary: bool = False):
+    '''Opens an export for reading, decompressing it if it is gzipped.'''
+    opener = gzip.open if path.lower().endswith('.gz') else open
+    if binary:
+        return opener(path, 'rb')
+    return opener(path, 'rt', encoding='utf-8-sig', newline='')
+
+def _local_name(tag: str):
+    '''Strips the namespace, if any, from an XML tag.'''
+    return tag.rsplit('}', 1)[-1]
+
+def _xml_user(elem):
+    '''Converts a user element from an Alma XML export to the format of the Alma Users API (as far as needed by extract_user).'''
+    user = {'user_identifier': []}
+    for child in elem:
+        name = _local_name(child.tag)
+        if name == 'primary_id':
+            user['primary_id'] = (child.text or '').strip()
+        elif name == 'user_group':
+            user['user_group'] = {'value': child.text, 'desc': child.get('desc')}
+        elif name == 'user_identifiers':
+            for ident in child:
+                fields = {_local_name(field.tag): field.text for field in ident}
+                user['user_identifier'].append({'id_type': {'value': fields.get('id_type')},
+                                                'value': fields.get('value')})
+    return user
+
+def read_alma_xml(f: IO):
+    '''Yields the users in an Alma XML export (a file opened in binary mode).'''
+    root = None
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and _local_name(elem.tag) == 'user':
+            yield _xml_user(elem)
+            # Discard the parsed users
+            root.clear()
+
+def read_alma_json(f: IO):
+    '''Yields the users in a JSON export: an array of user objects, one user per line, or Users API responses (with the users under the "user" key).
+    Raises ValueError on a value that is not a user.'''
+    for value in iter_json(f):
+        users = value['user'] if isinstance(value, dict) and 'user' in value else [value]
+        # A response for a single user has the user object itself under "user"
+        if isinstance(users, dict):
+            users = [users]
+        for user in users:
+            if not (isinstance(user, dict) and 'primary_id' in user):
+                raise ValueError(f'Not a user record in the Alma export: {str(user)[:100]}')
+            yield user
+
+def read_alma_csv(f: IO, columns: Dict[str, str] = None):
+    '''Yields the users in a CSV export, in the format of the Alma Users API. columns maps primary_id, barcode, and user_group to the names of the corresponding columns.'''
+    columns = {**ALMA_CSV_COLUMNS, **(columns or {})}
+    for row in csv.DictReader(f):
+        barcode = row.get(columns['barcode'])
+        user_group = row.get(columns['user_group'])
+        yield {'primary_id': row[columns['primary_id']],
+               'user_group': {'desc': user_group} if user_group else None,
+               'user_identifier': [{'id_type': {'value': 'BARCODE'}, 'value': barcode}] if barcode else []}
+
+def read_alma_export(path: str, fmt: str = None, columns: Dict[str, str] = None):
+    '''Yields the users in an Alma export, in the format of the Alma Users API.'''
+    fmt = fmt or export_format(path)
+    with open_export(path, binary=(fmt == 'xml')) as f:
+        if fmt == 'xml':
+            yield from read_alma_xml(f)
+        elif fmt == 'csv':
+            yield from read_alma_csv(f, columns)
+        else:
+            yield from read_alma_json(f)
+
+def read_pp_export(path: str, fmt: str = None, columns: Dict[str, str] = None):
+    '''Yields a dictionary with the barcode and visitor ID of each visitor in a PassagePoint export. columns maps visitor_id and barcode to the names of the corresponding columns (or keys, for JSON).
+    A JSON export may be an array of visitors, one visitor per line, or API responses with the visitors under the "data" key.'''
+    columns = {**PP_CSV_COLUMNS, **(columns or {})}
+    fmt = fmt or export_format(path)
+    with open_export(path) as f:
+        if fmt == 'csv':
+            visitors = csv.DictReader(f)
+        else:
+            visitors = (visitor for value in iter_json(f)
+                                for visitor in (value['data'] if isinstance(value, dict) and 'data' in value else [value]))
+        for visitor in visitors:
+            barcode, visitor_id = visitor.get(columns['barcode']), visitor.get(columns['visitor_id'])
+            if barcode and visitor_id:
+                yield {'barcode': str(barcode), 'visitor_id': str(visitor_id)}
+
+class Prewarmer():
+
+    def __init__(self, cache: SQLiteCache, batch_size: int = 10000):
+        '''Loads users from bulk exports into the users table of the cache. Each batch of batch_size users is written in a single transaction.'''
+        self.logger = logging.getLogger('lcpp.prewarm')
+        self.cache = cache
+        self.batch_size = batch_size
+
+    def load_profiles(self, users: Iterable[Dict], iz: str = None, fetched_at: float = None):
+        '''Saves the barcode and user group of each user (objects in the format of the Alma Users API), extracted as for users fetched from the API.
+        iz, if provided, is the identifier of the IZ from which the users were exported (see AlmaRequests.iz_id), which is also recorded as their IZ affinity. fetched_at is the time (UNIX timestamp) recorded as that of the Alma data (by default, now); profiles older than profile_max_age are refreshed from Alma by the app.
+        Users without a barcode are skipped. Returns the number of users saved and skipped.'''
+        fetched_at = fetched_at or time.time()
+        saved = skipped = 0
+        for batch in chunked(users, self.batch_size):
+            profiles = []
+            for user in batch:
+                primary_id, info = extract_user(user, iz)
+                if not primary_id or not info.get('barcode'):
+                    skipped += 1
+                    continue
+                profiles.append({'primary_id': primary_id, 'fetched_at': fetched_at, **info})
+            with self.cache.transaction():
+                self.cache.merge_profiles(profiles)
+                if iz:
+                    self.cache.add_iz_affinity([{'primary_id': p['primary_id'], 'iz': iz} for p in profiles])
+            saved += len(profiles)
+            self.logger.info(f'Saved {saved} users from Alma ({skipped} skipped).')
+        return saved, skipped
+
+    def load_visitors(self, visitors: Iterable[Dict[str, str]]):
+        '''Saves the PassagePoint visitor ID of each visitor (dictionaries with barcode and visitor_id) for the user with the same barcode. Users must already be in the cache, e.g., from load_profiles.
+        Returns the number of visitors read and of users updated.'''
+        read = updated = 0
+        for batch in chunked(visitors, self.batch_size):
+            updated += self.cache.set_visitor_ids(batch)
+            read += len(batch)
+            self.logger.info(f'Read {read} visitors from PassagePoint; updated {updated} users.')
+        return read, updated
+
+def parse_columns(pairs: Iterable[str]):
+    '''Parses FIELD=COLUMN arguments into a dictionary.'''
+    return dict(pair.split('=', 1) for pair in pairs or [])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load users into the SQL cache from an Alma user export and/or a PassagePoint visitor export.')
+    parser.add_argument('--alma', metavar='PATH', help='Alma user export (CSV, JSON, or XML; optionally gzipped)')
+    parser.add_argument('--alma-format', choices=['csv', 'json', 'xml'], help='Format of the Alma export (by default, from the file extension)')
+    parser.add_argument('--alma-columns', nargs='+', metavar='FIELD=COLUMN', help='CSV columns for primary_id, barcode, and user_group, if not so named')
+    parser.add_argument('--iz', type=int, metavar='N', help='Position (from 0) in the Alma apikeys setting of the key for the IZ the users were exported from')
+    parser.add_argument('--pp', metavar='PATH', help='PassagePoint visitor export (CSV or JSON; optionally gzipped)')
+    parser.add_argument('--pp-format', choices=['csv', 'json'], help='Format of the PassagePoint export (by default, from the file extension)')
+    parser.add_argument('--pp-columns', nargs='+', metavar='FIELD=COLUMN', help='Columns (or JSON keys) for visitor_id and barcode, if not id and uniqueId')
+    parser.add_argument('--config', default='./config.yml', help='Path to the app\'s config (used with --iz)')
+    parser.add_argument('--db', default='cache.db', help='Path to the SQL cache')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Users written per transaction')
+    parser.add_argument('--debug', action='store_const', dest='log_level', const=logging.DEBUG, default=logging.INFO)
+    args = parser.parse_args()
+    if not (args.alma or args.pp):
+        parser.error('At least one of --alma and --pp is required.')
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+    iz = None
+    if args.iz is not None:
+        iz = AlmaRequests.iz_id(load_config(args.config)['Alma']['apikeys'][args.iz])
+    cache = SQLiteCache(args.db)
+    prewarmer = Prewarmer(cache, batch_size=args.batch_size)
+    try:
+        if args.alma:
+            saved, skipped = prewarmer.load_profiles(read_alma_export(args.alma, args.alma_format, parse_columns(args.alma_columns)), iz=iz)
+            print(f'Alma: {saved} users saved, {skipped} skipped (no barcode).')
+        if args.pp:
+            read, updated = prewarmer.load_visitors(read_pp_export(args.pp, args.pp_format, parse_columns(args.pp_columns)))
+            print(f'PassagePoint: {read} visitors read, {updated} users updated.')
+    finally:
+        cache.close()
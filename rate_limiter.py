@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Dict
+import logging
+
+class QuotaExceeded(Exception):
+    '''Raised when the daily API quota for an IZ is exhausted (or down to the reserve).'''
+    pass
+
+class SlidingWindow():
+
+    def __init__(self, rate: float, period: float = 1.0):
+        '''Allows at most rate acquisitions in any period (in seconds).'''
+        self.rate = rate
+        self.period = period
+        self._task_logs = deque()
+
+    @property
+    def limit(self):
+        '''The number of acquisitions allowed in the window: at least one, even when the rate is below one per period.'''
+        return max(1, int(self.rate))
+
+    @property
+    def span(self):
+        '''The length of the window, in seconds: the period, or longer when the rate is below one per period, so that acquisitions are spaced period / rate seconds apart.'''
+        return self.period if self.rate >= 1 else self.period / self.rate
+
+    def flush(self):
+        '''Forgets acquisitions older than the window.'''
+        now = time.monotonic()
+        span = self.span
+        while self._task_logs and (now - self._task_logs[0] > span):
+            self._task_logs.popleft()
+
+    async def acquire(self, retry_interval: float = 0.01):
+        '''Waits until an acquisition is allowed.'''
+        while True:
+            self.flush()
+            if len(self._task_logs) < self.limit:
+                break
+            await asyncio.sleep(retry_interval)
+        self._task_logs.append(time.monotonic())
+
+class QuotaBudget():
+
+    def __init__(self, reserve: int = 0, max_rate: float = None):
+        '''Tracks the API quota shared by all of the AdaptiveThrottlers for Alma.
+        reserve is the number of daily API calls per IZ to leave unused (for other applications sharing the quota).
+        max_rate, if provided, limits the requests per second across all IZ's combined.'''
+        self.logger = logging.getLogger('lcpp.rate_limiter')
+        self.reserve = reserve
+        self.window = SlidingWindow(max_rate) if max_rate else None
+        # Remaining daily API calls per IZ, as last reported by Alma
+        self.remaining = {}
+        # Time until which an IZ's quota is considered exhausted (after a daily threshold error)
+        self.exhausted_until = {}
+        self.requests = 0
+        self.throttled = 0
+
+    async def acquire(self):
+        '''Waits for the combined rate limit, if any.'''
+        self.requests += 1
+        if self.window:
+            await self.window.acquire()
+
+    def update(self, iz: str, headers: Dict):
+        '''Records the remaining quota reported in the headers of an Alma response.'''
+        remaining = headers.get('X-Exl-Api-Remaining')
+        if remaining is not None:
+            self.remaining[iz] = int(remaining)
+
+    def check(self, iz: str):
+        '''Raises QuotaExceeded if the IZ has no quota to spare.'''
+        if time.time() < self.exhausted_until.get(iz, 0):
+            raise QuotaExceeded(f'Daily API quota exhausted for IZ {iz}')
+        if self.remaining.get(iz, self.reserve + 1) <= self.reserve:
+            raise QuotaExceeded(f'Daily API quota for IZ {iz} down to the reserve ({self.reserve})')
+
+    def has_headroom(self, iz: str):
+        '''True if the IZ has ample quota left (or its quota is not known).'''
+        remaining = self.remaining.get(iz)
+        return (remaining is None) or (remaining > 2 * self.reserve)
+
+    def mark_exhausted(self, iz: str, wait: float = 3600):
+        '''Records that Alma reported the daily quota as exhausted. Requests to the IZ are not attempted again for wait seconds.'''
+        self.logger.error(f'Daily API quota exhausted for IZ {iz}.')
+        self.exhausted_until[iz] = time.time() + wait
+
+    def usage(self):
+        '''Returns a summary of the quota and of the requests made so far.'''
+        return {'requests': self.requests,
+                'throttled': self.throttled,
+                'remaining': dict(self.remaining),
+                'exhausted': [iz for iz, until in self.exhausted_until.items() if time.time() < until]}
+
+class AdaptiveThrottler():
+
+    def __init__(self, rate: float, min_rate: float = 1, max_rate: float = 25, budget: QuotaBudget = None):
+        '''Async context manager (like asyncio_throttle.Throttler) for the rate limit of a single Alma API key.
+        The rate starts at rate requests per second. It is halved whenever Alma responds with a 429 (and requests pause for a randomized backoff), and increases by one request per second after each success while there is quota to spare, within [min_rate, max_rate].
+        budget, if provided, is shared with the throttlers for the other keys.'''
+        self.window = SlidingWindow(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.budget = budget
+        self.paused_until = 0
+        self.last_decrease = 0
+
+    @property
+    def rate(self):
+        return self.window.rate
+
+    async def acquire(self):
+        '''Waits until a request is allowed.'''
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        await self.window.acquire()
+        if self.budget:
+            await self.budget.acquire()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def on_success(self, headroom: bool = True):
+        '''Ramps the rate up (additively) if there is headroom.'''
+        if headroom:
+            self.window.rate = min(self.max_rate, self.window.rate + 1)
+
+    def on_throttled(self, retry_after: float = None):
+        '''Backs off after a 429: halves the rate, and pauses for retry_after seconds (if given by the API) or for a random period of up to one second.
+        The rate is halved at most once per period, since requests already in flight may return 429's for the same burst.'''
+        now = time.monotonic()
+        if now - self.last_decrease > self.window.period:
+            self.window.rate = max(self.min_rate, self.window.rate / 2)
+            self.last_decrease = now
+        pause = retry_after if retry_after else random.uniform(0.1, 1.0)
+        self.paused_until = max(self.paused_until, now + pause)
+        if self.budget:
+            self.budget.throttled += 1
@@ -0,0 +1,79 @@
+import time
+from datetime import date
+from typing import Dict, Iterable, List
+import logging
+
+class Reconciler():
+
+    def __init__(self, app):
+        '''Brings PassagePoint in line with bookings changed or cancelled in LibCal after they were registered.
+        On each cycle, the appointments in the cache for the locations whose bookings were fetched in full are compared with the current bookings, by their fingerprints (see LibCal2PP.booking_fingerprint): appointments whose booking has changed are queued for update, and those whose booking is gone, for deletion.
+        If PassagePoint has no update endpoint configured, a changed booking is registered again after its pre-registration is deleted; if it has no delete endpoint either, reconciliation is disabled.
+        app should be an instance of LibCal2PP, whose cache and outbox are used.'''
+        self.logger = logging.getLogger('lcpp.reconcile')
+        self.app = app
+        self.can_update = bool(app.pp.update_prereg_endpt)
+        self.can_delete = bool(app.pp.delete_prereg_endpt)
+        if not self.can_delete:
+            self.logger.warning('Reconciliation requires delete_prereg_endpt in the PassagePoint config; changed and cancelled bookings will not be reconciled.')
+
+    def reconcile(self, bookings: List, location_ids: Iterable[int]):
+        '''Queues the PassagePoint operations needed for the appointments at the given locations to match bookings.
+        bookings should be all of the current bookings at those locations (bookings at other locations may be included, e.g., if a booking has been moved). Appointments that have already ended, or have an update or deletion pending, are left alone.'''
+        location_ids = list(location_ids)
+        if not (self.can_delete and location_ids):
+            return
+        # Bookings whose times can't be read are skipped by the app, so their appointments are left as they are
+        unreadable = {booking['bookId'] for booking in bookings if self.app.booking_times(booking) is None}
+        current = {self.app.appt_key(booking): booking for booking in bookings if booking['bookId'] not in unreadable}
+        cached = self.app.cache.reconcile_lookup(date.today().isoformat(), location_ids, time.time())
+        pending = self.app.outbox.pending_changes((row['appt_id'], row['booking_date']) for row in cached)
+        changed = []
+        cancelled = []
+        backfill = []
+        for row in cached:
+            appt_key = (row['appt_id'], row['booking_date'])
+            if (appt_key in pending) or (row['appt_id'] in unreadable):
+                continue
+            booking = current.get(appt_key)
+            if booking is None:
+                cancelled.append(row)
+                continue
+            fingerprint = self.app.booking_fingerprint(booking)
+            if row['fingerprint'] == fingerprint:
+                continue
+            # Appointments registered before fingerprints were stored are compared on the fields they do have
+            if (row['fingerprint'] is None) and self.matches(row, booking):
+                backfill.append({'appt_id': row['appt_id'], 'booking_date': row['booking_date'], 'fingerprint': fingerprint})
+                continue
+            changed.append((row, booking))
+        if backfill:
+            self.app.cache.set_appt_fingerprints(backfill)
+        if changed or cancelled:
+            self.logger.info(f'Reconciling {len(changed)} changed and {len(cancelled)} cancelled bookings.')
+            self.queue(changed, cancelled)
+
+    def matches(self, row: Dict, booking: Dict):
+        '''True if an appointment in the cache has the same times and location as the booking.'''
+        return (row['start_time'], row['end_time'], str(row['location_id'])) == \
+                (*self.app.booking_times(booking), str(booking['lid']))
+
+    def queue(self, changed: List, cancelled: List[Dict]):
+        '''Adds the updates and deletions to the outbox. Without an update endpoint, changed bookings are deleted and registered again.'''
+        updates = []
+        cancels = [{'appt_id': row['appt_id'], 'booking_date': row['booking_date'],
+                    'prereg_id': row['prereg_id'], 'location_id': row['location_id'], 'recreate': None} for row in cancelled]
+        if self.can_update:
+            updates = [{'prereg_id': row['prereg_id'], 'location_id': row['location_id'],
+                        'pre_reg': self.app.make_prereg(booking)} for row, booking in changed]
+        elif changed:
+            users = self.app.cache.user_lookup_many(booking['primary_id'] for _, booking in changed)
+            for row, booking in changed:
+                cancels.append({'appt_id': row['appt_id'], 'booking_date': row['booking_date'],
+                                'prereg_id': row['prereg_id'], 'location_id': row['location_id'],
+                                'recreate': {'pre_reg': self.app.make_prereg(booking),
+                                             'primary_id': booking['primary_id'],
+                                             'visitor_id': (users.get(booking['primary_id']) or {}).get('visitor_id')}})
+        with self.app.cache.transaction():
+            self.app.outbox.add_updates(updates)
+            self.app.outbox.add_cancels(cancels)
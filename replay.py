@@ -0,0 +1,313 @@
+import argparse
+import base64
+import copy
+import gzip
+import json
+import signal
+import sys
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from hashlib import sha256
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Iterator
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import logging
+import requests
+import yaml
+from utils import load_config
+
+# Run from the command line to record the app's traffic with LibCal, Alma, and PassagePoint, or to replay a recording, e.g.:
+#   python replay.py record --archive traffic.jsonl.gz
+#   python app.py --config config.replay.yml
+# and later, offline:
+#   python replay.py replay --archive traffic.jsonl.gz --speed 10
+#   python app.py --config config.replay.yml
+# In both modes, a local server is started, and a copy of the app's config is written (to config.replay.yml, by default) with the API endpoints pointing to that server, so that the app runs unmodified.
+# When recording, the server forwards each request to the real API and appends the exchange to the archive (gzipped JSON Lines), with credentials redacted. When replaying, it answers each request with the recorded response to the same request, as of the same point in the recording, after the recorded latency; with --speed, time (and the app's polling interval, in the config written) is accelerated.
+# Since the app runs on the real clock, the dates in LibCal responses are moved forward on replay by the time since the recording started (unless --no-shift is given), so that a recording made on an earlier day is replayed as if it were made now.
+
+# Request and response fields (in JSON bodies and query strings) whose values are replaced before recording
+SECRET_FIELDS = {'client_secret', 'password', 'access_token', 'refresh_token', 'token', 'apikey'}
+REDACTED = 'REDACTED'
+# Response headers kept in the recording
+RECORDED_HEADERS = {'content-type', 'retry-after', 'x-exl-api-remaining', 'etag', 'last-modified'}
+# Headers not to be passed on by the proxy
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'host', 'upgrade', 'proxy-connection'}
+# Fields of LibCal bookings holding timestamps, which are shifted on replay
+DATE_FIELDS = {'fromDate', 'toDate', 'created'}
+
+def redact(data):
+    '''Returns a copy of parsed JSON data with the values of SECRET_FIELDS replaced, at any depth.'''
+    if isinstance(data, dict):
+        return {key: REDACTED if key in SECRET_FIELDS else redact(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [redact(value) for value in data]
+    return data
+
+def redact_url(url: str):
+    '''Replaces the values of SECRET_FIELDS in the query string of a URL.'''
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    query = urlencode([(name, REDACTED if name in SECRET_FIELDS else value) for name, value in parse_qsl(parts.query, keep_blank_values=True)])
+    return parts._replace(query=query).geturl()
+
+def redact_body(body: bytes):
+    '''Returns a request or response body for recording: redacted, if it is JSON, and as text. Non-text bodies are base64-encoded, and marked as such.'''
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return {'body_b64': base64.b64encode(body).decode('ascii')}
+    try:
+        return {'body': json.dumps(redact(json.loads(text)))}
+    except ValueError:
+        return {'body': text}
+
+def shift_date(value, offset: float):
+    '''Returns a LibCal timestamp moved offset seconds later, or value unchanged if it is not a timestamp.'''
+    try:
+        return (datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z') + timedelta(seconds=offset)).isoformat()
+    except (TypeError, ValueError):
+        return value
+
+def shift_dates(data, offset: float):
+    '''Returns a copy of parsed JSON data with the timestamps in DATE_FIELDS moved offset seconds later, at any depth.'''
+    if isinstance(data, dict):
+        return {key: shift_date(value, offset) if key in DATE_FIELDS else shift_dates(value, offset) for key, value in data.items()}
+    if isinstance(data, list):
+        return [shift_dates(value, offset) for value in data]
+    return data
+
+def credential_id(headers):
+    '''Returns a short, non-reversible identifier for the API key in an Alma Authorization header (so that requests to different IZ's can be told apart on replay), or None.'''
+    auth = headers.get('Authorization') or ''
+    if auth.lower().startswith('apikey '):
+        # As AlmaRequests.iz_id
+        return sha256(auth[7:].strip().encode()).hexdigest()[:16]
+    return None
+
+def proxy_url(base_url: str, upstream: str, url: str):
+    '''Rewrites an API URL to go through the local server at base_url. The upstream name and the original scheme and host are kept in the path, so that the server can reconstruct the URL.'''
+    parts = urlsplit(url)
+    return f'{base_url}/{upstream}/{parts.scheme}/{parts.netloc}{parts.path}'
+
+def original_url(path: str):
+    '''Given the path of a request to the local server, returns the upstream name and the original URL.'''
+    upstream, scheme, rest = path.lstrip('/').split('/', 2)
+    return upstream, f'{scheme}://{rest}'
+
+def rewrite_config(config: Dict, base_url: str, speed: float = 1.0):
+    '''Returns a copy of the app config with the API endpoints pointing to the local server at base_url.
+    If speed is greater than 1, the polling intervals are shortened by the same factor.'''
+    config = copy.deepcopy(config)
+    for section, upstream, keys in (('LibCal', 'libcal', ('credentials_endpt', 'bookings_endpt')),
+                                    ('Alma', 'alma', ('users_endpt',)),
+                                    ('PassagePoint', 'passagepoint', ('pp_api_root',))):
+        for key in keys:
+            config[section][key] = proxy_url(base_url, upstream, config[section][key])
+    if speed != 1:
+        for key in ('interval', 'min_interval', 'max_interval'):
+            if key in config['LCPP']:
+                config['LCPP'][key] = max(1, config['LCPP'][key] / speed)
+    return config
+
+def read_archive(path: str):
+    '''Yields the records in an archive. An archive cut short (e.g., if the recording was killed) is read up to the last complete record.'''
+    logger = logging.getLogger('lcpp.replay')
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, ValueError) as e:
+            logger.warning(f'Archive {path} ends with an incomplete record -- {e}')
+
+class TrafficArchive():
+
+    def __init__(self, path: str, flush_every: int = 100):
+        '''Appends records (exchanges with an API) to a gzipped JSON Lines file. Records may be written from any thread.
+        The file is flushed every flush_every records, so that most of the recording can be read even if the process is killed.'''
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.flush_every = flush_every
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, record: Dict):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class ReplayIndex():
+
+    def __init__(self, records: Iterator[Dict], speed: float = 1.0, shift: bool = True):
+        '''Recorded responses, by request (method, URL, and credential), in the order recorded. The clock starts at the first record when start is called, running speed times faster than real time.
+        If shift is true, the dates in LibCal responses are moved forward by the time (to the second) between the start of the recording and the start of the replay, so that the bookings are as current, relative to the app's clock, as when they were recorded; otherwise, bookings recorded on an earlier day would be ignored as expired. (The offset is fixed for the replay, so that a booking is always served with the same dates.)'''
+        self.speed = speed
+        self.shift = shift
+        self.responses = {}
+        for record in records:
+            self.responses.setdefault(self.key(record['method'], record['url'], record.get('credential')), []).append(record)
+        for responses in self.responses.values():
+            responses.sort(key=lambda r: r['time'])
+        self.times = {key: [r['time'] for r in responses] for key, responses in self.responses.items()}
+        self.origin = min((times[0] for times in self.times.values()), default=0)
+        self.start()
+        self.stats = {'served': 0, 'missing': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(method: str, url: str, credential: str = None):
+        return method.upper(), redact_url(url), credential
+
+    def start(self):
+        '''Starts the replay clock from the beginning of the recording.'''
+        self.started = time.time()
+        self.offset = round(self.started - self.origin) if self.shift else 0
+
+    def now(self):
+        '''The current time on the recording's clock.'''
+        return self.origin + (time.time() - self.started) * self.speed
+
+    def lookup(self, method: str, url: str, credential: str = None):
+        '''Returns the most recent response, as of now on the recording\'s clock, to the same request; or the first response, if the request was not made until later in the recording; or None, if it was never made.'''
+        key = self.key(method, url, credential)
+        responses = self.responses.get(key)
+        with self.lock:
+            self.stats['served' if responses else 'missing'] += 1
+        if not responses:
+            return None
+        return responses[max(0, bisect_right(self.times[key], self.now()) - 1)]
+
+    def body(self, record: Dict):
+        '''Returns the body of a recorded response, as served: with the dates shifted, for a LibCal response with a JSON body.'''
+        if 'body_b64' in record:
+            return base64.b64decode(record['body_b64'])
+        body = record.get('body', '')
+        if self.offset and record.get('upstream') == 'libcal':
+            try:
+                body = json.dumps(shift_dates(json.loads(body), self.offset))
+            except ValueError:
+                pass
+        return body.encode('utf-8')
+
+def make_handler(mode: str, archive: TrafficArchive = None, index: ReplayIndex = None):
+    '''Returns a request handler class for the local server. In record mode, requests are forwarded and written to archive; in replay mode, they are answered from index.'''
+    logger = logging.getLogger('lcpp.replay')
+    # One pooled connection per concurrent request from the app
+    session = requests.Session()
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, requests.adapters.HTTPAdapter(pool_maxsize=64))
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send(self, status: int, headers: Dict, body: bytes):
+            self.send_response(status)
+            for name, value in headers.items():
+                if name.lower() not in HOP_HEADERS:
+                    self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length)
+
+        def _handle(self):
+            body = self._body()
+            if self.path == '/_stats' and index:
+                return self._send(200, {'Content-Type': 'application/json'}, json.dumps(index.stats).encode())
+            try:
+                upstream, url = original_url(self.path)
+            except ValueError:
+                return self._send(404, {}, b'')
+            if mode == 'record':
+                self._record(upstream, url, body)
+            else:
+                self._replay(url)
+
+        def _record(self, upstream: str, url: str, body: bytes):
+            headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_HEADERS}
+            start = time.time()
+            try:
+                resp = session.request(self.command, url, headers=headers, data=body or None, allow_redirects=False)
+            except requests.RequestException as e:
+                logger.error(f'Error forwarding request to {upstream} -- {e}')
+                return self._send(502, {}, b'')
+            elapsed = time.time() - start
+            archive.write({'time': start,
+                           'elapsed': elapsed,
+                           'upstream': upstream,
+                           'method': self.command,
+                           'url': redact_url(url),
+                           'credential': credential_id(self.headers),
+                           'request': redact_body(body) if body else {},
+                           'status': resp.status_code,
+                           'headers': {name: value for name, value in resp.headers.items() if name.lower() in RECORDED_HEADERS},
+                           **redact_body(resp.content)})
+            self._send(resp.status_code, dict(resp.headers), resp.content)
+
+        def _replay(self, url: str):
+            record = index.lookup(self.command, url, credential_id(self.headers))
+            if record is None:
+                logger.warning(f'No recorded response for {self.command} {redact_url(url)}')
+                return self._send(404, {'Content-Type': 'application/json'}, json.dumps({'error': 'Not in recording'}).encode())
+            time.sleep(record.get('elapsed', 0) / index.speed)
+            self._send(record['status'], record.get('headers', {}), index.body(record))
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    return Handler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record the app\'s API traffic, or replay a recording, through a local server.')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--archive', required=True, help='Recording (gzipped JSON Lines); appended to when recording')
+    parser.add_argument('--config', default='./config.yml', help='Path to the app\'s config')
+    parser.add_argument('--out-config', default='./config.replay.yml', help='Where to write the config for the app to use with the local server')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay: speed relative to the recording (e.g., 10 for ten times as fast)')
+    parser.add_argument('--no-shift', action='store_false', dest='shift', help='Replay: serve the dates in LibCal responses as recorded, rather than moving them forward to the time of the replay')
+    parser.add_argument('--debug', action='store_const', dest='log_level', const=logging.DEBUG, default=logging.INFO)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+    logger = logging.getLogger('lcpp.replay')
+    archive = index = None
+    if args.mode == 'record':
+        archive = TrafficArchive(args.archive)
+        speed = 1.0
+    else:
+        index = ReplayIndex(read_archive(args.archive), speed=args.speed, shift=args.shift)
+        speed = args.speed
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args.mode, archive=archive, index=index))
+    with open(args.out_config, 'w') as f:
+        yaml.safe_dump(rewrite_config(load_config(args.config), f'http://127.0.0.1:{args.port}', speed), f, sort_keys=False)
+    logger.info(f'{args.mode.capitalize()}ing on port {args.port}; run the app with --config {args.out_config}')
+    if index:
+        index.start()
+    # Stopped with Ctrl-C or SIGTERM; either way, the archive is closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if archive:
+            archive.close()
+        if index:
+            logger.info(f'Replay: {index.stats}')
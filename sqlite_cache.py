@@ -1,46 +1,240 @@
+import math
 import sqlite3
-from sqlite3 import OperationalError, Row
-from typing import Dict, List
+import threading
+from contextlib import contextmanager
+from sqlite3 import Row
+from typing import Dict, Iterable, List, Tuple
+from utils import chunked
+from tracing import TRACER, TracedCursor
 import logging
 
+# Number of parameters to bind per query, below SQLite's default limit on host parameters (999)
+MAX_VARIABLES = 900
+
+# Settings applied to each connection. WAL lets readers proceed while another connection (or process) writes, and with synchronous=NORMAL, commits don't wait on fsync (the database remains consistent after a crash, though the latest commits may be lost if the OS crashes).
+DEFAULT_PRAGMAS = {'journal_mode': 'WAL',
+                   'synchronous': 'NORMAL',
+                   'temp_store': 'MEMORY',
+                   'cache_size': -8000} # In KiB (8 MB)
+
+# Seconds to wait for another connection's write lock before giving up
+BUSY_TIMEOUT = 30
+
 class SQLiteCache():
 
-    def __init__(self, db_name: str = 'cache.db'):
-        '''Initializes a SQLite database (unless it already exists) with the supplied name (if given).'''
+    def __init__(self, db_name: str = 'cache.db', pragmas: Dict = None):
+        '''Initializes a SQLite database (unless it already exists) with the supplied name (if given), applying any schema migrations not yet applied.
+        Each thread gets its own connection, so the cache may be used from worker threads as well as the main thread.
+        pragmas, if provided, override DEFAULT_PRAGMAS.'''
         self.logger = logging.getLogger('lcpp.sqlite_cache')
+        self.db_name = db_name
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
         try:
-            self.conn = sqlite3.connect(db_name)
-            self.conn.row_factory = Row # Facilitates lookup of query results by key
-            self.cursor = self.conn.cursor()
+            self.conn
         except Exception as e:
             self.logger.exception(f'Error connecting to database.')
             raise
+        self._migrate()
 
-        self._create_tables()
+    @property
+    def conn(self):
+        '''The calling thread\'s connection, opened on first use.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            # When tracing is enabled, each query is recorded as a span
+            self._local.cursor = conn.cursor(TracedCursor) if TRACER.enabled else conn.cursor()
+            self._local.depth = 0
+        return conn
 
-    def _create_tables(self):
-        '''Initializes database with tables for users and appointments, if these don\'t exist'''
+    @property
+    def cursor(self):
+        '''The calling thread\'s cursor.'''
+        self.conn
+        return self._local.cursor
+
+    def _connect(self):
+        '''Opens a connection with the configured pragmas.'''
+        conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT)
+        conn.row_factory = Row # Facilitates lookup of query results by key
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def close_connection(self):
+        '''Closes the calling thread\'s connection (e.g., at the end of a worker thread).'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+            self._local.conn = None
+
+    def close(self):
+        '''Closes all connections. Should be called once other threads have stopped using the cache.'''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        '''Runs the block in a single transaction on the calling thread\'s connection, committing at the end (or rolling back on error).
+        Transactions nest: the writes of all the methods called within a block are committed together, so that a batch of writes costs a single commit.
+        If immediate is true, the database\'s write lock is taken at the start (BEGIN IMMEDIATE), so that reads and writes by other connections cannot interleave with the block. (This has no effect on a nested block.)'''
+        conn = self.conn
+        local = self._local
+        if local.depth:
+            local.depth += 1
+            try:
+                yield
+            finally:
+                local.depth -= 1
+            return
+        local.depth = 1
         try:
-            with self.conn:
-                self.cursor.execute('''
-                                CREATE TABLE users 
-                                    (primary_id text PRIMARY KEY, barcode text, visitor_id text)
+            if immediate:
+                local.cursor.execute('BEGIN IMMEDIATE')
+            yield
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            local.depth = 0
+
+    def in_transaction(self):
+        '''True if the calling thread is within a transaction block.'''
+        self.conn
+        return bool(self._local.depth)
+
+    def _migrate(self):
+        '''Applies the migrations in MIGRATIONS that have not yet been applied, recording the schema version in the database\'s user_version.'''
+        with self.transaction(immediate=True):
+            self.cursor.execute('PRAGMA user_version')
+            version = self.cursor.fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                self.logger.debug(f'Applying schema migration {number}: {migration.__name__}')
+                migration(self)
+                # PRAGMA does not accept parameters
+                self.cursor.execute(f'PRAGMA user_version = {int(number)}')
+
+    def _create_tables(self):
+        '''Creates the tables, if they don\'t exist, and brings tables created by earlier versions of the app up to date.'''
+        self.cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS users
+                            (primary_id text PRIMARY KEY, barcode text, visitor_id text)
+                        ''')
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS appts
+                                (appt_id text, booking_date text, prereg_id text, start_time real, end_time real, location_id integer,
+                                PRIMARY KEY (appt_id, booking_date))
+                        ''')
+        # Columns added after the initial schema
+        self._add_columns('users', {'user_group': 'text', 'iz': 'text', 'fetched_at': 'real'})
+        self._migrate_appts()
+        # Per-location high-water mark for incremental polling of LibCal
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS watermarks
+                                (location_id integer PRIMARY KEY, booking_date text, last_created real, last_full_sweep real)
+                            ''')
+        # The Alma IZ in which each user was last found
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS iz_affinity
+                                (primary_id text PRIMARY KEY, iz text)
+                            ''')
+        # User ID's that could not be registered, with the reason and the time at which the entry expires
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS invalid_users
+                                (primary_id text PRIMARY KEY, reason text, expires_at real)
+                            ''')
+        # Pending PassagePoint operations, keyed by an idempotency key
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS outbox
+                                (key text PRIMARY KEY, op text, payload text, attempts integer, next_attempt_at real, last_error text)
+                            ''')
+        # Leases on shards of work (LibCal locations) held by worker processes sharing the cache, and the workers' heartbeats
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS leases
+                                (shard text PRIMARY KEY, owner text, expires_at real)
+                            ''')
+        self.cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS workers
+                                (worker_id text PRIMARY KEY, heartbeat_at real)
+                            ''')
+        # The shard (location) to which an outbox operation belongs; NULL for operations any worker may perform
+        self._add_columns('outbox', {'shard': 'text'})
+
+    def _create_indexes(self):
+        '''Adds indexes for the queries that filter on columns other than the primary keys.'''
+        # Due operations in the outbox
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS outbox_next_attempt_at ON outbox (next_attempt_at)')
+        # The next appointment to start (adaptive polling)
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS appts_start_time ON appts (start_time)')
+        # Pruning the negative cache
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS invalid_users_expires_at ON invalid_users (expires_at)')
+        # A worker's leases
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS leases_owner ON leases (owner)')
+
+    def _index_barcodes(self):
+        '''Adds an index on users.barcode, for matching PassagePoint visitors (identified by barcode) to users.'''
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS users_barcode ON users (barcode)')
+
+    def _add_change_detection(self):
+        '''Adds the columns used to detect unchanged LibCal responses to the watermarks table: the conditional request headers (as JSON) and a hash of the bookings from the last poll.'''
+        self._add_columns('watermarks', {'validators': 'text', 'fingerprint': 'text'})
+
+    def _add_held_bookings(self):
+        '''Adds a column to the watermarks table for the IDs (as JSON) of the bookings not yet approved at the last poll, which incremental polling returns again whatever their creation time.'''
+        self._add_columns('watermarks', {'held': 'text'})
+
+    def _add_outbox_claims(self):
+        '''Adds a column to the outbox for the time at which an operation was last claimed, cleared when a failed attempt is recorded. An operation claimed again while this is set was never completed or rescheduled (e.g., the worker stopped during the attempt), so its outcome is unknown.'''
+        self._add_columns('outbox', {'claimed_at': 'real'})
+
+    def _add_appt_fingerprints(self):
+        '''Adds a column to the appts table for a hash of the booking\'s times, location, and status when it was registered, so that bookings changed since can be found.'''
+        self._add_columns('appts', {'fingerprint': 'text'})
+
+    def _migrate_appts(self):
+        '''Rebuilds an appts table created before appointments were keyed on (bookId, date). Existing rows are assigned today\'s date, and are pruned after today.'''
+        self.cursor.execute('PRAGMA table_info(appts)')
+        if 'booking_date' not in {row['name'] for row in self.cursor.fetchall()}:
+            self.logger.debug('Migrating appts table.')
+            self.cursor.execute('''
+                                CREATE TABLE appts_new
+                                    (appt_id text, booking_date text, prereg_id text, start_time real, end_time real, location_id integer,
+                                    PRIMARY KEY (appt_id, booking_date))
                                 ''')
-                self.cursor.execute('''
-                                    CREATE TABLE appts
-                                        (appt_id text PRIMARY KEY, prereg_id text)
+            self.cursor.execute('''
+                                INSERT INTO appts_new (appt_id, booking_date, prereg_id)
+                                SELECT appt_id, date('now', 'localtime'), prereg_id FROM appts
                                 ''')
-        except OperationalError as e:
-            # Catch error if table already exists; no need to recreate
-            if 'already exists' in e.args[0]:
-                self.logger.debug('Tables already exist. Skipping table creation.')
-                return
-        except Exception as e:
-            raise
+            self.cursor.execute('DROP TABLE appts')
+            self.cursor.execute('ALTER TABLE appts_new RENAME TO appts')
+        # For pruning expired appointments
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS appts_end_time ON appts (end_time)')
+
+    def _add_columns(self, table: str, columns: Dict[str, str]):
+        '''Adds the given columns (a mapping of column names to types) to an existing table, if they are not already present.'''
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        existing = {row['name'] for row in self.cursor.fetchall()}
+        for name, col_type in columns.items():
+            if name not in existing:
+                self.logger.debug(f'Adding column {name} to table {table}.')
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {col_type}')
 
     def user_lookup(self, primary_id: str):
         '''Retrieve the user\'s data from the database if it exists.'''
-        with self.conn:
+        with self.transaction():
             self.cursor.execute('''
                                     SELECT * from users 
                                     WHERE primary_id = :primary_id
@@ -54,7 +248,7 @@ class SQLiteCache():
     def appt_lookup(self, appt_id: str):
         '''Queries the appointments table for an existing appointment.
         appt_id should be a LibCal bookId.'''
-        with self.conn:
+        with self.transaction():
             self.cursor.execute('''
                                         SELECT * from appts
                                         WHERE appt_id = :appt_id
@@ -64,30 +258,332 @@ class SQLiteCache():
                 return dict(row)
             return None
 
+    def user_lookup_many(self, primary_ids: Iterable[str]):
+        '''Retrieves the data for a batch of users in as few queries as possible.
+        Returns a dictionary mapping primary IDs to user data. Users not in the database are omitted.'''
+        users = {}
+        with self.transaction():
+            for chunk in chunked(set(primary_ids), MAX_VARIABLES):
+                placeholders = ','.join('?' * len(chunk))
+                self.cursor.execute(f'''
+                                        SELECT * from users
+                                        WHERE primary_id IN ({placeholders})
+                                    ''', chunk)
+                users.update({row['primary_id']: dict(row) for row in self.cursor.fetchall()})
+        return users
+
+    def load_appt_keys(self):
+        '''Returns a dictionary mapping the (appt_id, booking_date) key of every appointment to its end time.'''
+        with self.transaction():
+            self.cursor.execute('SELECT appt_id, booking_date, end_time from appts')
+            return {(row['appt_id'], row['booking_date']): row['end_time'] for row in self.cursor.fetchall()}
+
+    def load_recent_users(self, limit: int):
+        '''Returns up to limit users, those whose Alma data was fetched most recently first.'''
+        with self.transaction():
+            self.cursor.execute('SELECT * from users ORDER BY fetched_at DESC LIMIT :limit', {'limit': limit})
+            return [dict(row) for row in self.cursor.fetchall()]
+
+    def appt_lookup_many(self, appt_keys: Iterable[Tuple[str, str]]):
+        '''Queries the appointments table for a batch of appointments, each identified by a tuple of LibCal bookId and booking date (YYYY-MM-DD).
+        Returns the set of those keys already in the table.'''
+        found = set()
+        with self.transaction():
+            # Two parameters per key
+            for chunk in chunked(set(appt_keys), MAX_VARIABLES // 2):
+                placeholders = ','.join(['(?, ?)'] * len(chunk))
+                self.cursor.execute(f'''
+                                        SELECT appt_id, booking_date from appts
+                                        WHERE (appt_id, booking_date) IN (VALUES {placeholders})
+                                    ''', [value for key in chunk for value in key])
+                found.update((row['appt_id'], row['booking_date']) for row in self.cursor.fetchall())
+        return found
+
     def add_users(self, user_data: List[Dict[str, str]]):
         '''Adds users to the users table.
-        user_data should be a list of dictionaries, each containing the user\'s Alma primary ID, barcode, and visitor ID (Passage Point).'''
-        with self.conn:
-            # Current behavior is to replace rows upon violation of the primary key constraint (on the primary ID.) That might be useful if, for instance, a user's visitor ID in Passage Point somehow changes.
+        user_data should be a list of dictionaries, each containing the user\'s Alma primary ID, barcode, and visitor ID (Passage Point), and optionally the user group and IZ from Alma and the time (UNIX timestamp) at which the Alma data was fetched.'''
+        with self.transaction():
+            self._insert_users(user_data)
+
+    def _insert_users(self, user_data: List[Dict[str, str]]):
+        '''Inserts users into the users table, within the current transaction.'''
+        user_data = [{'user_group': None, 'iz': None, 'fetched_at': None, **user} for user in user_data]
+        # Current behavior is to replace rows upon violation of the primary key constraint (on the primary ID.) That might be useful if, for instance, a user's visitor ID in Passage Point somehow changes.
+        self.cursor.executemany('''
+                                INSERT OR REPLACE INTO users (primary_id, barcode, visitor_id, user_group, iz, fetched_at) 
+                                VALUES (:primary_id, :barcode, :visitor_id, :user_group, :iz, :fetched_at)
+                                ''', user_data)
+
+    def merge_profiles(self, profiles: List[Dict]):
+        '''Adds or updates the Alma data for a batch of users (e.g., just fetched, or from a bulk export). profiles should be a list of dictionaries with primary_id, barcode, user_group, iz, and fetched_at as keys.
+        Users already in the table keep their visitor ID, unless their barcode has changed (since PassagePoint visitors are identified by barcode), and their IZ, if iz is None.'''
+        with self.transaction():
+            # In the SET clause, columns of users refer to the existing row
             self.cursor.executemany('''
-                                    INSERT OR REPLACE INTO users (primary_id, barcode, visitor_id) 
-                                    VALUES (:primary_id, :barcode, :visitor_id)
-                                    ''', user_data)
+                                    INSERT INTO users (primary_id, barcode, visitor_id, user_group, iz, fetched_at)
+                                    VALUES (:primary_id, :barcode, NULL, :user_group, :iz, :fetched_at)
+                                    ON CONFLICT (primary_id) DO UPDATE SET
+                                        visitor_id = CASE WHEN users.barcode = excluded.barcode THEN users.visitor_id END,
+                                        barcode = excluded.barcode,
+                                        user_group = excluded.user_group,
+                                        iz = COALESCE(excluded.iz, users.iz),
+                                        fetched_at = excluded.fetched_at
+                                    ''', profiles)
+
+    def set_visitor_ids(self, visitors: List[Dict[str, str]]):
+        '''Records PassagePoint visitor IDs for the users with the given barcodes. visitors should be a list of dictionaries with barcode and visitor_id as keys.
+        Returns the number of users updated. (Visitors whose barcode does not belong to any user are ignored.)'''
+        with self.transaction():
+            self.cursor.executemany('''
+                                    UPDATE users SET visitor_id = :visitor_id
+                                    WHERE barcode = :barcode
+                                    ''', visitors)
+            return self.cursor.rowcount
 
     def add_appt(self, appt_data: List[Dict[str, str]]):
         '''Insert a list of mappings from LibCal to PassagePoint appointment IDs. 
-        appt_data should contain appt_id (LibCal) and prereg_id (PP) as keys.'''
-        with self.conn:
+        appt_data should contain appt_id (LibCal) and prereg_id (PP) as keys, along with the booking_date (YYYY-MM-DD), start_time and end_time (UNIX timestamps), and location_id (LibCal).'''
+        with self.transaction():
+            self._insert_appts(appt_data)
+
+    def _insert_appts(self, appt_data: List[Dict[str, str]]):
+        '''Inserts appointments into the appts table, within the current transaction. Existing rows for the same appointments (e.g., updated by reconciliation) are replaced.'''
+        self.cursor.executemany('''
+                                    INSERT OR REPLACE INTO appts (appt_id, booking_date, prereg_id, start_time, end_time, location_id, fingerprint) 
+                                    VALUES (:appt_id, :booking_date, :prereg_id, :start_time, :end_time, :location_id, :fingerprint)
+                                ''', ({'fingerprint': None, **appt} for appt in appt_data))
+
+    def add_outbox(self, ops: List[Dict]):
+        '''Adds pending PassagePoint operations to the outbox. ops should be a list of dictionaries with key, op, payload (a JSON string), and next_attempt_at as keys, and optionally the shard to which the operation belongs and claimed_at (for operations claimed as they are added; see claim_outbox).
+        Operations whose key is already in the outbox are ignored.'''
+        with self.transaction():
             self.cursor.executemany('''
-                                        INSERT INTO appts (appt_id, prereg_id) 
-                                        VALUES (:appt_id, :prereg_id)
-                                    ''', appt_data)
+                                    INSERT OR IGNORE INTO outbox (key, op, payload, attempts, next_attempt_at, last_error, shard, claimed_at)
+                                    VALUES (:key, :op, :payload, 0, :next_attempt_at, NULL, :shard, :claimed_at)
+                                    ''', ({'shard': None, 'claimed_at': None, **op} for op in ops))
+
+    def outbox_lookup_many(self, keys: Iterable[str]):
+        '''Returns the set of the given keys that are in the outbox.'''
+        found = set()
+        with self.transaction():
+            for chunk in chunked(set(keys), MAX_VARIABLES):
+                placeholders = ','.join('?' * len(chunk))
+                self.cursor.execute(f'''
+                                        SELECT key from outbox
+                                        WHERE key IN ({placeholders})
+                                    ''', chunk)
+                found.update(row['key'] for row in self.cursor.fetchall())
+        return found
+
+    def outbox_due(self, now: float):
+        '''Returns the operations in the outbox due to be attempted at or before now (a UNIX timestamp), oldest first.'''
+        with self.transaction():
+            self.cursor.execute('''
+                                    SELECT * from outbox
+                                    WHERE next_attempt_at <= :now
+                                    ORDER BY next_attempt_at
+                                ''', {'now': now})
+            return [dict(row) for row in self.cursor.fetchall()]
+
+    def claim_outbox(self, now: float, claim_timeout: float, shards: Iterable[str] = None):
+        '''Returns the operations in the outbox due at or before now (a UNIX timestamp), oldest first, and postpones them by claim_timeout seconds, so that other workers do not attempt them at the same time. Operations that are not completed or rescheduled in the meantime become due again.
+        The time of the claim is recorded in claimed_at; the operations returned have the claimed_at of their previous claim, which is not None if that claim expired.
+        If shards is provided, only operations with no shard or with one of the given shards are claimed.'''
+        with self.transaction(immediate=True):
+            query = 'SELECT * from outbox WHERE next_attempt_at <= ?'
+            params = [now]
+            if shards is not None:
+                shards = list(shards)
+                query += f' AND (shard IS NULL OR shard IN ({",".join("?" * len(shards))}))'
+                params.extend(shards)
+            self.cursor.execute(query + ' ORDER BY next_attempt_at', params)
+            ops = [dict(row) for row in self.cursor.fetchall()]
+            self.cursor.executemany('UPDATE outbox SET next_attempt_at = ?, claimed_at = ? WHERE key = ?', 
+                                    [(now + claim_timeout, now, op['key']) for op in ops])
+        return ops
+
+    def count_outbox(self):
+        '''Returns the number of operations in the outbox.'''
+        with self.transaction():
+            self.cursor.execute('SELECT count(*) from outbox')
+            return self.cursor.fetchone()[0]
+
+    def reschedule_outbox(self, ops: List[Dict]):
+        '''Records failed attempts, releasing the operations' claims. ops should be a list of dictionaries with key, attempts, next_attempt_at, and last_error as keys.'''
+        with self.transaction():
+            self.cursor.executemany('''
+                                    UPDATE outbox SET attempts = :attempts, next_attempt_at = :next_attempt_at, last_error = :last_error, claimed_at = NULL
+                                    WHERE key = :key
+                                    ''', ops)
+
+    def complete_outbox(self, key: str, users: List[Dict] = None, appts: List[Dict] = None, deleted_appts: List[Tuple[str, str]] = None):
+        '''Removes a completed operation from the outbox and saves its results, in a single transaction. deleted_appts, if provided, should be a list of (appt_id, booking_date) keys of appointments to remove.'''
+        with self.transaction():
+            if users:
+                self._insert_users(users)
+            if appts:
+                self._insert_appts(appts)
+            if deleted_appts:
+                self.cursor.executemany('DELETE FROM appts WHERE appt_id = ? AND booking_date = ?', deleted_appts)
+            self.cursor.execute('DELETE FROM outbox WHERE key = :key', {'key': key})
+
+    def delete_outbox(self, keys: List[str]):
+        '''Removes operations from the outbox without saving any results.'''
+        with self.transaction():
+            self.cursor.executemany('DELETE FROM outbox WHERE key = ?', [(key,) for key in keys])
+
+    def iz_lookup_many(self, primary_ids: Iterable[str]):
+        '''Returns a dictionary mapping primary IDs to the IZ in which each user was last found. Users with no IZ on record are omitted.'''
+        izs = {}
+        with self.transaction():
+            for chunk in chunked(set(primary_ids), MAX_VARIABLES):
+                placeholders = ','.join('?' * len(chunk))
+                self.cursor.execute(f'''
+                                        SELECT primary_id, iz from iz_affinity
+                                        WHERE primary_id IN ({placeholders})
+                                    ''', chunk)
+                izs.update({row['primary_id']: row['iz'] for row in self.cursor.fetchall()})
+        return izs
+
+    def add_iz_affinity(self, affinity: List[Dict[str, str]]):
+        '''Records the IZ in which users were found. affinity should be a list of dictionaries with primary_id and iz as keys.'''
+        with self.transaction():
+            self.cursor.executemany('''
+                                    INSERT OR REPLACE INTO iz_affinity (primary_id, iz)
+                                    VALUES (:primary_id, :iz)
+                                    ''', affinity)
+
+    def load_invalid_users(self, now: float):
+        '''Returns a dictionary mapping the primary IDs of invalid users to the expiry time of the entry, for entries that expire after now (a UNIX timestamp).'''
+        with self.transaction():
+            self.cursor.execute('''
+                                    SELECT primary_id, expires_at from invalid_users
+                                    WHERE expires_at > :now
+                                ''', {'now': now})
+            return {row['primary_id']: row['expires_at'] for row in self.cursor.fetchall()}
+
+    def add_invalid_users(self, user_data: List[Dict]):
+        '''Records invalid users. user_data should be a list of dictionaries with primary_id, reason, and expires_at as keys.'''
+        with self.transaction():
+            self.cursor.executemany('''
+                                    INSERT OR REPLACE INTO invalid_users (primary_id, reason, expires_at)
+                                    VALUES (:primary_id, :reason, :expires_at)
+                                    ''', user_data)
+
+    def delete_expired_invalid_users(self, now: float):
+        '''Deletes entries for invalid users that expire at or before now (a UNIX timestamp).'''
+        with self.transaction():
+            self.cursor.execute('DELETE FROM invalid_users WHERE expires_at <= :now', {'now': now})
+
+    def watermark_lookup(self, location_id: int):
+        '''Retrieves the high-water mark for a LibCal location, if one has been recorded.'''
+        with self.transaction():
+            self.cursor.execute('''
+                                    SELECT * from watermarks
+                                    WHERE location_id = :location_id
+                                ''', {'location_id': location_id})
+            row = self.cursor.fetchone()
+            if row:
+                return dict(row)
+            return None
+
+    def update_watermark(self, watermark: Dict):
+        '''Records the high-water mark for a LibCal location.
+        watermark should contain location_id, booking_date (ISO format), last_created and last_full_sweep (UNIX timestamps) as keys, and optionally validators and fingerprint (for change detection) and held (the IDs of bookings not yet approved, as JSON).'''
+        watermark = {'validators': None, 'fingerprint': None, 'held': None, **watermark}
+        with self.transaction():
+            self.cursor.execute('''
+                                    INSERT OR REPLACE INTO watermarks (location_id, booking_date, last_created, last_full_sweep, validators, fingerprint, held)
+                                    VALUES (:location_id, :booking_date, :last_created, :last_full_sweep, :validators, :fingerprint, :held)
+                                ''', watermark)
+
+    def reconcile_lookup(self, booking_date: str, location_ids: Iterable[int], now: float):
+        '''Returns the appointments on booking_date (YYYY-MM-DD) at the given LibCal locations that have not yet ended at now (a UNIX timestamp), for comparison with the current bookings.'''
+        location_ids = list(location_ids)
+        with self.transaction():
+            self.cursor.execute(f'''
+                                    SELECT * from appts
+                                    WHERE booking_date = ? AND location_id IN ({','.join('?' * len(location_ids))})
+                                        AND (end_time IS NULL OR end_time >= ?)
+                                ''', [booking_date, *location_ids, now])
+            return [dict(row) for row in self.cursor.fetchall()]
+
+    def set_appt_fingerprints(self, appts: List[Dict[str, str]]):
+        '''Records the fingerprints of appointments registered before fingerprints were stored. appts should be a list of dictionaries with appt_id, booking_date, and fingerprint.'''
+        with self.transaction():
+            self.cursor.executemany('''
+                                    UPDATE appts SET fingerprint = :fingerprint
+                                    WHERE appt_id = :appt_id AND booking_date = :booking_date
+                                    ''', appts)
+
+    def delete_expired_appts(self, cutoff: float):
+        '''Deletes appointments that ended before cutoff (a UNIX timestamp), as well as migrated appointments (with no end time) from previous days.'''
+        with self.transaction():
+            self.cursor.execute('''
+                                DELETE FROM appts 
+                                WHERE end_time < :cutoff 
+                                OR (end_time IS NULL AND booking_date < date('now', 'localtime'))
+                                ''', {'cutoff': cutoff})
+            if self.cursor.rowcount:
+                self.logger.debug(f'Deleted {self.cursor.rowcount} expired appointments.')
+
+    def claim_leases(self, worker_id: str, shards: List[str], now: float, ttl: float):
+        '''Records a heartbeat for the worker, and claims its fair share of the shards: the number of shards divided by the number of live workers (those with a heartbeat in the last ttl seconds), rounded up.
+        Leases the worker already holds are kept first (up to its share); leases that are unowned or expired are claimed; leases beyond the worker's share are released, to be claimed by other workers.
+        Claimed leases expire ttl seconds from now. Returns the set of shards held by the worker.'''
+        with self.transaction(immediate=True):
+            self.cursor.execute('INSERT OR REPLACE INTO workers (worker_id, heartbeat_at) VALUES (?, ?)', (worker_id, now))
+            # Forget workers that have been gone for a while
+            self.cursor.execute('DELETE FROM workers WHERE heartbeat_at < ?', (now - 10 * ttl,))
+            self.cursor.execute('SELECT count(*) FROM workers WHERE heartbeat_at >= ?', (now - ttl,))
+            share = math.ceil(len(shards) / max(self.cursor.fetchone()[0], 1))
+            self.cursor.execute('SELECT * FROM leases')
+            leases = {row['shard']: dict(row) for row in self.cursor.fetchall()}
+            mine = [shard for shard in shards if shard in leases and leases[shard]['owner'] == worker_id]
+            free = [shard for shard in shards if shard not in leases or 
+                        (leases[shard]['owner'] != worker_id and leases[shard]['expires_at'] <= now)]
+            owned = (mine + free)[:share]
+            released = [shard for shard in mine if shard not in owned]
+            self.cursor.executemany('INSERT OR REPLACE INTO leases (shard, owner, expires_at) VALUES (?, ?, ?)',
+                                    [(shard, worker_id, now + ttl) for shard in owned])
+            self.cursor.executemany('DELETE FROM leases WHERE shard = ? AND owner = ?', 
+                                    [(shard, worker_id) for shard in released])
+        return set(owned)
+
+    def renew_leases(self, worker_id: str, now: float, ttl: float):
+        '''Records a heartbeat for the worker and extends the leases it holds to ttl seconds from now. Returns the set of shards held by the worker.'''
+        with self.transaction():
+            self.cursor.execute('INSERT OR REPLACE INTO workers (worker_id, heartbeat_at) VALUES (?, ?)', (worker_id, now))
+            self.cursor.execute('UPDATE leases SET expires_at = ? WHERE owner = ?', (now + ttl, worker_id))
+            self.cursor.execute('SELECT shard FROM leases WHERE owner = ?', (worker_id,))
+            return {row['shard'] for row in self.cursor.fetchall()}
+
+    def release_leases(self, worker_id: str):
+        '''Releases the worker's leases (e.g., on shutdown), so that other workers can take them over right away.'''
+        with self.transaction():
+            self.cursor.execute('DELETE FROM leases WHERE owner = ?', (worker_id,))
+            self.cursor.execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+    def next_appt_start(self, now: float):
+        '''Returns the start time (a UNIX timestamp) of the next appointment to start after now, or None if there is none.'''
+        with self.transaction():
+            self.cursor.execute('SELECT MIN(start_time) FROM appts WHERE start_time > :now', {'now': now})
+            return self.cursor.fetchone()[0]
 
     def delete_appts(self):
         '''Clears all rows from the appointments table.'''
-        with self.conn:
+        with self.transaction():
             self.logger.debug('Clearing appointments table.')
             self.cursor.execute('DELETE FROM appts')
 
+# Schema migrations, in order. The database's user_version records how many have been applied. Add new migrations to the end of the list; never change or remove one that has been released.
+MIGRATIONS = [SQLiteCache._create_tables,
+              SQLiteCache._create_indexes,
+              SQLiteCache._index_barcodes,
+              SQLiteCache._add_change_detection,
+              SQLiteCache._add_appt_fingerprints,
+              SQLiteCache._add_held_bookings,
+              SQLiteCache._add_outbox_claims]
+
 if __name__ == '__main__':
     sqc = SQLiteCache()
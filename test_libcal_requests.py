@@ -0,0 +1,71 @@
+import logging
+import pytest
+from booking import Booking
+from libcal_requests import LibCalRequests
+from sqlite_cache import SQLiteCache
+
+LOCATION = {'name': 'Test Location', 'id': 1}
+APPROVED = 'Mediated Approved'
+TENTATIVE = 'Mediated Tentative'
+
+def make_booking(book_id: str, created: str, status: str = APPROVED):
+    return Booking(book_id, LOCATION['id'], '2026-10-17T22:00:00-04:00', '2026-10-17T23:00:00-04:00',
+                   f'2026-10-17T{created}-04:00', status, 'A', 'B', 'e', 'G00000001')
+
+def make_client(cache: SQLiteCache, incremental: bool = True, full_sweep_interval: int = 3600):
+    '''A LibCalRequests instance that doesn\'t connect to LibCal, for testing the handling of bookings already fetched.'''
+    client = LibCalRequests.__new__(LibCalRequests)
+    client.logger = logging.getLogger('lcpp.libcal_requests')
+    client.cache = cache
+    client.incremental = incremental
+    client.change_detection = False
+    client.full_sweep_interval = full_sweep_interval
+    return client
+
+def poll(client: LibCalRequests, bookings, now: float):
+    '''Applies the watermark to bookings as retrieve_bookings_by_location does, returning the IDs of the bookings passed on and whether the set is complete.'''
+    watermark = client.cache.watermark_lookup(LOCATION['id'])
+    new_bookings, complete = client.filter_by_watermark(LOCATION, bookings, [None], watermark, client.is_full_sweep(watermark, now), now)
+    return [b['bookId'] for b in client.approved(new_bookings)], complete
+
+@pytest.fixture
+def client(cache):
+    return make_client(cache)
+
+def test_first_poll_is_full_sweep(client):
+    bookings = [make_booking('a', '10:00:00'), make_booking('b', '10:05:00', TENTATIVE)]
+    assert poll(client, bookings, 1000) == (['a'], True)
+    watermark = client.cache.watermark_lookup(LOCATION['id'])
+    assert watermark['last_full_sweep'] == 1000
+    assert watermark['held'] == '["b"]'
+
+def test_incremental_poll_returns_new_bookings(client):
+    bookings = [make_booking('a', '10:00:00'), make_booking('b', '10:05:00')]
+    poll(client, bookings, 1000)
+    bookings.append(make_booking('c', '10:10:00'))
+    assert poll(client, bookings, 1060) == (['b', 'c'], False)
+    # Only bookings created in the same second as the mark are returned again
+    assert poll(client, bookings, 1120) == (['c'], False)
+
+def test_incremental_poll_returns_late_approvals(client):
+    # A mediated booking is approved after it was created, and after later bookings have advanced the mark
+    poll(client, [make_booking('a', '10:00:00', TENTATIVE), make_booking('b', '10:05:00')], 1000)
+    bookings = [make_booking('a', '10:00:00'), make_booking('b', '10:05:00'), make_booking('c', '10:10:00')]
+    assert poll(client, bookings, 1060) == (['a', 'b', 'c'], False)
+    # Once approved, the booking is no longer held
+    assert poll(client, bookings, 1120) == (['c'], False)
+
+def test_full_sweep_returns_all_bookings(client):
+    bookings = [make_booking('a', '10:00:00'), make_booking('b', '10:05:00')]
+    poll(client, bookings, 1000)
+    assert poll(client, bookings, 1060) == (['b'], False)
+    assert poll(client, bookings, 1000 + client.full_sweep_interval) == (['a', 'b'], True)
+
+def test_cancelled_bookings_are_filtered_out(client):
+    bookings = [make_booking('a', '10:00:00', 'Cancelled by User'), make_booking('b', '10:05:00')]
+    assert poll(client, bookings, 1000) == (['b'], True)
+
+def test_duplicates_prefer_approved_booking(client):
+    # Duplicate bookIds (the same booking for several seats) are kept once, whatever the order of their statuses
+    bookings = [make_booking('a', '10:00:00', 'Cancelled by User'), make_booking('a', '10:00:00')]
+    assert poll(client, bookings, 1000) == (['a'], True)
@@ -0,0 +1,145 @@
+import time
+import pytest
+from outbox import Outbox, PREREG
+
+def add_prereg(outbox: Outbox, appt_id: str = 'b1'):
+    outbox.add_preregs([{'pre_reg': {'appt_id': appt_id, 'booking_date': '2026-10-17', 'destination': 1,
+                                     'startTime': '2026-10-17T22:00:00-04:00', 'endTime': '2026-10-17T23:00:00-04:00'},
+                         'primary_id': 'G00000001',
+                         'visitor_id': 'v1'}])
+
+def pending(app):
+    return {op['key']: op for op in app.cache.outbox_due(float('inf'))}
+
+def test_success_saves_appointment(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    outbox.drain()
+    assert pending(app) == {}
+    assert app.cache.appt_lookup_many([('b1', '2026-10-17')]) == {('b1', '2026-10-17')}
+
+def test_failure_is_rescheduled_with_backoff(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.pp.error = 'boom'
+    before = time.time()
+    outbox.drain()
+    op = pending(app)[Outbox.prereg_key(('b1', '2026-10-17'))]
+    assert op['op'] == PREREG
+    assert op['attempts'] == 1
+    assert op['last_error'] == 'boom'
+    # The first retry is after base_delay, plus up to 25% jitter
+    assert before + 30 <= op['next_attempt_at'] <= time.time() + 30 * 1.25
+    # Not yet due
+    outbox.drain()
+    assert app.pp.calls == 1
+
+def test_backoff_doubles_up_to_max_delay(app):
+    app.config['LCPP']['outbox_max_attempts'] = 10
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.pp.error = 'boom'
+    delays = []
+    for attempt in range(4):
+        now = time.time()
+        outbox.drain()
+        op = pending(app)[Outbox.prereg_key(('b1', '2026-10-17'))]
+        delays.append(op['next_attempt_at'] - now)
+        # Make the operation due again
+        app.cache.reschedule_outbox([{**op, 'next_attempt_at': 0}])
+    for delay, expected in zip(delays, [30, 60, 100, 100]):
+        assert expected <= delay <= expected * 1.25 + 1
+
+def test_dropped_after_max_attempts(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.pp.error = 'boom'
+    for attempt in range(3):
+        assert len(pending(app)) == 1
+        app.cache.reschedule_outbox([{**op, 'next_attempt_at': 0} for op in pending(app).values()])
+        outbox.drain()
+    assert pending(app) == {}
+    assert app.pp.calls == 3
+    assert app.cache.appt_lookup_many([('b1', '2026-10-17')]) == set()
+
+def test_claimed_operations_are_hidden(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    assert len(app.cache.claim_outbox(time.time(), 300)) == 1
+    # Another worker finds nothing due until the claim times out
+    assert app.cache.claim_outbox(time.time(), 300) == []
+    assert len(app.cache.claim_outbox(time.time() + 301, 300)) == 1
+
+def test_duplicate_keys_are_ignored(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    add_prereg(outbox)
+    assert len(pending(app)) == 1
+    assert outbox.pending_appts([('b1', '2026-10-17'), ('b2', '2026-10-17')]) == {('b1', '2026-10-17')}
+
+def expire_claims(app):
+    '''Makes claimed operations due again, as if their claims had timed out.'''
+    app.cache.conn.execute('UPDATE outbox SET next_attempt_at = 0')
+    app.cache.conn.commit()
+
+def test_results_are_saved_as_they_complete(app):
+    outbox = Outbox(app)
+    add_prereg(outbox, 'b1')
+    add_prereg(outbox, 'b2')
+    def create_preregs(preregs, on_result=None):
+        # The first pre-registration is created, then the process stops
+        on_result(preregs[0], 'prereg-b1', None)
+        raise SystemExit
+    app.pp.create_preregs = create_preregs
+    with pytest.raises(SystemExit):
+        outbox.drain()
+    assert app.cache.appt_lookup_many([('b1', '2026-10-17'), ('b2', '2026-10-17')]) == {('b1', '2026-10-17')}
+    # The other stays claimed until the claim times out
+    assert list(pending(app)) == [Outbox.prereg_key(('b2', '2026-10-17'))]
+    assert app.cache.outbox_due(time.time()) == []
+
+def test_expired_claim_is_checked_before_retry(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    # A worker claims the pre-registration, which PassagePoint creates, but stops before saving the result
+    app.cache.claim_outbox(time.time(), 300)
+    app.pp.existing['b1'] = 'prereg-b1'
+    expire_claims(app)
+    outbox.drain()
+    assert app.pp.calls == 0
+    assert pending(app) == {}
+    assert app.cache.appt_lookup_many([('b1', '2026-10-17')]) == {('b1', '2026-10-17')}
+
+def test_failed_prereg_is_checked_before_retry(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.pp.error = 'timeout'
+    outbox.drain()
+    # The request timed out, but PassagePoint created the pre-registration
+    app.pp.error = None
+    app.pp.existing['b1'] = 'prereg-b1'
+    expire_claims(app)
+    outbox.drain()
+    assert app.pp.calls == 1
+    assert pending(app) == {}
+
+def test_prereg_not_found_is_created(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.cache.claim_outbox(time.time(), 300)
+    expire_claims(app)
+    outbox.drain()
+    assert app.pp.calls == 1
+    assert app.cache.appt_lookup_many([('b1', '2026-10-17')]) == {('b1', '2026-10-17')}
+
+def test_prereg_is_not_created_if_check_fails(app):
+    outbox = Outbox(app)
+    add_prereg(outbox)
+    app.cache.claim_outbox(time.time(), 300)
+    expire_claims(app)
+    app.pp.find_preregs = lambda preregs: [(args, None, Exception('unavailable')) for args in preregs]
+    outbox.drain()
+    assert app.pp.calls == 0
+    op = pending(app)[Outbox.prereg_key(('b1', '2026-10-17'))]
+    assert op['attempts'] == 1
+    assert 'unavailable' in op['last_error']
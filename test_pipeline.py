@@ -0,0 +1,69 @@
+import threading
+import pytest
+from conftest import FakeApp
+from booking import Booking
+from outbox import Outbox
+from pipeline import PipelineSync
+
+def make_booking(book_id: str, primary_id: str):
+    return Booking(book_id, 1, '2026-10-17T22:00:00-04:00', '2026-10-17T23:00:00-04:00', None, 'Mediated Approved', 'A', 'B', 'e', primary_id)
+
+class PipelineApp(FakeApp):
+    '''A FakeApp whose bookings are all for new users, with Alma profiles.'''
+
+    def __init__(self, cache, bookings):
+        super().__init__(cache)
+        self.bookings = bookings
+
+    def get_new_bookings(self):
+        return self.bookings
+
+    def sort_users(self, bookings):
+        return {}, {b['primary_id']: {'primary_id': b['primary_id']} for b in bookings}
+
+    def fetch_profiles(self, new_users):
+        return [{**user, 'barcode': f'b-{pid}', 'user_group': 'Staff', 'iz': None, 'fetched_at': 0} for pid, user in new_users.items()]
+
+def run(app):
+    '''Runs a cycle of the pipeline, failing if it doesn't finish.'''
+    def target():
+        try:
+            PipelineSync(app).run()
+        finally:
+            app.cache.close_connection()
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), 'The pipeline did not finish'
+
+@pytest.fixture
+def app(cache):
+    return PipelineApp(cache, [make_booking('a', 'G00000001'), make_booking('b', 'G00000002')])
+
+def test_bookings_are_registered(app):
+    run(app)
+    assert app.cache.appt_lookup_many([('a', '2026-10-17'), ('b', '2026-10-17')]) == {('a', '2026-10-17'), ('b', '2026-10-17')}
+    assert set(app.cache.user_lookup_many(['G00000001', 'G00000002'])) == {'G00000001', 'G00000002'}
+
+def test_error_saving_visitor_doesnt_stop_bookings(app):
+    def make_user_record(visitor, visitor_id):
+        raise KeyError('barcode')
+    app.make_user_record = make_user_record
+    run(app)
+    assert app.cache.appt_lookup_many([('a', '2026-10-17'), ('b', '2026-10-17')]) == {('a', '2026-10-17'), ('b', '2026-10-17')}
+
+def test_preregs_are_written_ahead(app, monkeypatch):
+    # The process stops before the results are saved
+    monkeypatch.setattr(PipelineSync, '_save', lambda self: None)
+    run(app)
+    ops = app.cache.outbox_due(float('inf'))
+    assert {op['key'] for op in ops} == {Outbox.prereg_key(('a', '2026-10-17')), Outbox.prereg_key(('b', '2026-10-17'))}
+    # Claimed, so that they are checked in PassagePoint before they are retried
+    assert all(Outbox.in_doubt(op) for op in ops)
+
+def test_failed_preregs_are_rescheduled(app):
+    app.pp.error = 'boom'
+    run(app)
+    ops = app.cache.outbox_due(float('inf'))
+    assert [(op['attempts'], op['last_error']) for op in ops] == [(1, 'boom'), (1, 'boom')]
+    assert app.cache.appt_lookup_many([('a', '2026-10-17')]) == set()
@@ -0,0 +1,21 @@
+from types import SimpleNamespace
+from polling import AdaptivePoller
+
+def make_poller(cache, **config):
+    app = SimpleNamespace(config={'LCPP': {'interval': 300, **config}, 'LibCal': {'locations': [{'id': 1}]}}, cache=cache)
+    return AdaptivePoller(app)
+
+def test_open_interval_is_capped_at_fixed_interval(cache):
+    poller = make_poller(cache)
+    # No bookings have arrived yet
+    assert poller.next_interval(1000) == 300
+    # Bookings arriving slowly don't stretch the interval beyond it either
+    poller.observe(0, 1000)
+    poller.observe(1, 1600)
+    assert poller.next_interval(1600) == 300
+
+def test_busy_locations_are_polled_more_often(cache):
+    poller = make_poller(cache)
+    poller.observe(0, 1000)
+    poller.observe(10, 1100)
+    assert poller.next_interval(1100) == 60
@@ -0,0 +1,20 @@
+import json
+import pytest
+from prewarm import read_alma_export
+
+USERS = [{'primary_id': 'G00000001'}, {'primary_id': 'G00000002'}]
+
+@pytest.mark.parametrize('content', [json.dumps(USERS),
+                                     '\n'.join(json.dumps(user) for user in USERS),
+                                     json.dumps({'user': USERS, 'total_record_count': 2}),
+                                     '\n'.join(json.dumps({'user': user}) for user in USERS)])
+def test_json_export_shapes(tmp_path, content):
+    path = tmp_path / 'users.json'
+    path.write_text(content)
+    assert [user['primary_id'] for user in read_alma_export(str(path))] == ['G00000001', 'G00000002']
+
+def test_json_export_rejects_other_records(tmp_path):
+    path = tmp_path / 'users.json'
+    path.write_text(json.dumps({'total_record_count': 2}))
+    with pytest.raises(ValueError):
+        list(read_alma_export(str(path)))
@@ -0,0 +1,23 @@
+import asyncio
+import time
+from rate_limiter import SlidingWindow
+
+def acquire(window: SlidingWindow, times: int):
+    '''Acquires the window the given number of times, returning the time taken (or raising TimeoutError if it stalls).'''
+    async def run():
+        for _ in range(times):
+            await window.acquire()
+    start = time.monotonic()
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    return time.monotonic() - start
+
+def test_rate_limits_acquisitions_per_period():
+    window = SlidingWindow(5, period=0.1)
+    # The first five are immediate; the sixth waits for the first to leave the window
+    assert acquire(window, 5) < 0.1
+    assert acquire(window, 1) >= 0.05
+
+def test_rate_below_one_per_period_spaces_acquisitions():
+    # Half an acquisition per period: one every two periods
+    window = SlidingWindow(0.5, period=0.1)
+    assert acquire(window, 3) >= 0.4
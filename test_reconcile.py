@@ -0,0 +1,98 @@
+import json
+from datetime import datetime, timedelta
+from booking import Booking
+from outbox import Outbox, UPDATE, CANCEL
+from reconcile import Reconciler
+
+LOCATION = 1
+# Bookings are made relative to a fixed time, so that the same booking made twice has the same fingerprint
+NOW = datetime.now().astimezone()
+
+def timestamp(hours: float):
+    '''A LibCal date string for the given number of hours from now.'''
+    return (NOW + timedelta(hours=hours)).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+def make_booking(book_id: str, start: float = 0, end: float = 1, lid: int = LOCATION):
+    return Booking(book_id, lid, timestamp(start), timestamp(end), None, 'Mediated Approved', 'A', 'B', 'e', 'G00000001')
+
+def register(app, *bookings):
+    '''Saves appointments for the bookings, as if they had been pre-registered.'''
+    app.cache.add_appt([app.make_appt_record(app.make_prereg(b), f'p-{b.bookId}') for b in bookings])
+
+def queued(app):
+    return {op['key']: (op['op'], json.loads(op['payload'])) for op in app.cache.outbox_due(float('inf'))}
+
+def test_unchanged_bookings(app):
+    bookings = [make_booking('a'), make_booking('b')]
+    register(app, *bookings)
+    Reconciler(app).reconcile(bookings, [LOCATION])
+    assert queued(app) == {}
+
+def test_changed_booking_is_updated(app):
+    register(app, make_booking('a'), make_booking('b'))
+    changed = make_booking('a', end=2)
+    Reconciler(app).reconcile([changed, make_booking('b')], [LOCATION])
+    ops = queued(app)
+    assert list(ops) == [Outbox.update_key(app.appt_key(changed))]
+    op, payload = ops[Outbox.update_key(app.appt_key(changed))]
+    assert op == UPDATE
+    assert payload['prereg_id'] == 'p-a'
+    assert payload['pre_reg']['endTime'] == changed.toDate
+
+def test_missing_booking_is_cancelled(app):
+    register(app, make_booking('a'), make_booking('b'))
+    Reconciler(app).reconcile([make_booking('b')], [LOCATION])
+    ops = queued(app)
+    assert list(ops) == [Outbox.cancel_key(app.appt_key(make_booking('a')))]
+    op, payload = list(ops.values())[0]
+    assert op == CANCEL
+    assert (payload['prereg_id'], payload['recreate']) == ('p-a', None)
+
+def test_changed_booking_is_recreated_without_update_endpoint(app):
+    app.pp.update_prereg_endpt = None
+    app.cache.add_users([{'primary_id': 'G00000001', 'barcode': 'b1', 'visitor_id': 'v1'}])
+    register(app, make_booking('a'))
+    Reconciler(app).reconcile([make_booking('a', lid=2)], [LOCATION])
+    op, payload = queued(app)[Outbox.cancel_key(app.appt_key(make_booking('a')))]
+    assert payload['recreate']['pre_reg']['destination'] == 2
+    assert payload['recreate']['visitor_id'] == 'v1'
+
+def test_nothing_without_delete_endpoint(app):
+    app.pp.delete_prereg_endpt = None
+    register(app, make_booking('a'))
+    Reconciler(app).reconcile([], [LOCATION])
+    assert queued(app) == {}
+
+def test_only_given_locations_are_compared(app):
+    register(app, make_booking('a'), make_booking('b', lid=2))
+    Reconciler(app).reconcile([], [2])
+    assert list(queued(app)) == [Outbox.cancel_key(app.appt_key(make_booking('b')))]
+
+def test_ended_appointments_are_ignored(app):
+    register(app, make_booking('a', start=-2, end=-1))
+    Reconciler(app).reconcile([], [LOCATION])
+    assert queued(app) == {}
+
+def test_pending_changes_are_not_queued_again(app):
+    register(app, make_booking('a'))
+    reconciler = Reconciler(app)
+    reconciler.reconcile([make_booking('a', end=2)], [LOCATION])
+    reconciler.reconcile([], [LOCATION])
+    assert [op for op, _ in queued(app).values()] == [UPDATE]
+
+def test_unreadable_times_are_left_alone(app):
+    register(app, make_booking('a'))
+    booking = make_booking('a')
+    booking.toDate = None
+    Reconciler(app).reconcile([booking], [LOCATION])
+    assert queued(app) == {}
+
+def test_legacy_appointments_are_backfilled(app):
+    register(app, make_booking('a'), make_booking('b'))
+    app.cache.conn.execute('UPDATE appts SET fingerprint = NULL')
+    app.cache.conn.commit()
+    Reconciler(app).reconcile([make_booking('a'), make_booking('b', end=2)], [LOCATION])
+    # Only the booking that differs in its times is updated; the other gets its fingerprint
+    assert list(queued(app)) == [Outbox.update_key(app.appt_key(make_booking('b')))]
+    rows = {row['appt_id']: row for row in app.cache.reconcile_lookup(app.appt_key(make_booking('a'))[1], [LOCATION], 0)}
+    assert rows['a']['fingerprint'] == app.booking_fingerprint(make_booking('a'))
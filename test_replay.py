@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+import pytest
+import requests
+from conftest import FakeApp
+from app import LibCal2PP
+from replay import ReplayIndex, make_handler, proxy_url
+
+BOOKINGS_URL = 'https://libcal.example.edu/1.1/space/bookings'
+DAY = 24 * 3600
+
+def timestamp(t: float):
+    '''A LibCal date string for a UNIX timestamp.'''
+    return datetime.fromtimestamp(t).astimezone().isoformat(timespec='seconds')
+
+def recording(recorded_at: float):
+    '''A recording of a single poll of LibCal, at recorded_at, returning bookings that start an hour later.'''
+    bookings = [{'bookId': book_id, 'lid': 1, 'fromDate': timestamp(recorded_at + 3600), 'toDate': timestamp(recorded_at + 7200),
+                 'created': timestamp(recorded_at - 600), 'status': 'Mediated Approved', 'primary_id': primary_id}
+                for book_id, primary_id in (('a', 'G00000001'), ('b', 'G00000002'))]
+    return [{'time': recorded_at, 'elapsed': 0, 'upstream': 'libcal', 'method': 'GET', 'url': BOOKINGS_URL,
+             'credential': None, 'request': {}, 'status': 200, 'headers': {'Content-Type': 'application/json'},
+             'body': json.dumps(bookings)}]
+
+class ReplayLibCal():
+    '''Stands in for LibCalRequests, fetching the bookings through the replay server.'''
+
+    def __init__(self, url: str):
+        self.url = url
+        self.complete_locations = []
+
+    def retrieve_bookings_by_location(self, locations):
+        return requests.get(self.url).json()
+
+class ReplayApp(FakeApp):
+    '''A FakeApp that runs LibCal2PP's sync against the replayed bookings, for users already registered in PassagePoint.'''
+    get_new_bookings = LibCal2PP.get_new_bookings
+    log_new_bookings = LibCal2PP.log_new_bookings
+    owned_locations = LibCal2PP.owned_locations
+
+    def __init__(self, cache, libcal):
+        super().__init__(cache)
+        self.libcal = libcal
+        self.leases = None
+        self.reconciler = None
+        self.appt_retention = 3600
+        self.error_cache = set()
+
+    def process_users(self, bookings):
+        return {b['primary_id']: f'visitor-{b["primary_id"]}' for b in bookings}
+
+    def drain_outbox(self):
+        self.outbox.drain()
+
+@pytest.fixture
+def replay(cache):
+    '''Returns a function that replays a recording, returning the app that polled it.'''
+    servers = []
+    def replay(records, shift=True):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler('replay', index=ReplayIndex(records, shift=shift)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        app = ReplayApp(cache, ReplayLibCal(proxy_url(f'http://127.0.0.1:{server.server_port}', 'libcal', BOOKINGS_URL)))
+        app.log_new_bookings()
+        return app
+    yield replay
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def test_replay_on_later_day(replay):
+    app = replay(recording(time.time() - DAY))
+    assert app.pp.calls == 2
+    assert len(app.cache.appt_lookup_many(app.appt_key(b) for b in app.libcal.retrieve_bookings_by_location(None))) == 2
+
+def test_replay_without_shift_keeps_recorded_dates(replay):
+    # The bookings ended a day ago, so they are ignored
+    app = replay(recording(time.time() - DAY), shift=False)
+    assert app.pp.calls == 0
@@ -0,0 +1,104 @@
+import sqlite3
+from datetime import date
+import pytest
+from sqlite_cache import SQLiteCache, MIGRATIONS
+
+def profile(primary_id: str, barcode: str, **fields):
+    return {'primary_id': primary_id, 'barcode': barcode, 'user_group': None, 'iz': None, 'fetched_at': 1.0, **fields}
+
+def test_merge_profiles_keeps_visitor_id(cache):
+    cache.add_users([{'primary_id': 'G1', 'barcode': 'b1', 'visitor_id': 'v1'}])
+    cache.merge_profiles([profile('G1', 'b1', user_group='gw und'), profile('G2', 'b2')])
+    users = cache.user_lookup_many(['G1', 'G2'])
+    assert users['G1']['visitor_id'] == 'v1'
+    assert users['G1']['user_group'] == 'gw und'
+    assert users['G2']['visitor_id'] is None
+
+def test_merge_profiles_drops_visitor_id_if_barcode_changed(cache):
+    cache.add_users([{'primary_id': 'G1', 'barcode': 'b1', 'visitor_id': 'v1', 'iz': 'iz1'}])
+    cache.merge_profiles([profile('G1', 'b2')])
+    user = cache.user_lookup_many(['G1'])['G1']
+    assert user['visitor_id'] is None
+    assert user['iz'] == 'iz1'
+
+SHARDS = ['1', '2', '3', '4']
+
+def test_claim_leases_single_worker(cache):
+    assert cache.claim_leases('w1', SHARDS, 1000, 120) == set(SHARDS)
+
+def test_claim_leases_fair_share(cache):
+    cache.claim_leases('w1', SHARDS, 1000, 120)
+    # A new worker gets nothing until the others give up their excess leases
+    assert cache.claim_leases('w2', SHARDS, 1001, 120) == set()
+    w1 = cache.claim_leases('w1', SHARDS, 1002, 120)
+    w2 = cache.claim_leases('w2', SHARDS, 1003, 120)
+    assert len(w1) == len(w2) == 2
+    assert w1 | w2 == set(SHARDS)
+
+def test_claim_leases_takes_over_expired(cache):
+    cache.claim_leases('w1', SHARDS, 1000, 120)
+    cache.claim_leases('w2', SHARDS, 1001, 120)
+    # w1 stops renewing; once its heartbeat and leases expire, w2 takes over all of the shards
+    assert cache.claim_leases('w2', SHARDS, 1000 + 121, 120) == set(SHARDS)
+
+def test_release_leases(cache):
+    cache.claim_leases('w1', SHARDS, 1000, 120)
+    cache.claim_leases('w2', SHARDS, 1001, 120)
+    cache.release_leases('w1')
+    assert cache.claim_leases('w2', SHARDS, 1002, 120) == set(SHARDS)
+
+def columns(conn, table: str):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    '''A database as created by the first version of the app, before schema versions were recorded.'''
+    path = str(tmp_path / 'baseline.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE users (primary_id text PRIMARY KEY, barcode text, visitor_id text)')
+        conn.execute('CREATE TABLE appts (appt_id text PRIMARY KEY, prereg_id text)')
+        conn.execute("INSERT INTO users VALUES ('G00000001', 'b1', 'v1')")
+        conn.execute("INSERT INTO appts VALUES ('cs_1', 'p1')")
+    conn.close()
+    return path
+
+def test_migrate_baseline_db(baseline_db):
+    cache = SQLiteCache(baseline_db)
+    try:
+        assert cache.conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert {'user_group', 'iz', 'fetched_at'} <= columns(cache.conn, 'users')
+        assert {'booking_date', 'start_time', 'end_time', 'location_id', 'fingerprint'} <= columns(cache.conn, 'appts')
+        assert {'validators', 'fingerprint', 'held'} <= columns(cache.conn, 'watermarks')
+        assert {'shard', 'claimed_at'} <= columns(cache.conn, 'outbox')
+        # Existing rows are kept; appointments are assigned today's date
+        assert cache.user_lookup_many(['G00000001'])['G00000001']['visitor_id'] == 'v1'
+        assert cache.appt_lookup_many([('cs_1', date.today().isoformat())]) == {('cs_1', date.today().isoformat())}
+        # The new tables can be used
+        cache.update_watermark({'location_id': 1, 'booking_date': date.today().isoformat(), 'last_created': None, 'last_full_sweep': 1.0})
+        cache.add_outbox([{'key': 'k', 'op': 'prereg', 'payload': '{}', 'next_attempt_at': 0}])
+        assert cache.count_outbox() == 1
+    finally:
+        cache.close()
+
+def test_migrations_are_not_reapplied(baseline_db):
+    SQLiteCache(baseline_db).close()
+    cache = SQLiteCache(baseline_db)
+    try:
+        assert cache.conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert cache.appt_lookup_many([('cs_1', date.today().isoformat())]) == {('cs_1', date.today().isoformat())}
+    finally:
+        cache.close()
+
+def test_migrations_can_be_rerun(baseline_db):
+    # E.g., if the version was not recorded because the process stopped during a migration
+    SQLiteCache(baseline_db).close()
+    conn = sqlite3.connect(baseline_db)
+    conn.execute('PRAGMA user_version = 0')
+    conn.close()
+    cache = SQLiteCache(baseline_db)
+    try:
+        assert cache.conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert cache.user_lookup_many(['G00000001'])['G00000001']['visitor_id'] == 'v1'
+    finally:
+        cache.close()
@@ -0,0 +1,30 @@
+import io
+import json
+import pytest
+from utils import iter_json
+
+DOCUMENTS = ['[10.25]',
+             '[1e5]',
+             '[-0.5E-3, 12, 3.0e+2]',
+             '[{"a": 1.5, "b": [2, 3e1]}, "x, y", true, null, -7]',
+             ' [ 1 , 2 ,\n 3 ] ',
+             '[]']
+
+@pytest.mark.parametrize('doc', DOCUMENTS)
+def test_iter_json_array_any_chunk_size(doc):
+    for chunk_size in range(1, len(doc) + 1):
+        assert list(iter_json(io.StringIO(doc), chunk_size=chunk_size)) == json.loads(doc), chunk_size
+
+def test_iter_json_lines_any_chunk_size():
+    doc = '{"id": 1}\n10.25\n1e5\n"s"\n'
+    expected = [{'id': 1}, 10.25, 1e5, 's']
+    for chunk_size in range(1, len(doc) + 1):
+        assert list(iter_json(io.StringIO(doc), chunk_size=chunk_size)) == expected, chunk_size
+
+def test_iter_json_number_at_end_of_file():
+    assert list(iter_json(io.StringIO('10.25'), chunk_size=3)) == [10.25]
+
+@pytest.mark.parametrize('doc', ['[1, 2', '[{"a": 1}'])
+def test_iter_json_unterminated(doc):
+    with pytest.raises(ValueError):
+        list(iter_json(io.StringIO(doc), chunk_size=2))
@@ -0,0 +1,66 @@
+import threading
+import time
+from typing import Callable
+import logging
+
+class TokenManager():
+
+    def __init__(self, fetch: Callable, lifetime: float = None, refresh_margin: float = 60, name: str = 'API'):
+        '''Keeps an authentication token current, refreshing it in the background shortly before it expires.
+        fetch should be a function that requests a new token, returning a tuple of the token and its lifetime in seconds (or None if the API doesn't report one).
+        lifetime, if provided, is used for tokens whose lifetime is not reported. If neither is known, the token is only refreshed on demand (e.g., after a 401).
+        refresh_margin is the number of seconds before expiry at which to refresh the token.
+        name identifies the API in log messages.'''
+        self.logger = logging.getLogger('lcpp.token_manager')
+        self.fetch = fetch
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.name = name
+        self.token = None
+        self.expires_at = 0
+        self.timer = None
+        # Ensures that only one thread fetches a new token at a time
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''Returns a current token, fetching a new one if necessary.'''
+        token = self.token
+        if token and time.time() < self.expires_at:
+            return token
+        return self.refresh(stale=token)
+
+    def refresh(self, stale: str = None):
+        '''Fetches a new token to replace stale (the token last used by the caller, if any).
+        If another thread has already replaced that token, the new token is returned without fetching another.'''
+        with self.lock:
+            if self.token and (self.token != stale) and (time.time() < self.expires_at):
+                return self.token
+            self.logger.debug(f'Fetching new {self.name} token.')
+            token, expires_in = self.fetch()
+            lifetime = expires_in or self.lifetime
+            self.token = token
+            self.expires_at = time.time() + lifetime if lifetime else float('inf')
+            self._schedule_refresh(lifetime)
+            return token
+
+    def _schedule_refresh(self, lifetime: float):
+        '''Starts a timer to refresh the token refresh_margin seconds before it expires.'''
+        if self.timer:
+            self.timer.cancel()
+        if not lifetime:
+            return
+        self.timer = threading.Timer(max(lifetime - self.refresh_margin, 1), self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        '''Called by the timer. Errors are logged; if the refresh fails, a new token will be fetched on the next request.'''
+        try:
+            self.refresh(stale=self.token)
+        except Exception as e:
+            self.logger.exception(f'Error refreshing {self.name} token in the background -- {e}')
+
+    def close(self):
+        '''Stops the background refresh.'''
+        if self.timer:
+            self.timer.cancel()
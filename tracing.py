@@ -0,0 +1,171 @@
+import cProfile
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Dict, Iterable
+import logging
+
+class Span():
+
+    __slots__ = ('tracer', 'name', 'tags', 'start')
+
+    def __init__(self, tracer, name: str, tags: Dict):
+        '''A timed section of code, recorded by the tracer when it ends. Spans on the same thread nest by time.'''
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.tags['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.tags)
+        return False
+
+    def tag(self, **tags):
+        '''Adds tags (e.g., counts known only at the end of the span).'''
+        self.tags.update(tags)
+
+class NoopSpan():
+
+    '''Returned in place of a Span when tracing is disabled.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class Tracer():
+
+    def __init__(self):
+        '''Collects spans from all threads while enabled. When disabled (the default), span returns a shared no-op object, so the cost of tracing is a single attribute check.'''
+        self.enabled = False
+        self.events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def span(self, name: str, **tags):
+        '''Returns a context manager that records the time spent in the block, with the given tags.'''
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, tags)
+
+    def record(self, name: str, start: float, end: float, tags: Dict = None):
+        '''Records a span directly, given its start and end (from time.perf_counter). Used where a context manager doesn't fit, such as the callbacks of an aiohttp request.'''
+        if not self.enabled:
+            return
+        # list.append is atomic, so spans may be recorded from any thread
+        self.events.append({'name': name,
+                            'ph': 'X', # Complete event, in the Chrome trace format
+                            'ts': (start - self.origin) * 1e6,
+                            'dur': (end - start) * 1e6,
+                            'pid': self.pid,
+                            'tid': threading.get_ident(),
+                            'args': tags or {}})
+
+    def reset(self):
+        '''Returns the spans recorded so far, and starts a new list.'''
+        events, self.events = self.events, []
+        return events
+
+    @staticmethod
+    def chrome_trace(events: Iterable[Dict]):
+        '''Returns the spans in the Chrome trace format (for chrome://tracing or Perfetto).'''
+        return {'traceEvents': sorted(events, key=lambda e: e['ts']),
+                'displayTimeUnit': 'ms'}
+
+# Tracer used by the app's components
+TRACER = Tracer()
+
+def span(name: str, **tags):
+    '''Shortcut for TRACER.span.'''
+    return TRACER.span(name, **tags)
+
+def traced(name: str, tags: Callable = None):
+    '''Decorator that records each call to the function as a span.
+    tags, if provided, should be a function taking the same arguments as the decorated function and returning a dictionary of tags (e.g., the ID of the booking or user being processed).
+    For generator functions, the span covers the iteration of the generator.'''
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not TRACER.enabled:
+                    return (yield from func(*args, **kwargs))
+                with TRACER.span(name, **(tags(*args, **kwargs) if tags else {})):
+                    return (yield from func(*args, **kwargs))
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not TRACER.enabled:
+                    return func(*args, **kwargs)
+                with TRACER.span(name, **(tags(*args, **kwargs) if tags else {})):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TracedCursor(sqlite3.Cursor):
+
+    '''Cursor that records each SQLite statement as a span. Used by SQLiteCache when tracing is enabled.'''
+
+    def execute(self, sql: str, *args):
+        with TRACER.span('sqlite', sql=' '.join(sql.split())[:200]):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql: str, *args):
+        with TRACER.span('sqlite', sql=' '.join(sql.split())[:200], many=True):
+            return super().executemany(sql, *args)
+
+class CycleProfiler():
+
+    def __init__(self, output_dir: str, formats: Iterable[str] = ('trace', 'cprofile')):
+        '''Enables tracing and writes the results of each cycle to output_dir.
+        formats may include "trace" (the spans, as a Chrome trace JSON file) and "cprofile" (cProfile statistics for the calling thread, readable with pstats or snakeviz).'''
+        self.logger = logging.getLogger('lcpp.tracing')
+        self.output_dir = output_dir
+        self.formats = set(formats)
+        os.makedirs(output_dir, exist_ok=True)
+        TRACER.enabled = True
+
+    @contextmanager
+    def cycle(self):
+        '''Context manager that profiles a single cycle.'''
+        TRACER.reset()
+        profile = cProfile.Profile() if 'cprofile' in self.formats else None
+        name = f'cycle-{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}'
+        if profile:
+            profile.enable()
+        try:
+            with TRACER.span('cycle'):
+                yield
+        finally:
+            if profile:
+                profile.disable()
+            self._write(name, TRACER.reset(), profile)
+
+    def _write(self, name: str, events: list, profile: cProfile.Profile):
+        '''Writes the output files for a cycle. Errors are logged, so as not to interrupt the app.'''
+        try:
+            if 'trace' in self.formats:
+                with open(os.path.join(self.output_dir, f'{name}.json'), 'w') as f:
+                    json.dump(TRACER.chrome_trace(events), f, default=str)
+            if profile:
+                profile.dump_stats(os.path.join(self.output_dir, f'{name}.prof'))
+            self.logger.debug(f'Wrote profile for {name} to {self.output_dir}.')
+        except Exception as e:
+            self.logger.exception(f'Error writing profile for {name} -- {e}')
@@ -1,6 +1,9 @@
+import json
+import re
 import yaml
-from typing import List, Dict
-from itertools import tee, filterfalse
+from datetime import datetime
+from typing import List, Dict, IO
+from itertools import tee, filterfalse, islice
 
 def load_config(config_path: str):
     '''Opens the YAML config file at the given path. '''
@@ -38,4 +41,75 @@ def check_config(config: Dict, top_level_key: str, config_keys: List[str], obj=N
 def partition(pred, iterable):
     '''Use a predicate to partition entries into false entries and true entries. From itertools recipes'''
     t1, t2 = tee(iterable)
-    return filterfalse(pred, t1), filter(pred, t2)
\ No newline at end of file
+    return filterfalse(pred, t1), filter(pred, t2)
+
+def chunked(iterable, size: int):
+    '''Yields successive lists of at most size entries from iterable.'''
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def to_timestamp(iso_date: str):
+    '''Converts a LibCal date string (e.g., 2020-08-22T20:05:00-04:00) to a UNIX timestamp.'''
+    return datetime.strptime(iso_date, '%Y-%m-%dT%H:%M:%S%z').timestamp()
+
+_JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+_JSON_SEPARATORS = re.compile(r'[ \t\r\n,]*')
+# The rest of the buffer, after a number, if it may yet turn out to be part of the number
+_JSON_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+def iter_json(f: IO, chunk_size: int = 1 << 16):
+    '''Yields the elements of a JSON array read from the text file f, parsing them one at a time, so that arrays larger than memory can be processed.
+    If the file does not start with an array, yields each of the (whitespace-separated) JSON values in the file instead, as for JSON Lines.'''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        # Discards the consumed part of the buffer and reads another chunk; returns False at the end of the file
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return not eof
+
+    def skip(pattern):
+        # Advances past the characters matched by pattern (reading more as needed); returns the next character, or None at the end of the file
+        nonlocal pos
+        while True:
+            pos = pattern.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                return None
+
+    in_array = skip(_JSON_WHITESPACE) == '['
+    if in_array:
+        pos += 1
+    separators = _JSON_SEPARATORS if in_array else _JSON_WHITESPACE
+    while True:
+        char = skip(separators)
+        if char is None:
+            if in_array:
+                raise ValueError('Unterminated JSON array.')
+            return
+        if in_array and char == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The value continues past the end of the buffer
+            if fill():
+                continue
+            raise
+        # A number at the end of the buffer may continue in the next chunk (e.g., "10" of "10.25", decoded from "10.")
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and not eof \
+                and _JSON_NUMBER_TAIL.match(buffer, end) and fill():
+            continue
+        pos = end
+        yield value